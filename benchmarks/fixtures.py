@@ -0,0 +1,106 @@
+##############################################################################################
+"""
+Synthetic audio and video fixtures for the benchmarks
+
+Speakers are harmonic tones with their own pitch, syllable-rate amplitude modulation and a little
+noise, talking in alternating turns separated by short pauses. The videos are ffmpeg test patterns
+muxed with that audio. Everything is generated locally, no network needed.
+"""
+##############################################################################################
+
+import os
+import numpy as np
+import audio_io
+
+SAMPLE_RATE = 16000
+PAUSE = 0.3  # Seconds of silence between turns
+
+
+def speaker_pitch(speaker):
+    """Fundamental frequency of a synthetic speaker in Hz"""
+    return 95.0 + 55.0 * speaker
+
+
+def synth_voice(speaker, duration, rng, sample_rate=SAMPLE_RATE):
+    """int16 samples of one speaker talking for duration seconds"""
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    f0 = speaker_pitch(speaker) * (1 + 0.03 * np.sin(2 * np.pi * 0.5 * t))  # Slow intonation
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 8))
+    syllables = 0.5 + 0.5 * np.sin(2 * np.pi * (3.5 + 0.3 * speaker) * t) ** 2
+    voice = voice * syllables + 0.05 * rng.standard_normal(len(t))
+    return (voice / np.abs(voice).max() * 12000).astype(np.int16)
+
+
+def make_conversation(path, duration=60.0, speakers=3, turn_len=(3.0, 15.0), seed=0):
+    """Write a wav of speakers talking in turns
+
+    Args:
+        path (str): target wav filepath
+        duration (float, optional): Length in seconds. Defaults to 60.
+        speakers (int, optional): Number of speakers. Defaults to 3.
+        turn_len (tuple, optional): Min and max turn length in seconds. Defaults to (3, 15).
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        list: ground truth (start, end, speaker) turns
+    """
+    rng = np.random.default_rng(seed)
+    samples = np.zeros(int(duration * SAMPLE_RATE), dtype=np.int16)
+    turns, start, speaker = [], 0.0, 0
+    while start < duration - turn_len[0]:
+        length = min(rng.uniform(*turn_len), duration - start)
+        begin = int(start * SAMPLE_RATE)
+        voice = synth_voice(speaker, length, rng)
+        samples[begin : begin + len(voice)] = voice
+        turns.append((start, start + length, speaker))
+        start += length + PAUSE
+        speaker = (speaker + 1 + rng.integers(speakers - 1)) % speakers if speakers > 1 else 0
+    audio_io.write_wav(path, samples, SAMPLE_RATE)
+    return turns
+
+
+def make_reference_clips(folder, speaker, clips=3, length=8.0, seed=1):
+    """Write reference wavs of one speaker, as download_ref_segments.py would
+
+    Returns:
+        list: filepaths of the clips
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(clips):
+        path = os.path.join(folder, f"ref_{i}.wav")
+        audio_io.write_wav(path, synth_voice(speaker, length, rng), SAMPLE_RATE)
+        paths.append(path)
+    return paths
+
+
+def make_video(path, wav_path, duration, size=(320, 240), fps=25):
+    """Mux an ffmpeg test pattern with a wav into an mp4"""
+    import ffmpeg
+
+    video = ffmpeg.input(
+        f"testsrc2=size={size[0]}x{size[1]}:rate={fps}", f="lavfi", t=duration
+    )
+    audio = ffmpeg.input(wav_path)
+    stream = ffmpeg.output(
+        video, audio, path, vcodec="libx264", preset="ultrafast", pix_fmt="yuv420p", acodec="aac"
+    )
+    stream.run(overwrite_output=True, quiet=True)
+
+
+def make_compressed_audio(path, wav_path):
+    """Encode a wav as AAC, the input ensure_wav has to decode"""
+    import ffmpeg
+
+    ffmpeg.input(wav_path).output(path, acodec="aac", ar=44100, ac=2).run(
+        overwrite_output=True, quiet=True
+    )
+
+
+def make_reference_image(path, size=(160, 160), seed=2):
+    """A flat-colored reference "face" for the mock face verifier, stored as .npy"""
+    rng = np.random.default_rng(seed)
+    color = rng.integers(0, 255, 3)
+    np.save(path, np.broadcast_to(color, size + (3,)).astype(np.uint8))
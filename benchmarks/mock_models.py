@@ -0,0 +1,165 @@
+##############################################################################################
+"""
+Tiny CPU stand-ins for the models, with the interfaces the pipeline calls
+
+- FakeSpeakerModel: speechbrain SpeakerRecognition (load_audio, encode_batch), embeddings are
+  pooled log spectra, so the synthetic speakers stay separable
+- FakeDiarizationPipeline: pyannote Pipeline, energy-based turns labelled by pitch
+- FakeFaceVerifier: FaceVerifier, color statistics of a center crop as the "face" embedding
+- mock_model_set: a ModelSet built from the three, to hand to Diarization(models=...)
+
+They cost a fraction of the real models, so the benchmarks measure the code around them.
+"""
+##############################################################################################
+
+import os
+import types
+import numpy as np
+import audio_io
+from speaker_embedding import SpeakerEmbedder
+
+
+class FakeSpeakerModel:
+    def __init__(self, sample_rate=16000, dim=192, win=400, hop=160):
+        import torch
+
+        self.device = torch.device("cpu")
+        self.audio_normalizer = types.SimpleNamespace(sample_rate=sample_rate)
+        self.dim = dim
+        self.win = win
+        self.hop = hop
+        self.window = torch.hann_window(win)
+
+    def load_audio(self, path):
+        import torch
+
+        samples, _ = audio_io.read_wav(path)
+        return torch.from_numpy(audio_io.to_float(samples))
+
+    def encode_batch(self, wavs, wav_lens=None):
+        """Mean log band energies over the valid frames of each padded waveform
+
+        Returns:
+            torch.Tensor: (batch, 1, dim) embeddings, like speechbrain
+        """
+        import torch
+
+        if wavs.shape[1] < self.win:
+            wavs = torch.nn.functional.pad(wavs, (0, self.win - wavs.shape[1]))
+        frames = wavs.unfold(1, self.win, self.hop) * self.window
+        spectrum = torch.fft.rfft(frames).abs() ** 2
+        bands = torch.nn.functional.adaptive_avg_pool1d(
+            spectrum.reshape(-1, spectrum.shape[-1]).unsqueeze(1), self.dim
+        ).reshape(spectrum.shape[0], spectrum.shape[1], self.dim)
+        if wav_lens is None:
+            wav_lens = torch.ones(wavs.shape[0])
+        lengths = wav_lens * wavs.shape[1]
+        valid = ((lengths - self.win) // self.hop + 1).clamp(min=1)
+        mask = (torch.arange(bands.shape[1])[None, :] < valid[:, None]).float()
+        pooled = (bands * mask[:, :, None]).sum(1) / mask.sum(1, keepdim=True)
+        return torch.log1p(pooled * 1e3).unsqueeze(1)
+
+
+class Segment:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+
+class FakeAnnotation:
+    def __init__(self, turns):
+        self.turns = turns
+
+    def itertracks(self, yield_label=False):
+        for i, (start, end, label) in enumerate(self.turns):
+            if yield_label:
+                yield Segment(start, end), i, label
+            else:
+                yield Segment(start, end), i
+
+
+class FakeDiarizationPipeline:
+    def __init__(self, frame=0.02, min_pause=0.2, threshold=0.02):
+        """Energy VAD plus pitch labels
+
+        Args:
+            frame (float, optional): Frame length in seconds. Defaults to 0.02.
+            min_pause (float, optional): Shortest silence that ends a turn. Defaults to 0.2.
+            threshold (float, optional): RMS (of full scale) of a voiced frame. Defaults to 0.02.
+        """
+        self.frame = frame
+        self.min_pause = min_pause
+        self.threshold = threshold
+
+    def __call__(self, audio_file):
+        samples, sample_rate = audio_io.read_wav(audio_file)
+        frame_len = int(self.frame * sample_rate)
+        num_frames = len(samples) // frame_len
+        frames = samples[: num_frames * frame_len].reshape(num_frames, frame_len)
+        rms = np.sqrt(((frames.astype(np.float32) / 32768.0) ** 2).mean(axis=1))
+
+        # Turns are voiced runs, pauses shorter than min_pause do not split them
+        voiced = np.flatnonzero(rms > self.threshold)
+        if len(voiced) == 0:
+            return FakeAnnotation([])
+        breaks = np.flatnonzero(np.diff(voiced) > self.min_pause / self.frame)
+        firsts = np.r_[voiced[0], voiced[breaks + 1]]
+        lasts = np.r_[voiced[breaks], voiced[-1]] + 1
+
+        annotated = []
+        for first, last in zip(firsts, lasts):
+            segment = samples[first * frame_len : last * frame_len].astype(np.float32)
+            spectrum = np.abs(np.fft.rfft(segment[: sample_rate]))
+            pitch = np.argmax(spectrum[1:]) + 1
+            pitch_hz = pitch * sample_rate / min(len(segment), sample_rate)
+            label = f"SPEAKER_{int(round((pitch_hz - 95.0) / 55.0)):02d}"
+            annotated.append((first * self.frame, last * self.frame, label))
+        return FakeAnnotation(annotated)
+
+    def to(self, device):
+        return self
+
+
+class FakeFaceVerifier:
+    def __init__(self, threshold=0.40, batch_size=32, crop=64):
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.crop = crop
+
+    def detect_faces(self, img):
+        """The center crop is the "face" """
+        if isinstance(img, str):
+            img = np.load(img)
+        h, w = img.shape[:2]
+        c = self.crop // 2
+        return [img[h // 2 - c : h // 2 + c, w // 2 - c : w // 2 + c].astype(np.float32) / 255]
+
+    def embed_faces(self, faces):
+        faces = np.stack(faces)
+        embeddings = np.concatenate(
+            [faces.mean(axis=(1, 2)), faces.std(axis=(1, 2)), np.ones((len(faces), 1))], axis=1
+        )
+        return embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+
+    def embed_reference(self, path):
+        if not os.path.exists(path):
+            raise OSError(f"No reference image {path}")
+        return self.embed_faces(self.detect_faces(path))[0]
+
+    def distances(self, ref_embedding, frames):
+        faces = [self.detect_faces(frame)[0] for frame in frames]
+        if not faces:
+            return np.zeros(0)
+        return 1 - self.embed_faces(faces) @ np.asarray(ref_embedding)
+
+
+def mock_model_set(cache_folder, face_threshold=0.40):
+    """A ModelSet-like holder of the mock models"""
+    spkr_embed_model = FakeSpeakerModel()
+    return types.SimpleNamespace(
+        device="cpu",
+        spkr_embed_model=spkr_embed_model,
+        spkr_embedder=SpeakerEmbedder(spkr_embed_model, cache_folder=cache_folder),
+        face_verifier=FakeFaceVerifier(threshold=face_threshold),
+        pipeline=FakeDiarizationPipeline(),
+    )
@@ -0,0 +1,334 @@
+##############################################################################################
+"""
+Benchmark every stage of the diarize pipeline on synthetic fixtures with mocked CPU models
+
+python benchmarks/run.py [--duration 120] [--videos 2] [--output results.json]
+
+Stages: decode, diarize, embed, frames, face, export, and the whole diarize.py run both
+sequential (end_to_end) and through the pipelined executor (pipelined). Each reports seconds,
+items/sec, real-time factor (seconds of compute per second of audio, lower is faster) and the
+peak RSS of the process so far, as JSON. Stages whose dependencies (torch, ffmpeg) are missing
+are reported as skipped. No network or GPU is used.
+"""
+##############################################################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+import importlib.util
+import subprocess
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "src"))
+sys.path.insert(0, BENCH_DIR)
+
+POI_NAME = "Speaker A"
+
+
+def has_module(name):
+    return importlib.util.find_spec(name) is not None
+
+
+def missing(needs):
+    """Which of the requirements of a stage are not available"""
+    available = {
+        "torch": has_module("torch"),
+        "ffmpeg": has_module("ffmpeg") and shutil.which("ffmpeg") is not None,
+        # What diarize.py and media_tasks.py import
+        "pipeline": all(has_module(name) for name in ("pandas", "tqdm", "dotenv", "ffmpeg")),
+    }
+    return [need for need in needs if not available[need]]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def setup_env(workdir, args):
+    """Point every folder of the pipeline into the work dir, before diarize.py is imported"""
+    data = os.path.join(workdir, "data")
+    os.environ.update(
+        {
+            "DATA_FOLDER": data,
+            "VIDEO_FOLDER": "original_video",
+            "DIARIZATION_FOLDER": "diarization",
+            "POI_FOLDER": os.path.join(data, "poi_list"),
+            "CACHE_FOLDER": os.path.join(workdir, "cache"),
+            "REF_AUDIO_DIR": os.path.join(data, "ref_audio"),
+            "REF_IMAGES_DIR": os.path.join(data, "ref_images"),
+            "DEFAULT_REF_IMAGE_FORMAT": "npy",
+            "TMP_FOLDER": os.path.join(data, "tmp"),
+            "MIN_SEGMENT_LEN": str(args.min_seg_len),
+            "MAX_SEGMENT_LEN": str(args.max_seg_len),
+            "VOICE_THRESHOLD": "0.0",  # Accept every turn, so export has work to do
+            "FACE_THRESHOLD": "2.0",
+            "VERIFICATION_CASCADE": "voice,face",
+            "FRAMES_PER_TURN": str(args.frames_per_turn),
+            "EXPORT_VIDEO_FLAG": "true" if not missing(["ffmpeg"]) else "false",
+            "AUDIO_ONLY": "false",
+            "MODEL_SERVER_URL": "",
+        }
+    )
+    for folder in ("POI_FOLDER", "REF_IMAGES_DIR", "TMP_FOLDER", "CACHE_FOLDER"):
+        os.makedirs(os.environ[folder], exist_ok=True)
+
+
+def make_fixtures(args):
+    """Synthetic POI videos, reference clips and reference image
+
+    Returns:
+        list: (wav, mp4 or None, ground truth turns) per video
+    """
+    import fixtures
+
+    video_dir = os.path.join(os.environ["DATA_FOLDER"], "original_video", POI_NAME)
+    os.makedirs(video_dir, exist_ok=True)
+    videos = []
+    for i in range(args.videos):
+        wav = os.path.join(video_dir, f"video{i}.wav")
+        turns = fixtures.make_conversation(
+            wav, duration=args.duration, speakers=args.speakers, seed=i
+        )
+        mp4 = None
+        if not missing(["ffmpeg"]):
+            mp4 = os.path.join(video_dir, f"video{i}.mp4")
+            fixtures.make_video(mp4, wav, args.duration)
+        videos.append((wav, mp4, turns))
+    fixtures.make_reference_clips(os.path.join(os.environ["REF_AUDIO_DIR"], POI_NAME), speaker=0)
+    fixtures.make_reference_image(os.path.join(os.environ["REF_IMAGES_DIR"], f"{POI_NAME}.npy"))
+    with open(os.path.join(os.environ["POI_FOLDER"], "poi_list.csv"), "w") as f:
+        f.write(f"Name\n{POI_NAME}\n")
+    return videos
+
+
+class Bench:
+    def __init__(self, trace_memory=False):
+        self.results = []
+        self.trace_memory = trace_memory
+
+    def run(self, stage, fn, needs=(), audio_seconds=None):
+        """Time fn() and record its metrics, fn returns the number of items it processed"""
+        lacking = missing(needs)
+        if lacking:
+            self.results.append({"stage": stage, "skipped": f"needs {', '.join(lacking)}"})
+            return
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stderr):  # Keep stdout for the JSON results
+            items = fn()
+        seconds = time.perf_counter() - start
+        result = {
+            "stage": stage,
+            "seconds": round(seconds, 4),
+            "items": items,
+            "items_per_sec": round(items / seconds, 2) if seconds else None,
+            "audio_seconds": audio_seconds,
+            "rtf": round(seconds / audio_seconds, 5) if audio_seconds else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+        if self.trace_memory:
+            result["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+            tracemalloc.stop()
+        self.results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+
+def benchmark(args, workdir):
+    setup_env(workdir, args)
+    fixture_start = time.perf_counter()
+    videos = make_fixtures(args)
+    fixture_seconds = time.perf_counter() - fixture_start
+
+    # Pipeline modules are imported inside the stages that need them, so a stage with missing
+    # dependencies is skipped instead of failing the whole run
+    import audio_io
+    from mock_models import FakeDiarizationPipeline, FakeFaceVerifier, mock_model_set
+
+    bench = Bench(trace_memory=args.trace_memory)
+    wav, mp4, _ = videos[0]
+    total_audio = args.duration * len(videos)
+    state = {}
+
+    def decode():
+        import fixtures
+        import media_tasks
+
+        compressed = os.path.join(os.environ["TMP_FOLDER"], "decode_input.m4a")
+        fixtures.make_compressed_audio(compressed, wav)
+        start = time.perf_counter()
+        converted = media_tasks.ensure_wav(compressed, os.environ["TMP_FOLDER"])
+        state["decode_only"] = time.perf_counter() - start
+        os.remove(converted)
+        return 1
+
+    def diarize():
+        samples, sample_rate = audio_io.read_wav(wav)
+        annotation = FakeDiarizationPipeline()(wav)
+        state["turns"] = [
+            (turn.start, turn.end, label) for turn, _, label in annotation.itertracks(True)
+        ]
+        state["samples"], state["sample_rate"] = samples, sample_rate
+        return len(state["turns"])
+
+    def embed():
+        models = mock_model_set(os.environ["CACHE_FOLDER"])
+        sample_rate = state["sample_rate"]
+        segments = [
+            state["samples"][int(start * sample_rate) : int(end * sample_rate)]
+            for start, end, _ in state["turns"]
+        ]
+        models.spkr_embedder.embed_batch(
+            segments, sample_rate=sample_rate, batch_size=args.batch_size
+        )
+        return len(segments)
+
+    def frames():
+        from frame_extractor import FrameExtractor
+
+        extractor = FrameExtractor(frames_per_turn=args.frames_per_turn)
+        timestamps = [
+            t for start, end, _ in state["turns"] for t in extractor.turn_timestamps(start, end)
+        ]
+        state["frames"] = [frame for _, frame in extractor.extract(mp4, timestamps)]
+        return len(state["frames"])
+
+    def face():
+        verifier = FakeFaceVerifier()
+        ref = verifier.embed_reference(
+            os.path.join(os.environ["REF_IMAGES_DIR"], f"{POI_NAME}.npy")
+        )
+        for b in range(0, len(state["frames"]), verifier.batch_size):
+            verifier.distances(ref, state["frames"][b : b + verifier.batch_size])
+        return len(state["frames"])
+
+    def export():
+        import media_tasks
+        from diarize import Diarization
+
+        poi_file = os.path.join(os.environ["POI_FOLDER"], "poi_list.csv")
+        settings = Diarization(poi_file, load_models=False).settings
+        os.makedirs(os.path.join(settings["diarization_folder"], POI_NAME), exist_ok=True)
+        job = {
+            "name": POI_NAME,
+            "wav_file": wav,
+            "audio_file": wav,
+            "wav_name_no_ext": "export",
+            "video_file": mp4 or "",
+            "video_url": None,
+            "settings": settings,
+            "turns": state["turns"],
+            "accepted": [True] * len(state["turns"]),
+        }
+        exported = media_tasks.export_segments(job)["exported"]
+        for path, _, _ in exported:
+            os.remove(path)
+        return len(exported)
+
+    def end_to_end(pipelined):
+        def run():
+            from diarize import Diarization
+
+            # A fresh cache each time, so pyannote's stand-in runs instead of the turn cache
+            suffix = "pipelined" if pipelined else "sequential"
+            os.environ["CACHE_FOLDER"] = os.path.join(workdir, f"cache_{suffix}")
+            poi_file = os.path.join(os.environ["POI_FOLDER"], "poi_list.csv")
+            diarization = Diarization(
+                poi_file,
+                batch_size=args.batch_size,
+                models=mock_model_set(os.environ["CACHE_FOLDER"]),
+            )
+            output = os.path.join(diarization.diarization_folder, POI_NAME)
+            shutil.rmtree(output, ignore_errors=True)
+            os.makedirs(output)
+            if pipelined:
+                diarization.run_pipelined([POI_NAME], workers=args.workers)
+            else:
+                diarization.diarize(POI_NAME)
+            return len(os.listdir(output))
+
+        return run
+
+    bench.run("decode", decode, needs=["ffmpeg"], audio_seconds=args.duration)
+    if "decode_only" in state:
+        bench.results[-1]["ensure_wav_seconds"] = round(state["decode_only"], 4)
+    bench.run("diarize", diarize, audio_seconds=args.duration)
+    bench.run("embed", embed, needs=["torch"], audio_seconds=args.duration)
+    bench.run("frames", frames, needs=["ffmpeg"], audio_seconds=args.duration)
+    if "frames" in state:
+        bench.run("face", face, audio_seconds=args.duration)
+    else:
+        bench.results.append({"stage": "face", "skipped": "needs frames"})
+    bench.run("export", export, needs=["pipeline"], audio_seconds=args.duration)
+    for stage, pipelined in (("end_to_end", False), ("pipelined", True)):
+        bench.run(
+            stage,
+            end_to_end(pipelined),
+            needs=["torch", "ffmpeg", "pipeline"],
+            audio_seconds=total_audio,
+        )
+
+    return {
+        "meta": {
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.time(),
+            "duration": args.duration,
+            "videos": args.videos,
+            "speakers": args.speakers,
+            "frames_per_turn": args.frames_per_turn,
+            "batch_size": args.batch_size,
+            "workers": args.workers,
+            "fixture_seconds": round(fixture_seconds, 3),
+        },
+        "stages": bench.results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=120, help="seconds per video")
+    parser.add_argument("--videos", type=int, default=2)
+    parser.add_argument("--speakers", type=int, default=3)
+    parser.add_argument("--frames-per-turn", type=int, default=3)
+    parser.add_argument("--min-seg-len", type=float, default=4)
+    parser.add_argument("--max-seg-len", type=float, default=8)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=2)
+    # tracemalloc slows Python code down, so timings with it are not comparable to without
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--workdir", type=str, default=None, help="kept when given")
+    parser.add_argument("--output", type=str, default=None, help="JSON file, stdout if omitted")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="voice_scrapper_bench_")
+    try:
+        results = benchmark(args, workdir)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
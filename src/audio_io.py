@@ -0,0 +1,181 @@
+##############################################################################################
+"""
+Lightweight wav I/O on NumPy arrays
+
+Reads 16-bit PCM wavs (what yt-dlp/ffmpeg produce with "-ar 16000 -ac 1") as memory-mapped arrays
+so that slicing a turn out of an hour-long file is a zero-copy view instead of a pydub byte copy.
+Other formats are converted with ffmpeg first (media_tasks.ensure_wav). Chunks are reshaped views
+of the mapped samples, and WavWriter writes them from a background thread, so peak memory depends
+on the chunks in flight and not on the length of the file.
+"""
+##############################################################################################
+
+import os
+import wave
+import queue
+import struct
+import threading
+import numpy as np
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def read_wav(path, mmap=True):
+    """Read a 16-bit PCM wav file
+
+    Args:
+        path (str): filepath of the wav
+        mmap (bool, optional): Memory-map the samples instead of reading them. Defaults to True.
+
+    Returns:
+        tuple: (samples, sample_rate), samples is int16 of shape (n,) for mono or (n, channels)
+    """
+    with open(path, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            raise ValueError(f"{path} is not a RIFF/WAVE file")
+
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(f"{path} has no data chunk")
+            chunk_id = chunk_header[:4]
+            chunk_size = struct.unpack("<I", chunk_header[4:])[0]
+            if chunk_id == b"fmt ":
+                fmt = struct.unpack("<HHIIHH", f.read(chunk_size)[:16])
+            elif chunk_id == b"data":
+                offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)  # Chunks are word aligned
+
+    if fmt is None:
+        raise ValueError(f"{path} has no fmt chunk")
+    audio_format, channels, sample_rate, _, _, bits_per_sample = fmt
+    if audio_format not in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE) or bits_per_sample != 16:
+        raise ValueError(f"{path} is not 16-bit PCM")
+
+    # Streamed wavs may carry a placeholder data size, so trust the file size instead
+    data_size = min(chunk_size, os.path.getsize(path) - offset)
+    num_frames = data_size // (2 * channels)
+    shape = (num_frames, channels) if channels > 1 else (num_frames,)
+    if mmap:
+        samples = np.memmap(path, dtype="<i2", mode="r", offset=offset, shape=shape)
+    else:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            samples = np.fromfile(f, dtype="<i2", count=num_frames * channels).reshape(shape)
+    return samples, sample_rate
+
+
+def chunks(samples, chunk_len, hop=None, min_tail=0, tail_policy="merge"):
+    """Split samples into windows of chunk_len samples starting every hop samples
+
+    Back-to-back chunks (hop == chunk_len) are a reshape of the samples, overlapping ones a
+    strided view, so no sample is copied either way. What the last full window does not reach
+    becomes a shorter tail window, unless it is shorter than min_tail.
+
+    Args:
+        samples (np.ndarray): samples of shape (n,) or (n, channels)
+        chunk_len (int): window length in samples
+        hop (int, optional): step between window starts in samples. Defaults to chunk_len.
+        min_tail (int, optional): shortest tail window kept on its own, in samples. Defaults to 0.
+        tail_policy (str, optional): What happens to a shorter tail: "merge" extends the last
+            window to the end of the samples, "drop" leaves it out. Defaults to "merge".
+
+    Returns:
+        list: (offset in samples, window view) tuples
+    """
+    if tail_policy not in ("merge", "drop"):
+        raise ValueError(f"Unknown tail policy {tail_policy}")
+    hop = hop or chunk_len
+    num_samples = len(samples)
+    count = (num_samples - chunk_len) // hop + 1 if num_samples >= chunk_len else 0
+
+    windows = []
+    if count:
+        if hop == chunk_len:
+            full = samples[: count * chunk_len].reshape(count, chunk_len, *samples.shape[1:])
+        else:
+            full = np.lib.stride_tricks.sliding_window_view(samples, chunk_len, axis=0)[::hop]
+            full = np.moveaxis(full[:count], -1, 1)  # (count, chunk_len, ...) like the reshape
+        windows = [(i * hop, window) for i, window in enumerate(full)]
+
+    covered = (count - 1) * hop + chunk_len if count else 0
+    tail_start = count * hop
+    if covered < num_samples and tail_start < num_samples:
+        if num_samples - tail_start >= min_tail:
+            windows.append((tail_start, samples[tail_start:]))
+        elif tail_policy == "merge":
+            # Short tail joins the last window, or is the only window of short samples
+            offset = windows.pop()[0] if windows else 0
+            windows.append((offset, samples[offset:]))
+    return windows
+
+
+class WavWriter:
+    def __init__(self, max_pending=8):
+        """Write wav files from a background thread
+
+        write() only queues the samples, so the caller can go on slicing (or cutting video)
+        while earlier chunks are written. Use as a context manager, leaving it waits for every
+        queued write and raises the first error.
+
+        Args:
+            max_pending (int, optional): Queued writes before write() blocks. Defaults to 8.
+        """
+        self.queue = queue.Queue(max_pending)
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                write_wav(*item)
+            except Exception as e:
+                self.errors.append(e)
+
+    def write(self, path, samples, sample_rate):
+        """Queue samples to be written to a wav file, see write_wav"""
+        self.queue.put((path, samples, sample_rate))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_wav(path, samples, sample_rate):
+    """Write int16 samples to a wav file
+
+    Args:
+        path (str): target filepath
+        samples (np.ndarray): int16 samples of shape (n,) or (n, channels)
+        sample_rate (int): sample rate in Hz
+    """
+    samples = np.asarray(samples, dtype="<i2")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1 if samples.ndim == 1 else samples.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+
+def to_float(samples):
+    """Convert int16 samples to mono float32 in [-1, 1]"""
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    return np.asarray(samples, dtype=np.float32) / 32768.0
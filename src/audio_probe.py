@@ -0,0 +1,125 @@
+##############################################################################################
+"""
+Audio-only probe run before a full video download
+
+Only the first seconds of a video's audio are fetched and scored against the enrolled POI
+references. A video in which none of its POIs is heard is never downloaded in full.
+"""
+##############################################################################################
+
+import os
+import threading
+import numpy as np
+from glob import glob
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import download_range_func
+import audio_io
+
+
+class AudioProbe:
+    def __init__(
+        self,
+        embedder,
+        ref_audio_dir,
+        tmp_folder,
+        seconds=60,
+        window=5,
+        threshold=0.5,
+        ydl_factory=YoutubeDL,
+        logger=None,
+    ):
+        """Initialize the probe
+
+        Args:
+            embedder (SpeakerEmbedder): embeds the probe windows and enrolls the POIs
+            ref_audio_dir (str): folder with one sub folder of reference wavs per POI
+            tmp_folder (str): where the probe audio is written
+            seconds (int, optional): Seconds of audio fetched from the start. Defaults to 60.
+            window (int, optional): Seconds per scored window. Defaults to 5.
+            threshold (float, optional): Min voice score of the best window. Defaults to 0.5.
+            ydl_factory (callable, optional): Builds the downloader from ydl_opts. Defaults to YoutubeDL.
+            logger (optional): yt-dlp logger
+        """
+        self.embedder = embedder
+        self.ref_audio_dir = ref_audio_dir
+        self.tmp_folder = tmp_folder
+        self.seconds = seconds
+        self.window = window
+        self.threshold = threshold
+        self.ydl_factory = ydl_factory
+        self.logger = logger
+        # Download threads share the embedder
+        self.lock = threading.Lock()
+
+    def profile(self, name):
+        """Enrolled references of a POI, None when it has no reference audio"""
+        refs = sorted(glob(os.path.join(self.ref_audio_dir, name, "*.wav")))
+        return np.asarray(self.embedder.enroll(name, refs)) if refs else None
+
+    def fetch(self, url, vid):
+        """Download the first seconds of a video's audio as 16 kHz mono wav
+
+        Returns:
+            str: filepath of the probe wav
+        """
+        ydl_opts = {
+            "format": "bestaudio/best",
+            "download_ranges": download_range_func(None, [(0, self.seconds)]),
+            "postprocessors": [{"key": "FFmpegExtractAudio", "preferredcodec": "wav"}],
+            "postprocessor_args": ["-ar", "16000", "-ac", "1"],
+            "outtmpl": f"{self.tmp_folder}/probe_{vid}.%(ext)s",
+            "logger": self.logger,
+        }
+        with self.ydl_factory(ydl_opts) as ydl:
+            ydl.download([url])
+        return os.path.join(self.tmp_folder, f"probe_{vid}.wav")
+
+    def matching_names(self, url, vid, names):
+        """POIs heard in the probe of a video
+
+        POIs without reference audio, and every POI when the probe itself fails, are kept, so
+        the probe only ever saves downloads and never loses a video it could not judge.
+
+        Args:
+            url (str): video URL
+            vid (str): video id
+            names (list): POIs the video was found for
+
+        Returns:
+            list: the names worth a full download
+        """
+        with self.lock:
+            profiles = {name: self.profile(name) for name in names}
+        if all(profile is None for profile in profiles.values()):
+            return list(names)
+
+        try:
+            probe_file = self.fetch(url, vid)
+            samples, sample_rate = audio_io.read_wav(probe_file, mmap=False)
+            os.remove(probe_file)
+        except Exception as e:
+            print(f"{url}: probe failed, downloading anyway ({e})")
+            return list(names)
+
+        if len(samples) == 0:
+            return list(names)
+        # Fixed-length windows as a reshape of the probe, a shorter probe is one window
+        window_len = int(self.window * sample_rate)
+        if len(samples) < window_len:
+            windows = [samples]
+        else:
+            n_windows = len(samples) // window_len
+            windows = list(samples[: n_windows * window_len].reshape(n_windows, window_len))
+        with self.lock:
+            embeddings = self.embedder.embed_batch(windows, sample_rate=sample_rate)
+
+        matched = []
+        for name, profile in profiles.items():
+            if profile is None:
+                matched.append(name)
+                continue
+            # Same decision as the voice stage of diarize.py, on the best window
+            scores, predictions = self.embedder.score_profile(profile, embeddings)
+            if np.any((scores >= self.threshold) & predictions):
+                matched.append(name)
+        return matched
@@ -0,0 +1,131 @@
+##############################################################################################
+"""
+Cheap pre-download checks on the search results scrapetube already returns
+
+A candidate video is scored on how well its title, channel and description match the POI name,
+and dropped when it is a live stream or a short, or (with langdetect installed) when its metadata
+is not in the wanted language. Nothing is downloaded for a rejected candidate.
+"""
+##############################################################################################
+
+import re
+import unicodedata
+
+try:
+    from langdetect import detect, DetectorFactory
+    from langdetect.lang_detect_exception import LangDetectException
+
+    DetectorFactory.seed = 0  # langdetect is random otherwise
+except ImportError:
+    detect = None
+
+# How much a full name match in each field counts, a name in the title is the strongest hint
+FIELD_WEIGHTS = {"title": 1.0, "channel": 1.0, "description": 0.75}
+
+
+def tokens(text):
+    """Lowercase ascii word tokens, accents stripped"""
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode()
+    return set(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+def runs_text(field):
+    """Plain text of a YT text field, either {"simpleText": ...} or {"runs": [{"text": ...}]}"""
+    if not field:
+        return ""
+    if "simpleText" in field:
+        return field["simpleText"]
+    return "".join(run.get("text", "") for run in field.get("runs", []))
+
+
+class CandidateFilter:
+    def __init__(self, min_score=0.5, language=None):
+        """Initialize the filter
+
+        Args:
+            min_score (float, optional): Min name match score to keep a video. Defaults to 0.5.
+            language (str, optional): ISO 639-1 code the metadata must be in, e.g. "en". Ignored
+                when langdetect is not installed. Defaults to None (any language).
+        """
+        self.min_score = min_score
+        self.language = language if detect is not None else None
+        if language and detect is None:
+            print("langdetect not installed, not filtering on language")
+
+    def fields(self, video):
+        """Title, channel and description of a search result"""
+        snippets = video.get("detailedMetadataSnippets") or [{}]
+        return {
+            "title": runs_text(video.get("title")),
+            "channel": runs_text(video.get("ownerText") or video.get("longBylineText")),
+            "description": runs_text(
+                snippets[0].get("snippetText") or video.get("descriptionSnippet")
+            ),
+        }
+
+    def is_live(self, video):
+        badges = [
+            badge.get("metadataBadgeRenderer", {}).get("label", "")
+            for badge in video.get("badges", [])
+        ]
+        styles = [
+            overlay.get("thumbnailOverlayTimeStatusRenderer", {}).get("style")
+            for overlay in video.get("thumbnailOverlays", [])
+        ]
+        return any("LIVE" in badge.upper() for badge in badges) or "LIVE" in styles
+
+    def is_short(self, video):
+        url = (
+            video.get("navigationEndpoint", {})
+            .get("commandMetadata", {})
+            .get("webCommandMetadata", {})
+            .get("url", "")
+        )
+        styles = [
+            overlay.get("thumbnailOverlayTimeStatusRenderer", {}).get("style")
+            for overlay in video.get("thumbnailOverlays", [])
+        ]
+        return url.startswith("/shorts/") or "SHORTS" in styles
+
+    def name_score(self, name, fields):
+        """Best weighted fraction of the name's words found in any one field"""
+        name_tokens = tokens(name)
+        if not name_tokens:
+            return 0.0
+        return max(
+            FIELD_WEIGHTS[field] * len(name_tokens & tokens(text)) / len(name_tokens)
+            for field, text in fields.items()
+        )
+
+    def language_of(self, fields):
+        text = f"{fields['title']} {fields['description']}".strip()
+        if not text:
+            return None
+        try:
+            return detect(text)
+        except LangDetectException:  # Raised on text without any letters
+            return None
+
+    def check(self, name, video):
+        """Score a search result for a POI
+
+        Args:
+            name (str): POI name
+            video (dict): scrapetube search result
+
+        Returns:
+            tuple: (name match score, rejection reason or None when the video is kept)
+        """
+        if self.is_live(video):
+            return 0.0, "live"
+        if self.is_short(video):
+            return 0.0, "short"
+        fields = self.fields(video)
+        score = self.name_score(name, fields)
+        if score < self.min_score:
+            return score, "name"
+        if self.language:
+            language = self.language_of(fields)
+            if language is not None and language != self.language:
+                return score, "language"
+        return score, None
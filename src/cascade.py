@@ -0,0 +1,99 @@
+##############################################################################################
+"""
+Verification cascade for diarized turns
+
+Checks run in a configurable order and each stage only sees the turns that passed the previous
+ones, so expensive checks (face) are skipped for turns a cheap check (voice) already rejected.
+"""
+##############################################################################################
+
+import os
+import threading
+import numpy as np
+from collections import Counter
+
+# Checks diarize.py has a verification stage for
+STAGES = ("voice", "face")
+
+
+def cascade_stages(value=None):
+    """Parse a comma-separated stage list such as VERIFICATION_CASCADE
+
+    Args:
+        value (str, optional): e.g. "voice, face". Defaults to VERIFICATION_CASCADE.
+
+    Returns:
+        list: stripped stage names in order
+
+    Raises:
+        ValueError: for unknown or repeated stages, so a typo fails at startup and not per job
+    """
+    if value is None:
+        value = os.getenv("VERIFICATION_CASCADE", "voice,face")
+    stages = [stage.strip() for stage in value.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise ValueError(
+            f"Unknown VERIFICATION_CASCADE stage(s) {unknown}, expected some of {list(STAGES)}"
+        )
+    if len(set(stages)) != len(stages):
+        raise ValueError(f"Repeated VERIFICATION_CASCADE stage in {stages}")
+    return stages
+
+
+class VerificationCascade:
+    def __init__(self, stages):
+        """Initialize the cascade
+
+        Args:
+            stages (list): stage names in the order they should run, e.g. ["voice", "face"]
+        """
+        self.stages = stages
+        self.counts = {}
+        self.lock = threading.Lock()  # Model workers of the executor share one cascade
+
+    def record(self, stage, evaluated, pruned):
+        """Add to the per-stage counters
+
+        Args:
+            stage (str): stage name
+            evaluated (int): turns the stage looked at
+            pruned (int): turns the stage rejected
+        """
+        with self.lock:
+            counts = self.counts.setdefault(stage, Counter())
+            counts["evaluated"] += evaluated
+            counts["pruned"] += pruned
+
+    def run(self, num_turns, checks, stages=None, keep=None):
+        """Run the stages over a set of turns, short-circuiting on rejection
+
+        Args:
+            num_turns (int): number of candidate turns
+            checks (dict): stage name -> callable taking an index array of surviving turns and
+                returning a boolean array with the verdict for each of them
+            stages (list, optional): Subset of the stages to run. Defaults to all of them.
+            keep (np.ndarray, optional): Mask of turns that survived earlier stages.
+
+        Returns:
+            np.ndarray: boolean mask of turns that passed every stage
+        """
+        keep = np.ones(num_turns, dtype=bool) if keep is None else keep.copy()
+        for stage in self.stages if stages is None else stages:
+            indices = np.flatnonzero(keep)
+            passed = np.zeros(0, dtype=bool)
+            if len(indices):
+                passed = np.asarray(checks[stage](indices), dtype=bool)
+            keep[indices[~passed]] = False
+            self.record(stage, len(indices), int((~passed).sum()))
+        return keep
+
+    def summary(self):
+        """One line per stage with how many turns it evaluated and pruned"""
+        lines = []
+        for stage, counts in self.counts.items():
+            lines.append(
+                f"{stage}: evaluated {counts['evaluated']}, pruned {counts['pruned']}, "
+                f"passed {counts['evaluated'] - counts['pruned']}"
+            )
+        return "\n".join(lines)
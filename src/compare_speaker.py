@@ -2,91 +2,280 @@
 """
 This script will compare the audio file against the folder of reference audio
 
-python src/compare_speaker.py --audio <filename.wav> --ref <folder_name>
+python src/compare_speaker.py --audio <filename.wav> --ref <folder_name> [--output timeline.csv]
 """
 ##############################################################################################
 
 import os
-import ffmpeg
 import argparse
 import datetime
-import torch
 from glob import glob
-from pyannote.audio import Pipeline
 from dotenv import load_dotenv
-from pydub import AudioSegment
-from statistics import mean
-from speechbrain.pretrained import SpeakerRecognition
+import numpy as np
+import pandas as pd
+import audio_io
+import media_tasks
+import model_server
+from pipeline_state import file_hash
+from instrumentation import Metrics, file_size, profiled, profile_path
+from result_cache import DiarizationCache
+from long_form import ChunkedDiarizer
 
 load_dotenv()
 
-def diarize(audio_file):
-    pipeline = Pipeline.from_pretrained("/models/pyannote/config.yaml")
-    pipeline.to(torch.device("cuda"))
-    # apply the pipeline to an audio file
-    diarization_res = pipeline(audio_file)
+def reference_files(ref_dir):
+    """Reference wavs of a --ref folder
+
+    Raises:
+        ValueError: when the folder has no wavs, before any model work is done
+    """
+    ref_audio_files = sorted(glob(os.path.join(ref_dir, "*.wav")))
+    if not ref_audio_files:
+        raise ValueError(f"No reference wavs in {ref_dir}")
+    return ref_audio_files
+
+def diarize(audio_file, device=None, pipeline=None, embedder=None):
+    """Diarize an audio file, reusing the turns cached by an earlier run on the same content
+
+    Recordings longer than LONG_FORM_WINDOW are diarized window by window.
+
+    Args:
+        audio_file (str): filepath of the audio
+        device (str, optional): torch device for a pipeline loaded here
+        pipeline (optional): Already loaded pyannote pipeline, loaded on a cache miss otherwise
+        embedder (SpeakerEmbedder, optional): Links speakers across windows, loaded with the
+            pipeline when long-form windows are on
+
+    Returns:
+        pyannote.core.Annotation: speaker turns
+    """
+    from pyannote.core import Annotation, Segment
+
+    cache = DiarizationCache(os.getenv("CACHE_FOLDER"))
+    content_hash = file_hash(audio_file)
+    turns = cache.load_turns(content_hash)
+    if turns is None:
+        if pipeline is None:
+            from model_loader import ModelSet
+
+            long_form = float(os.getenv("LONG_FORM_WINDOW", "0")) > 0
+            models = ModelSet(device, speaker=long_form, face=False)
+            pipeline, embedder = models.pipeline, models.spkr_embedder
+        # apply the pipeline to an audio file
+        turns = list(ChunkedDiarizer.from_env(pipeline, embedder).turns(audio_file))
+        cache.save_turns(content_hash, turns)
+
+    diarization_res = Annotation(uri=content_hash)
+    for start, end, label in turns:
+        diarization_res[Segment(start, end)] = label
     return diarization_res
 
 class CompareSpeaker():
-    def __init__(self):
-        self.model_init()
-
-    def model_init(self):
-        self.spkr_embed_model = SpeakerRecognition.from_hparams("/models/speechbrain")
-
-    def compare_speaker(self, ref, audio):
-        score, prediction = self.spkr_embed_model.verify_files(ref, audio)
-        return score.numpy()[0], prediction.numpy()[0]
-    
-    def extract_frame(self, in_filename, out_filename, start_timestamp, end_timestamp):
-        command_str = f"ffmpeg -y -i '{in_filename}' -ss {start_timestamp} -to {end_timestamp} -ac 1 -ar 16000 '{out_filename}' -hide_banner -loglevel error"
-        os.system(command=command_str)
-    
+    def __init__(self, device=None, models=None):
+        """Initialize the comparison
+
+        Args:
+            device (str, optional): torch device. Defaults to DEVICE or autodetect.
+            models (ModelSet, optional): Already loaded models, e.g. the model server's.
+        """
+        self.device = device
+        self.model_init(models)
+
+    def model_init(self, models=None):
+        if models is None:
+            from model_loader import ModelSet
+
+            models = ModelSet(self.device, face=False, diarization=False)
+        self.spkr_embed_model = models.spkr_embed_model
+        self.spkr_embedder = models.spkr_embedder
+
     def split_hms_secs(self, timestamp):
         pt = datetime.datetime.strptime(timestamp,'%H:%M:%S.%f')
         return (pt.second + pt.minute*60 + pt.hour*3600)
 
-    def iterate_timestamps(self, ref_audio_files, audio_file, diarization_res, resolution=5, method="max"):
-        sound = AudioSegment.from_file(
-            audio_file,
-            format="wav",
+    def frame_windows(self, samples, sample_rate, start, end, resolution, hop, min_window):
+        """Cut a turn into fixed-length windows without copying any samples
+
+        Args:
+            samples (np.ndarray): memory-mapped samples of the whole file
+            sample_rate (int): sample rate
+            start (float): turn start in seconds
+            end (float): turn end in seconds
+            resolution (float): window length in seconds
+            hop (float): step between window starts in seconds
+            min_window (float): shortest tail window worth scoring, in seconds
+
+        Returns:
+            list: (window start, window end, samples view) tuples
+        """
+        segment = samples[int(start * sample_rate) : int(end * sample_rate)]
+        # Strided views over the turn, a tail shorter than min_window is not scored
+        windows = audio_io.chunks(
+            segment,
+            int(resolution * sample_rate),
+            hop=int(hop * sample_rate),
+            min_tail=int(min_window * sample_rate),
+            tail_policy="drop",
+        )
+        return [
+            (start + offset / sample_rate, start + (offset + len(window)) / sample_rate, window)
+            for offset, window in windows
+        ]
+
+    def aggregate(self, scores, method="max", top_k=3):
+        """Collapse a (windows x references) score matrix to one score per window
+
+        Args:
+            scores (np.ndarray): cosine scores of shape (windows, references)
+            method (str, optional): "max", "mean" or "topk" (mean of the top_k). Defaults to "max".
+            top_k (int, optional): references averaged by "topk". Defaults to 3.
+        """
+        if method == "max":
+            return scores.max(axis=1)
+        if method == "mean":
+            return scores.mean(axis=1)
+        if method == "topk":
+            k = min(top_k, scores.shape[1])
+            return np.sort(scores, axis=1)[:, -k:].mean(axis=1)
+        raise ValueError(f"Unknown aggregation method {method}")
+
+    def iterate_timestamps(
+        self,
+        ref_audio_files,
+        audio_file,
+        diarization_res,
+        resolution=5,
+        method="max",
+        hop=None,
+        top_k=3,
+        min_window=1.0,
+        batch_size=16,
+    ):
+        """Score every window of every turn against all reference audios
+
+        The audio is decoded once, windows are strided views embedded in batches, and scores come
+        from a single (windows x references) cosine matrix, or from the enrolled centroid alone
+        with method="centroid".
+
+        Returns:
+            pd.DataFrame: timeline with one row per window
+        """
+        wav_file = media_tasks.ensure_wav(audio_file, os.getenv("TMP_FOLDER"))
+        samples, sample_rate = audio_io.read_wav(wav_file)
+
+        windows, speakers = [], []
+        for turn, _, speaker in diarization_res.itertracks(yield_label=True):
+            turn_windows = self.frame_windows(
+                samples,
+                sample_rate,
+                turn.start,
+                turn.end,
+                resolution,
+                hop or resolution,
+                min_window,
+            )
+            windows.extend(turn_windows)
+            speakers.extend([speaker] * len(turn_windows))
+
+        # Enrolled once per reference folder: centroid in row 0, one row per reference clip
+        ref_audio_files = sorted(ref_audio_files)
+        if not ref_audio_files:
+            raise ValueError("No reference wavs to compare against")
+        profile = np.asarray(
+            self.spkr_embedder.enroll(
+                os.path.basename(os.path.dirname(os.path.abspath(ref_audio_files[0]))),
+                ref_audio_files,
+            )
+        )
+        embeddings = self.spkr_embedder.embed_batch(
+            [window for _, _, window in windows], sample_rate=sample_rate, batch_size=batch_size
+        )
+        scores = np.zeros((0, len(ref_audio_files)))
+        if windows:
+            scores = embeddings @ profile[1:].T
+        if method == "centroid":
+            # One dot product per window however many references there are
+            final_scores = embeddings @ profile[0] if windows else np.zeros(0)
+        else:
+            final_scores = self.aggregate(scores, method=method, top_k=top_k)
+
+        if wav_file != audio_file:
+            os.remove(wav_file)
+        return pd.DataFrame(
+            {
+                "start": [start for start, _, _ in windows],
+                "end": [end for _, end, _ in windows],
+                "speaker": speakers,
+                "score": final_scores,
+                "best_ref": [
+                    os.path.basename(ref_audio_files[i]) for i in scores.argmax(axis=1)
+                ],
+            }
         )
 
-        for turn, _, _ in diarization_res.itertracks(yield_label=True):
-            # segment = sound[turn.start * 1000 : turn.end * 1000]
-            start_time = turn.start
-            end_time = turn.end
-            # Slice into segments of length == resolution
-            for r in range(int(start_time), int(end_time), resolution):
-                if r+resolution > end_time:
-                    segment_end = end_time
-                else:
-                    segment_end = r + resolution    
-
-                self.extract_frame(audio_file, f"/app/data/tmp/tmp.wav", r, segment_end)
-                # Compare against all reference speeches
-                score_overall = []
-                for ref_audio_file in ref_audio_files:
-                    score, _ = cp_spkr.compare_speaker(ref_audio_file, f"/app/data/tmp/tmp.wav")
-                    score_overall.append(score)
-
-                final_score = 0
-                if method == "max":
-                    final_score = max(score_overall)
-                elif method == "mean":
-                    final_score = mean(score_overall)
-
-                print(f"{str(datetime.timedelta(seconds=r))} - {str(datetime.timedelta(seconds=segment_end))}, Score: {final_score}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--audio", type=str, required=True)
     parser.add_argument("--ref", type=str, required=True)
+    parser.add_argument("--device", type=str, default=os.getenv("DEVICE"))
+    parser.add_argument("--resolution", type=float, default=5)
+    parser.add_argument("--hop", type=float, default=None)  # Defaults to the resolution
+    parser.add_argument("--method", type=str, default="mean", choices=["max", "mean", "topk", "centroid"])
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument(
+        "--batch-size", type=int, default=int(os.getenv("EMBED_BATCH_SIZE", "16"))
+    )
+    # Timeline file, .json or .csv, printed when omitted
+    parser.add_argument("--output", type=str, default=None)
+    # Write cProfile stats of the run to <METRICS_FOLDER>/compare_speaker.prof
+    parser.add_argument("--profile", action="store_true")
     args = parser.parse_args()
 
-    diarization_res = diarize(args.audio)
-    
-    cp_spkr = CompareSpeaker()
-    ref_audio_files = glob(f"{args.ref}/*.wav")
+    metrics = Metrics("compare_speaker", folder=os.getenv("METRICS_FOLDER"))
+    with profiled(profile_path("compare_speaker", args.profile)):
+        try:
+            with metrics.timer("model_server", file=args.audio):
+                result = model_server.request(
+                    "compare",
+                    {
+                        "audio": os.path.abspath(args.audio),
+                        "ref": os.path.abspath(args.ref),
+                        "resolution": args.resolution,
+                        "method": args.method,
+                        "hop": args.hop,
+                        "top_k": args.top_k,
+                        "batch_size": args.batch_size,
+                    },
+                )
+            if result is not None:
+                timeline = pd.DataFrame(result["timeline"])
+            else:
+                # No model server, load the models in this process
+                ref_audio_files = reference_files(args.ref)
+                with metrics.timer("pyannote", file=args.audio):
+                    diarization_res = diarize(args.audio, device=args.device)
+
+                cp_spkr = CompareSpeaker(device=args.device)
 
-    cp_spkr.iterate_timestamps(ref_audio_files, args.audio, diarization_res, resolution=5, method="mean")
\ No newline at end of file
+                with metrics.timer("compare", file=args.audio):
+                    timeline = cp_spkr.iterate_timestamps(
+                        ref_audio_files,
+                        args.audio,
+                        diarization_res,
+                        resolution=args.resolution,
+                        method=args.method,
+                        hop=args.hop,
+                        top_k=args.top_k,
+                        batch_size=args.batch_size,
+                    )
+            metrics.count("windows", len(timeline), file=args.audio)
+            metrics.count("bytes_read", file_size(args.audio), file=args.audio)
+            if args.output is None:
+                print(timeline.to_string(index=False))
+            elif args.output.endswith(".json"):
+                timeline.to_json(args.output, orient="records", indent=2)
+            else:
+                timeline.to_csv(args.output, index=False)
+        finally:
+            metrics.close()
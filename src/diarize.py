@@ -8,182 +8,914 @@ python src/diarize.py --file poi_list.csv
 
 import os
 import re
-import ast
-import time
-import torch
 import argparse
-import pydub
-import shutil
-import ffmpeg
+import copy
+import json
+import hashlib
+import threading
 import datetime
+import numpy as np
 from tqdm import tqdm
 import pandas as pd
 from glob import glob
-from speechbrain.pretrained import SpeakerRecognition
-from pyannote.audio import Pipeline, Audio
-from pyannote.core import Segment
-from pyannote.audio.pipelines.speaker_verification import PretrainedSpeakerEmbedding
 from dotenv import load_dotenv
-from pydub import AudioSegment
-from pydub.utils import make_chunks
-from deepface import DeepFace
+import audio_io
+import media_tasks
+import model_server
+from cascade import VerificationCascade, cascade_stages
+from executor import PipelinedExecutor, Stage
+from pipeline_state import PipelineState, file_hash
+from result_cache import DiarizationCache
+from frame_extractor import FrameExtractor
+from instrumentation import Metrics, file_size, profiled, profile_path
+from long_form import ChunkedDiarizer
+from segment_index import SegmentIndex, fingerprint
 
 
 load_dotenv()
 
+BASE_YOUTUBE_URL = "https://www.youtube.com/watch?v="
+
 
 class Diarization:
-    def __init__(self, poi_filename):
+    def __init__(
+        self,
+        poi_filename,
+        batch_size=16,
+        device=None,
+        state=None,
+        load_models=True,
+        range_downloader=None,
+        models=None,
+        metrics=None,
+    ):
+        """Initialize the diarization
+
+        Args:
+            poi_filename (str): filepath of poi csv
+            batch_size (int, optional): Segments per embedding pass. Defaults to 16.
+            device (str, optional): torch device. Defaults to DEVICE or autodetect.
+            state (PipelineState, optional): Skips wavs that were already diarized.
+            load_models (bool, optional): False for re-scoring from the cache. Defaults to True.
+            range_downloader (VideoRangeDownloader, optional): Fetches the needed video ranges
+                of any wav whose mp4 is missing. Defaults to one when yt-dlp is installed.
+            models (ModelSet, optional): Already loaded models, e.g. the model server's.
+            metrics (Metrics, optional): Receives stage timings and per-file outcomes.
+        """
         self.poi_filename = poi_filename
+        self.batch_size = batch_size
+        self.state = state
+        # Resolved by ModelSet when models are loaded, re-scoring never imports torch
+        self.device = device
         self.spkr_embed_model = None
+        self.spkr_embedder = None
+        self.face_verifier = None
         self.audio_reader = None
         self.pipeline = None
+        self.long_form = None
+        self.model_workers = []
+        self.metrics = metrics or Metrics("diarize")
         self.export_video = os.getenv("EXPORT_VIDEO_FLAG")
         self.diarization_folder = os.path.join(
             os.getenv("DATA_FOLDER"), os.getenv("DIARIZATION_FOLDER")
         )
         self.min_seg_len = float(os.getenv("MIN_SEGMENT_LEN"))
+        self.frame_extractor = FrameExtractor(
+            frames_per_turn=int(os.getenv("FRAMES_PER_TURN", "1")),
+            max_height=int(os.getenv("FRAME_MAX_HEIGHT", "720")),
+        )
+        # Fraction of a turn's sampled frames that must match the reference face
+        self.face_vote_ratio = float(os.getenv("FACE_VOTE_RATIO", "0.5"))
         self.max_seg_len = float(os.getenv("MAX_SEGMENT_LEN"))
-
-        self.model_init()
+        self.voice_threshold = float(os.getenv("VOICE_THRESHOLD"))
+        self.face_threshold = float(os.getenv("FACE_THRESHOLD", "0.40"))
+        # centroid, topk or snorm, see SpeakerEmbedder.score_profile
+        self.speaker_scoring = os.getenv("SPEAKER_SCORING", "centroid")
+        self.speaker_top_k = int(os.getenv("SPEAKER_TOP_K", "3"))
+        self.cohort = None
+        self.cohort_refs = None
+        # "turn" verifies every turn on its own, "cluster" once per pyannote speaker label
+        self.verification_mode = os.getenv("VERIFICATION_MODE", "turn")
+        # Longest turns of a cluster that are embedded and face-checked for the whole cluster
+        self.cluster_representatives = int(os.getenv("CLUSTER_REPRESENTATIVES", "3"))
+        # Accepted turns are indexed per POI, near duplicates of indexed segments are dropped
+        self.segment_index_flag = os.getenv("SEGMENT_INDEX", "true") == "true"
+        self.dedup_threshold = float(os.getenv("DEDUP_THRESHOLD", "0.95"))
+        self.fingerprint_threshold = float(os.getenv("FINGERPRINT_THRESHOLD", "0.65"))
+        self.segment_indexes = {}
+        self.segment_indexes_lock = threading.Lock()
+        # Per-POI references, shared by all jobs of a POI and by the threads building them
+        self.reference_cache = {}
+        self.references_lock = threading.Lock()
+        self.result_cache = DiarizationCache(os.getenv("CACHE_FOLDER"))
+        # One lock per recording, so model workers never diarize the same shared video twice
+        self.hash_locks = {}
+        self.hash_locks_guard = threading.Lock()
+        # Cheap checks first, a turn rejected by one stage never reaches the next
+        self.cascade = VerificationCascade(cascade_stages())
+
+        if load_models:  # Re-scoring from the result cache needs no model at all
+            self.model_init(models)
         self.read_poi_file()
 
         self.video_folder = os.path.join(
             os.getenv("DATA_FOLDER"), os.getenv("VIDEO_FOLDER")
         )
+        # Everything the process-pool tasks in media_tasks need, they never see this object
+        if range_downloader is None:
+            try:
+                from video_ranges import VideoRangeDownloader
+
+                range_downloader = VideoRangeDownloader()
+            except ImportError:  # A wav without its mp4 then fails instead of skipping the video
+                pass
+        self.settings = {
+            "tmp_folder": os.getenv("TMP_FOLDER"),
+            "range_downloader": range_downloader,
+            "diarization_folder": self.diarization_folder,
+            "min_seg_len": self.min_seg_len,
+            "max_seg_len": self.max_seg_len,
+            # A last chunk shorter than this (seconds) is merged into the one before or dropped
+            "chunk_min_tail": float(os.getenv("CHUNK_MIN_TAIL", "0")),
+            "chunk_tail_policy": os.getenv("CHUNK_TAIL_POLICY", "merge"),
+            "export_video": self.export_video,
+            # Keyframe-aligned stream copy instead of re-encoding exported video
+            "stream_copy": os.getenv("EXPORT_STREAM_COPY") == "true",
+            "frames_per_turn": self.frame_extractor.frames_per_turn,
+            "frame_max_height": self.frame_extractor.max_height,
+        }
+        # Settings that change which segments get accepted, a wav is redone when they change
+        self.params = {
+            "min_seg_len": self.min_seg_len,
+            "max_seg_len": self.max_seg_len,
+            "chunk_min_tail": self.settings["chunk_min_tail"],
+            "chunk_tail_policy": self.settings["chunk_tail_policy"],
+            "voice_threshold": self.voice_threshold,
+            "speaker_scoring": self.speaker_scoring,
+            "speaker_top_k": self.speaker_top_k,
+            "face_threshold": self.face_threshold,
+            "face_vote_ratio": self.face_vote_ratio,
+            "frames_per_turn": self.frame_extractor.frames_per_turn,
+            "cascade": self.cascade.stages,
+            "verification_mode": self.verification_mode,
+            "cluster_representatives": self.cluster_representatives,
+            "segment_index": self.segment_index_flag,
+            "dedup_threshold": self.dedup_threshold,
+            "fingerprint_threshold": self.fingerprint_threshold,
+            "export_video": self.export_video,
+            "stream_copy": self.settings["stream_copy"],
+        }
+
+    def model_init(self, models=None):
+        """Use the given models, or load them (DeepFace only when the cascade has a face stage)"""
+        if models is None:
+            from model_loader import ModelSet
+
+            models = ModelSet(
+                self.device,
+                batch_size=self.batch_size,
+                face_threshold=self.face_threshold,
+                face="face" in self.cascade.stages,
+            )
+        self.device = getattr(models, "device", self.device)
+        self.spkr_embed_model = models.spkr_embed_model
+        self.spkr_embedder = models.spkr_embedder
+        self.face_verifier = models.face_verifier
+        self.pipeline = models.pipeline
+        # Recordings longer than LONG_FORM_WINDOW are diarized window by window
+        self.long_form = ChunkedDiarizer.from_env(
+            self.pipeline, self.spkr_embedder, batch_size=self.batch_size
+        )
 
-    def model_init(self):
-        self.spkr_embed_model = SpeakerRecognition.from_hparams("/models/speechbrain")
-        self.pipeline = Pipeline.from_pretrained("/models/pyannote/config.yaml")
-        self.pipeline.to(torch.device("cuda"))
+    def model_worker(self, index):
+        """Model holder for executor worker `index`, the first one reuses this object's models
+
+        Both model stages of the executor share the same holders, so models are loaded once per
+        worker and not once per worker per stage.
+        """
+        while len(self.model_workers) <= index:
+            if not self.model_workers:
+                self.model_workers.append(self)
+            else:
+                worker = copy.copy(self)
+                worker.model_init()
+                self.model_workers.append(worker)
+        return self.model_workers[index]
 
     def read_poi_file(self):
         """Read in the CSV file"""
         self.df = pd.read_csv(self.poi_filename)
 
-    def compare_speaker(self, ref, audio):
-        score, prediction = self.spkr_embed_model.verify_files(ref, audio)
-        return score.numpy()[0], prediction.numpy()[0]
+    def face_distances(self, ref_face_embedding, frames, owners, slots, num_turns):
+        """Distance of the closest face to the reference for every sampled frame of every turn
 
-    def verify_face(
-        self,
-        img1_path,
-        img2_path,
-        model_name: str,
-        distance_metric: str,
-        detector_backend: str,
-    ):
-        result = DeepFace.verify(
-            img1_path=img1_path,
-            img2_path=img2_path,
-            model_name=model_name,
-            distance_metric=distance_metric,
-            detector_backend=detector_backend,
+        Args:
+            ref_face_embedding (np.ndarray): cached reference face embedding
+            frames (iterable): (index into owners, frame) as produced by media_tasks.load_frames
+            owners (list): turn index of each requested timestamp
+            slots (list): position of each requested timestamp within its turn
+            num_turns (int): number of turns being checked
+
+        Returns:
+            np.ndarray: (num_turns, frames_per_turn) distances, np.inf where no face was found
+        """
+        distances = np.full((num_turns, self.frame_extractor.frames_per_turn), np.inf)
+        batch, batch_idx = [], []
+
+        def flush():
+            distances[[owners[i] for i in batch_idx], [slots[i] for i in batch_idx]] = (
+                self.face_verifier.distances(ref_face_embedding, batch)
+            )
+
+        for idx, frame in frames:
+            batch.append(frame)
+            batch_idx.append(idx)
+            if len(batch) == self.face_verifier.batch_size:
+                flush()
+                batch, batch_idx = [], []
+        if batch:
+            flush()
+        return distances
+
+    def face_votes_pass(self, distances):
+        """Whether enough sampled frames of each turn match the reference face"""
+        votes = (distances <= self.face_threshold).sum(axis=-1)
+        return votes >= self.face_vote_ratio * distances.shape[-1]
+
+    def references(self, name):
+        """Reference embeddings of a POI and the params its jobs are keyed on, built once per run
+
+        Args:
+            name (str): Name of each POI
+
+        Returns:
+            dict: ref_embedding, cohort, ref_face_embedding, params and reference_key
+        """
+        with self.references_lock:
+            if name in self.reference_cache:
+                return self.reference_cache[name]
+
+            ref_path = os.path.join(
+                os.getenv("REF_AUDIO_DIR"),
+                f"{name}/*.wav",
+            )
+            refs = sorted(glob(ref_path))
+            if not refs:
+                raise ValueError(f"No reference audio for {name} in {ref_path}")
+            ref_image_format = os.getenv("DEFAULT_REF_IMAGE_FORMAT")
+            ref_face = os.path.join(
+                os.getenv("REF_IMAGES_DIR"),
+                f"{name}.{ref_image_format}",
+            )
+
+            ref_embedding, ref_face_embedding, cohort = None, None, None
+            if self.spkr_embedder is not None:
+                # Centroid plus per-clip embeddings of every reference clip of the POI
+                ref_embedding = np.asarray(self.spkr_embedder.enroll(name, refs))
+                # Building the cohort enrolls every POI, only snorm needs it
+                if self.speaker_scoring == "snorm":
+                    others = [c for poi, c in self.cohort_centroids().items() if poi != name]
+                    if len(others) < 2:
+                        raise ValueError(
+                            f"SPEAKER_SCORING=snorm needs reference audio of at least 2 other POIs "
+                            f"than {name}, found {len(others)}"
+                        )
+                    cohort = np.stack(others)
+                try:
+                    if self.face_verifier is not None:
+                        ref_face_embedding = np.asarray(
+                            self.face_verifier.embed_reference(ref_face)
+                        )
+                except (ValueError, OSError) as e:
+                    print(e)
+                    self.metrics.error("ref_face", e, poi=name, file=ref_face)
+                    ref_face_embedding = None  # Every face check fails, as DeepFace.verify would
+
+            params = dict(self.params, ref=[file_hash(ref) for ref in refs])
+            if os.path.exists(ref_face):
+                params["ref_face"] = file_hash(ref_face)
+            # Scores depend on the references and on how they are compared
+            reference_key = (
+                f"{name}:{params['ref']}:{params.get('ref_face')}:"
+                f"{self.speaker_scoring}:{self.speaker_top_k}"
+            )
+            if self.speaker_scoring == "snorm":  # and on every other POI's references
+                params["cohort"] = self.cohort_key(name)
+                reference_key += f":{params['cohort']}"
+            self.reference_cache[name] = {
+                "ref_embedding": ref_embedding,
+                "cohort": cohort,
+                "ref_face_embedding": ref_face_embedding,
+                "params": params,
+                "reference_key": reference_key,
+            }
+            return self.reference_cache[name]
+
+    def make_job(self, name, file, force=False):
+        """Build the diarize job of one downloaded wav of a POI
+
+        Args:
+            name (str): Name of each POI
+            file (str): filepath of the wav
+            force (bool, optional): Build it even when the state has it as done. Defaults to False.
+
+        Returns:
+            dict: job dict for the executor, None when the wav needs no work
+        """
+        references = self.references(name)
+        content_hash = None
+        if self.state:
+            needed, content_hash = self.state.diarize_needed(file, references["params"])
+            if not needed and not force:
+                return None
+            # Segments of an older run of this wav would otherwise linger next to the new ones
+            for path in self.state.previous_segments(file):
+                if os.path.exists(path):
+                    os.remove(path)
+        wav_name_no_ext = os.path.basename(file).split(".")[0]
+        return dict(
+            references,
+            name=name,
+            wav_file=file,
+            wav_name_no_ext=wav_name_no_ext,
+            video_file=os.path.join(self.video_folder, f"{name}/{wav_name_no_ext}.mp4"),
+            # Wavs are named after their video id, for fetching video ranges
+            video_url=BASE_YOUTUBE_URL + wav_name_no_ext,
+            settings=self.settings,
+            hash=content_hash,
         )
-        return result["verified"]
 
-    def extract_frame(self, in_filename, out_filename, timestamp):
-        stream = ffmpeg.input(in_filename, ss=timestamp)
-        stream = stream.output(out_filename, frames=1)
-        stream.compile()
-        stream.run(overwrite_output=True, quiet=True)
+    def make_jobs(self, name, force=False):
+        """Build one diarize job per downloaded wav of a POI
 
-    def extract_video_segment(self, in_filename, out_filename, start_timestamp, end_timestamp):
-        stream = ffmpeg.input(in_filename, ss=start_timestamp, to=end_timestamp)
-        stream = stream.output(out_filename)
-        stream.compile()
-        stream.run(overwrite_output=True, quiet=True)
+        Args:
+            name (str): Name of each POI
+            force (bool, optional): Include wavs the state has as done. Defaults to False.
 
-    def diarize(self, name):
+        Returns:
+            list: job dicts for the executor, empty when the POI's references cannot be built
+        """
+        try:
+            self.references(name)
+        except (ValueError, OSError) as e:
+            # e.g. no or unreadable reference audio, the other POIs still run
+            print(f"Skipping {name}: {e}")
+            self.metrics.error("references", e, poi=name)
+            return []
         video_path = os.path.join(os.getenv("DATA_FOLDER"), os.getenv("VIDEO_FOLDER"))
         poi_video_path = f"{os.path.join(video_path, name)}/*.wav"
-        wav_files = glob(poi_video_path)
+        jobs = []
+        for file in glob(poi_video_path):
+            try:
+                job = self.make_job(name, file, force=force)
+            except OSError as e:  # Unreadable wav, file_hash fails
+                print(f"Skipping {file}: {e}")
+                self.metrics.error("make_job", e, poi=name, file=file)
+                continue
+            if job is not None:
+                jobs.append(job)
+        return jobs
+
+    def cohort_centroids(self):
+        """Centroids of every POI with reference audio, the impostor cohort for s-norm"""
+        if self.cohort is None:
+            self.cohort = {}
+            for ref_dir in glob(os.path.join(os.getenv("REF_AUDIO_DIR"), "*/")):
+                refs = sorted(glob(os.path.join(ref_dir, "*.wav")))
+                if refs:
+                    poi = os.path.basename(os.path.normpath(ref_dir))
+                    self.cohort[poi] = np.asarray(self.spkr_embedder.enroll(poi, refs))[0]
+        return self.cohort
+
+    def cohort_key(self, name):
+        """Hash of the reference files of every POI in the s-norm cohort of `name`
+
+        Computed from the files alone, so re-scoring without models gets the same key.
+        """
+        if self.cohort_refs is None:
+            self.cohort_refs = {}
+            for ref_dir in glob(os.path.join(os.getenv("REF_AUDIO_DIR"), "*/")):
+                refs = sorted(glob(os.path.join(ref_dir, "*.wav")))
+                if refs:
+                    poi = os.path.basename(os.path.normpath(ref_dir))
+                    self.cohort_refs[poi] = [file_hash(ref) for ref in refs]
+        others = sorted((poi, refs) for poi, refs in self.cohort_refs.items() if poi != name)
+        return hashlib.sha1(json.dumps(others).encode("utf-8")).hexdigest()[:16]
+
+    def segment_index(self, name):
+        """Segment index of a POI, loaded once per run"""
+        with self.segment_indexes_lock:
+            if name not in self.segment_indexes:
+                self.segment_indexes[name] = SegmentIndex(
+                    os.path.join(os.getenv("CACHE_FOLDER"), "segment_index", name)
+                )
+            return self.segment_indexes[name]
+
+    def deduplicate(self, job):
+        """Add the accepted turns of a job to the POI's index, rejecting near duplicates
+
+        Turns keep the embedding the voice stage computed for them, only turns it did not embed
+        (cluster mode, no voice stage) are embedded here. Without models (--rescore) those are
+        left unembedded and matched on fingerprint and duration alone.
+        """
+        job["index_ids"] = {}
+        index = self.segment_index(job["name"])
+        # Turns of an earlier run of this wav would otherwise be found as duplicates of themselves
+        index.remove_source(job["wav_file"])
+        accepted = np.flatnonzero(job["accepted"])
+        if not len(accepted):
+            return job
+        samples, sample_rate = audio_io.read_wav(job["audio_file"])
+        turns = [job["turns"][i] for i in accepted]
+        segments = [
+            samples[int(start * sample_rate) : int(end * sample_rate)] for start, end, _ in turns
+        ]
+        known = job.setdefault("turn_embeddings", {})
+        missing = [k for k, i in enumerate(accepted) if i not in known]
+        if missing and self.spkr_embedder is not None:
+            with self.metrics.timer("speaker_embedding", file=job["wav_file"], turns=len(missing)):
+                embeddings = self.spkr_embedder.embed_batch(
+                    [segments[k] for k in missing],
+                    sample_rate=sample_rate,
+                    batch_size=self.batch_size,
+                )
+            # Stored with the scores, so re-scoring can check these turns too
+            known.update((int(accepted[k]), e) for k, e in zip(missing, embeddings))
+        dim = len(next(iter(known.values()))) if known else 0
+        embeddings = np.stack([known.get(i, np.zeros(dim, dtype=np.float32)) for i in accepted])
+        fingerprints = [fingerprint(segment, sample_rate) for segment in segments]
+        ids, duplicate_of = index.add(
+            embeddings,
+            fingerprints,
+            [{"source": job["wav_file"], "start": start, "end": end} for start, end, _ in turns],
+            threshold=self.dedup_threshold,
+            fingerprint_threshold=self.fingerprint_threshold,
+        )
+        duplicates = accepted[np.array(duplicate_of) >= 0]
+        job["accepted"][duplicates] = False
+        self.cascade.record("duplicate", len(accepted), len(duplicates))
+        job["index_ids"] = {int(i): id_ for i, id_ in zip(accepted, ids) if id_ >= 0}
+        return job
+
+    def index_exports(self, job):
+        """Attach the exported wavs of a job to its indexed turns and save the POI's index"""
+        if "index_ids" not in job:  # Indexing is off
+            return
+        index = self.segment_index(job["name"])
+        for path, start, _ in job["exported"]:
+            if not path.endswith(".wav"):
+                continue
+            for i, id_ in job["index_ids"].items():
+                turn_start, turn_end, _ = job["turns"][i]
+                if turn_start <= start < turn_end:  # Chunks start inside their turn
+                    index.attach(id_, path)
+                    break
+        index.save()
+
+    def mark_done(self, job):
+        """Record a finished job in the metrics, and in the state so it is skipped next time"""
+        self.record_job(job)
+        self.index_exports(job)
+        if self.state:
+            self.state.mark_diarized(
+                job["wav_file"], job["name"], job["hash"], job["params"], job["exported"]
+            )
 
-        ref_path = os.path.join(
-            os.getenv("REF_AUDIO_DIR"),
-            f"{name}/*.wav",
+    def record_job(self, job):
+        """Count the turns and bytes of a finished job, per POI, and trace them per file"""
+        accepted = int(np.sum(job["accepted"]))
+        rejected = len(job["turns"]) - accepted
+        bytes_read = file_size(job["wav_file"])
+        bytes_written = sum(file_size(path) for path, _, _ in job["exported"])
+        labels = {"poi": job["name"]}
+        self.metrics.add("files", 1, dict(labels, outcome="done"))
+        self.metrics.add("turns", accepted, dict(labels, outcome="accepted"))
+        self.metrics.add("turns", rejected, dict(labels, outcome="rejected"))
+        self.metrics.add("bytes_read", bytes_read, labels)
+        self.metrics.add("bytes_written", bytes_written, labels)
+        self.metrics.event(
+            "file",
+            poi=job["name"],
+            file=job["wav_file"],
+            accepted=accepted,
+            rejected=rejected,
+            bytes_read=bytes_read,
+            bytes_written=bytes_written,
         )
-        ref = glob(ref_path)[0]
-        ref_image_format = os.getenv("DEFAULT_REF_IMAGE_FORMAT")
-        ref_face = os.path.join(
-            os.getenv("REF_IMAGES_DIR"),
-            f"{name}.{ref_image_format}",
+
+    def record_error(self, stage, job, error):
+        """Count a job the executor dropped after a failing stage"""
+        # The executor's timer already counted the error of the stage
+        self.metrics.add("files", 1, {"poi": job["name"], "outcome": "error"})
+        self.metrics.event(
+            "file", poi=job["name"], file=job["wav_file"], stage=stage, error=str(error)
         )
 
-        tmpfolder = os.getenv("TMP_FOLDER")
-        for file in tqdm(wav_files):
-            diarization = self.pipeline(file)
+    def cascade_checks(self, job):
+        """Verification stages for the turns of a job, each fills in its scores on the job"""
+        turns = job["turns"]
+
+        def voice_check(indices):
+            # Speaker Verification, memory-mapped so each turn is a view into the file
+            samples, sample_rate = audio_io.read_wav(job["audio_file"])
+            segments = [
+                samples[int(turns[i][0] * sample_rate) : int(turns[i][1] * sample_rate)]
+                for i in indices
+            ]
+            with self.metrics.timer("speaker_embedding", file=job["wav_file"], turns=len(indices)):
+                embeddings = self.spkr_embedder.embed_batch(
+                    segments, sample_rate=sample_rate, batch_size=self.batch_size
+                )
+            # Kept for the segment index, so accepted turns are not embedded twice
+            job.setdefault("turn_embeddings", {}).update(zip(indices.tolist(), embeddings))
+            scores, voice_predictions = self.spkr_embedder.score_profile(
+                job["ref_embedding"],
+                embeddings,
+                method=self.speaker_scoring,
+                top_k=self.speaker_top_k,
+                cohort=job["cohort"],
+            )
+            job["scores"][indices] = scores
+            job["voice_predictions"][indices] = voice_predictions
+            return (scores >= self.voice_threshold) & voice_predictions
+
+        def face_check(indices):
+            # Face Verification on the frames decoded for these turns by extract_frames
+            if job["ref_face_embedding"] is None:
+                return np.zeros(len(indices), dtype=bool)
+            with self.metrics.timer("face_verification", file=job["wav_file"], turns=len(indices)):
+                distances = self.face_distances(
+                    job["ref_face_embedding"],
+                    media_tasks.load_frames(job),
+                    job["owners"],
+                    job["slots"],
+                    len(turns),
+                )
+            job["face_distances"][indices] = distances[indices]
+            job["face_predictions"][indices] = self.face_votes_pass(distances[indices])
+            return job["face_predictions"][indices]
+
+        return {"voice": voice_check, "face": face_check}
+
+    def clusters(self, turns):
+        """Turn indices of every pyannote speaker label, longest turns first
+
+        Args:
+            turns (list): (start, end, speaker) turns
 
-            sound = AudioSegment.from_file(
-                file,
-                format="wav",
+        Returns:
+            list: one list of turn indices per speaker label
+        """
+        clusters = {}
+        for i, (_, _, speaker) in enumerate(turns):
+            clusters.setdefault(speaker, []).append(i)
+        return [
+            sorted(members, key=lambda i: turns[i][0] - turns[i][1])
+            for members in clusters.values()
+        ]
+
+    def cluster_face_pass(self, distances):
+        """Whether enough of the frames sampled across a cluster's turns match the reference face"""
+        return distances.size > 0 and (
+            (distances <= self.face_threshold).sum() >= self.face_vote_ratio * distances.size
+        )
+
+    def cluster_checks(self, job):
+        """Verification stages over the speaker clusters of a job, instead of its single turns
+
+        Each cluster is checked on its longest turns only: the voice stage scores the mean
+        embedding of those turns once, the face stage votes over all of their frames. The
+        verdict and scores are copied to every turn of the cluster.
+        """
+        turns = job["turns"]
+        clusters, representatives = job["clusters"], job["representatives"]
+
+        def voice_check(indices):
+            samples, sample_rate = audio_io.read_wav(job["audio_file"])
+            members = [i for c in indices for i in representatives[c]]
+            segments = [
+                samples[int(turns[i][0] * sample_rate) : int(turns[i][1] * sample_rate)]
+                for i in members
+            ]
+            with self.metrics.timer("speaker_embedding", file=job["wav_file"], turns=len(members)):
+                embeddings = self.spkr_embedder.embed_batch(
+                    segments, sample_rate=sample_rate, batch_size=self.batch_size
+                )
+            job.setdefault("turn_embeddings", {}).update(zip(members, embeddings))
+            # One embedding per cluster, the normalized mean of its representatives
+            sizes = [len(representatives[c]) for c in indices]
+            owners = np.repeat(np.arange(len(indices)), sizes)
+            sums = np.zeros((len(indices), embeddings.shape[1]))
+            np.add.at(sums, owners, embeddings)
+            scores, voice_predictions = self.spkr_embedder.score_profile(
+                job["ref_embedding"],
+                self.spkr_embedder.normalize(sums),
+                method=self.speaker_scoring,
+                top_k=self.speaker_top_k,
+                cohort=job["cohort"],
             )
+            for c, score, prediction in zip(indices, scores, voice_predictions):
+                job["scores"][clusters[c]] = score
+                job["voice_predictions"][clusters[c]] = prediction
+            return (scores >= self.voice_threshold) & voice_predictions
+
+        def face_check(indices):
+            if job["ref_face_embedding"] is None:
+                return np.zeros(len(indices), dtype=bool)
+            with self.metrics.timer("face_verification", file=job["wav_file"], turns=len(indices)):
+                distances = self.face_distances(
+                    job["ref_face_embedding"],
+                    media_tasks.load_frames(job),
+                    job["owners"],
+                    job["slots"],
+                    len(turns),
+                )
+            passed = np.zeros(len(indices), dtype=bool)
+            for k, c in enumerate(indices):
+                job["face_distances"][representatives[c]] = distances[representatives[c]]
+                passed[k] = self.cluster_face_pass(distances[representatives[c]])
+                job["face_predictions"][clusters[c]] = passed[k]
+            return passed
+
+        return {"voice": voice_check, "face": face_check}
+
+    def run_cascade(self, job, stages, resume=False):
+        """Run cascade stages over the turns of a job, or over its clusters in cluster mode
 
-            wav_name = os.path.basename(file)
-            wav_name_no_ext = wav_name.split(".")[0]
+        Args:
+            job (dict): diarize job with "turns"
+            stages (list): stages to run
+            resume (bool, optional): Continue from the verdicts of earlier stages. Defaults to False.
 
-            orig_video_file = os.path.join(
-                self.video_folder,
-                f"{name}/{wav_name_no_ext}.mp4",
+        Returns:
+            dict: the job with the per-turn "accepted" mask
+        """
+        if self.verification_mode != "cluster":
+            keep = job["accepted"] if resume else None
+            job["accepted"] = self.cascade.run(
+                len(job["turns"]), self.cascade_checks(job), stages=stages, keep=keep
             )
+            return job
 
-            for turn, _, speaker in diarization.itertracks(yield_label=True):
-                if float(turn.end) - float(turn.start) >= self.min_seg_len:
-                    segment = sound[turn.start * 1000 : turn.end * 1000]
-                    outfile = f"{self.diarization_folder}/{name}/{wav_name_no_ext}_{turn.start}_{turn.end}.wav"
-                    tmpfile = (
-                        f"{tmpfolder}/{wav_name_no_ext}_{turn.start}_{turn.end}.wav"
-                    )
-                    segment.export(tmpfile, format="wav")
-
-                    # Speaker Verification
-                    score, voice_prediction = self.compare_speaker(ref, tmpfile)
-                    # Face Verification
-                    ref_image_format = os.getenv("DEFAULT_REF_IMAGE_FORMAT")
-                    tmpfile_img = f"{tmpfolder}/{name}_{turn.start}_{turn.end}.{ref_image_format}"
-                    timestamp = datetime.timedelta(seconds=(turn.end + turn.start) / 2)
-
-                    self.extract_frame(orig_video_file, tmpfile_img, timestamp)
-
-                    try:
-                        face_prediction = self.verify_face(
-                            ref_face,
-                            tmpfile_img,
-                            model_name="Facenet",
-                            distance_metric="cosine",
-                            detector_backend="mtcnn"
-                        )
-                    except Exception as e:
-                        face_prediction = False
-
-                    print(f"{str(datetime.timedelta(seconds=turn.start))} - {str(datetime.timedelta(seconds=turn.end))}, VoiceScore: {score}, Face: {face_prediction}")
-                    if (
-                        score >= float(os.getenv("VOICE_THRESHOLD"))
-                        and voice_prediction
-                        and face_prediction
-                    ):
-                        # Slice audio into multiple segments if exceed max length
-                        if float(turn.end) - float(turn.start) >= self.max_seg_len:
-                            chunks = make_chunks(
-                                segment, self.min_seg_len * 1000
-                            )  # Make chunks
-                            for i, chunk in enumerate(chunks):
-                                chunk_name = f"{self.diarization_folder}/{name}/{wav_name_no_ext}_{turn.start}_{turn.end}_{i}.wav"
-                                chunk.export(chunk_name, format="wav")
-                                # Export video segment as well
-                                if self.export_video == "true":
-                                    out_filename = f"{self.diarization_folder}/{name}/{wav_name_no_ext}_{turn.start}_{turn.end}_{i}.mp4"
-                                    self.extract_video_segment(orig_video_file, out_filename, turn.start, turn.end)
-                            os.remove(tmpfile)
-                        else:
-                            # Export video segment as well
-                            if self.export_video == "true":
-                                out_filename = f"{self.diarization_folder}/{name}/{wav_name_no_ext}_{turn.start}_{turn.end}.mp4"
-                                self.extract_video_segment(orig_video_file, out_filename, turn.start, turn.end)
-                            shutil.move(tmpfile, outfile)
-                    else:
-                        os.remove(tmpfile)
-                    os.remove(tmpfile_img)
+        keep = job["cluster_accepted"] if resume else None
+        job["cluster_accepted"] = self.cascade.run(
+            len(job["clusters"]), self.cluster_checks(job), stages=stages, keep=keep
+        )
+        job["accepted"] = np.zeros(len(job["turns"]), dtype=bool)
+        for c in np.flatnonzero(job["cluster_accepted"]):
+            job["accepted"][job["clusters"][c]] = True
+        return job
+
+    def analyze(self, job):
+        """Model step 1: diarize the wav and run the cascade stages that come before the face check
+
+        Returns:
+            dict: the job with "turns", scores so far and the "timestamps" to decode for faces
+        """
+        if job["hash"] is None:
+            job["hash"] = file_hash(job["wav_file"])
+        # pyannote runs once per unique recording, later runs (and other POIs linking the same
+        # stored video) reuse the stored turns
+        with self.hash_locks_guard:
+            lock = self.hash_locks.setdefault(job["hash"], threading.Lock())
+        with lock:
+            all_turns = self.result_cache.load_turns(job["hash"])
+            if all_turns is None:
+                with self.metrics.timer("pyannote", file=job["wav_file"]):
+                    all_turns = list(self.long_form.turns(job["audio_file"]))
+                self.result_cache.save_turns(job["hash"], all_turns)
+
+        # Collect every candidate turn first so they can be embedded in batches
+        self.select_candidates(job, all_turns)
+        turns = job["turns"]
+        job["scores"] = np.full(len(turns), np.nan)
+        job["voice_predictions"] = np.zeros(len(turns), dtype=bool)
+        job["face_distances"] = np.full(
+            (len(turns), self.frame_extractor.frames_per_turn), np.nan
+        )
+        job["face_predictions"] = np.zeros(len(turns), dtype=bool)
+        if self.verification_mode == "cluster":
+            job["clusters"] = self.clusters(turns)
+            job["representatives"] = [
+                members[: self.cluster_representatives] for members in job["clusters"]
+            ]
+        stages = self.cascade.stages
+        before_face = stages[: stages.index("face")] if "face" in stages else stages
+        self.run_cascade(job, before_face)
+
+        # Frames are only decoded for turns that survived the cheaper stages, and in cluster
+        # mode only for the representatives of the surviving clusters
+        candidates = np.flatnonzero(job["accepted"])
+        if self.verification_mode == "cluster":
+            candidates = [
+                i
+                for c in np.flatnonzero(job["cluster_accepted"])
+                for i in job["representatives"][c]
+            ]
+        job["timestamps"], job["owners"], job["slots"] = [], [], []
+        if "face" in stages:
+            for i in candidates:
+                start, end, _ = turns[i]
+                timestamps = self.frame_extractor.turn_timestamps(start, end)
+                for slot, timestamp in enumerate(timestamps):
+                    job["timestamps"].append(timestamp)
+                    job["owners"].append(i)
+                    job["slots"].append(slot)
+        return job
+
+    def select_candidates(self, job, all_turns):
+        """Keep the turns long enough to verify, remembering where they sit in all_turns"""
+        job["all_turns"] = all_turns
+        job["turn_index"] = [
+            i for i, (start, end, _) in enumerate(all_turns) if end - start >= self.min_seg_len
+        ]
+        job["turns"] = [all_turns[i] for i in job["turn_index"]]
+        self.cascade.record("length", len(all_turns), len(all_turns) - len(job["turns"]))
+
+    def save_scores(self, job):
+        """Store the scores of every turn so thresholds can be re-tuned without the models"""
+        num_turns = len(job["all_turns"])
+        voice_scores = np.full(num_turns, np.nan)
+        voice_scores[job["turn_index"]] = job["scores"]
+        voice_predictions = np.zeros(num_turns, dtype=bool)
+        voice_predictions[job["turn_index"]] = job["voice_predictions"]
+        face_distances = np.full((num_turns, self.frame_extractor.frames_per_turn), np.nan)
+        face_distances[job["turn_index"]] = job["face_distances"]
+        arrays = {}
+        embedded = job.get("turn_embeddings", {})
+        if embedded:  # For the duplicate check of --rescore, NaN rows were never embedded
+            dim = len(next(iter(embedded.values())))
+            voice_embeddings = np.full((num_turns, dim), np.nan, dtype=np.float32)
+            for i, embedding in embedded.items():
+                voice_embeddings[job["turn_index"][i]] = embedding
+            arrays["voice_embeddings"] = voice_embeddings
+        self.result_cache.save_scores(
+            job["hash"],
+            job["reference_key"],
+            voice_scores=voice_scores,
+            voice_predictions=voice_predictions,
+            face_distances=face_distances,
+            **arrays,
+        )
+
+    def verify(self, job):
+        """Model step 2: face check on the decoded frames and any stages after it
+
+        Returns:
+            dict: the job with the final "accepted" mask
+        """
+        stages = self.cascade.stages
+        from_face = stages[stages.index("face") :] if "face" in stages else []
+        self.run_cascade(job, from_face, resume=True)
+        if self.segment_index_flag:
+            self.deduplicate(job)
+        for (start, end, _), score, face_prediction in zip(
+            job["turns"], job["scores"], job["face_predictions"]
+        ):
+            print(f"{str(datetime.timedelta(seconds=start))} - {str(datetime.timedelta(seconds=end))}, VoiceScore: {score}, Face: {face_prediction}")
+        self.save_scores(job)
+        job.pop("turn_embeddings", None)  # Not needed by the export
+        return job
+
+    def rescore_job(self, job):
+        """Re-apply the current thresholds to the cached turns and scores of a job, no model runs
+
+        Turns that a stage never scored (e.g. face checks skipped by the cascade, or turns that
+        were below MIN_SEGMENT_LEN at the time) cannot pass that stage.
+
+        Returns:
+            dict: the job ready for export_segments, None when nothing is cached for it
+        """
+        if job["hash"] is None:
+            job["hash"] = file_hash(job["wav_file"])
+        all_turns = self.result_cache.load_turns(job["hash"])
+        cached = self.result_cache.load_scores(job["hash"], job["reference_key"])
+        if all_turns is None or cached is None:
+            print(f"No cached results for {job['wav_file']}, diarize it without --rescore first")
+            return None
+
+        self.select_candidates(job, all_turns)
+        job["scores"] = cached["voice_scores"][job["turn_index"]]
+        job["voice_predictions"] = cached["voice_predictions"][job["turn_index"]]
+        job["face_distances"] = cached["face_distances"][job["turn_index"]]
+        scores, predictions = job["scores"], job["voice_predictions"]
+        distances = job["face_distances"]
+        face_passed = self.face_votes_pass(distances)
+        if self.verification_mode == "cluster":
+            # Turns carry their cluster's voice score, the face vote is redone per cluster over
+            # the turns that had frames sampled
+            for members in self.clusters(job["turns"]):
+                sampled = distances[members]
+                sampled = sampled[~np.isnan(sampled).all(axis=1)]
+                face_passed[members] = self.cluster_face_pass(sampled)
+        checks = {
+            # NaN scores compare False, so unscored turns are rejected
+            "voice": lambda indices: (scores[indices] >= self.voice_threshold)
+            & predictions[indices],
+            "face": lambda indices: face_passed[indices],
+        }
+        job["accepted"] = self.cascade.run(len(job["turns"]), checks)
+        if "voice_embeddings" in cached:  # For deduplicate
+            embeddings = cached["voice_embeddings"][job["turn_index"]]
+            job["turn_embeddings"] = {
+                i: embedding
+                for i, embedding in enumerate(embeddings)
+                if not np.isnan(embedding).any()
+            }
+        return job
+
+    def rescore(self, names):
+        """Re-select and export segments of several POIs from the result cache"""
+        for name in names:
+            for job in tqdm(self.make_jobs(name, force=True)):
+                job = self.rescore_job(job)
+                if job is None:
+                    continue
+                try:
+                    job = media_tasks.prepare_audio(job)
+                    if self.segment_index_flag:  # Turns dropped as duplicates stay dropped
+                        self.deduplicate(job)
+                    job.pop("turn_embeddings", None)
+                    job = media_tasks.export_segments(job)
+                except Exception:
+                    media_tasks.cleanup(job)
+                    raise
+                self.mark_done(job)
+
+    def diarize(self, name):
+        """Diarize and verify every wav of a POI one after another"""
+        steps = [
+            ("decode", media_tasks.prepare_audio),
+            ("analyze", self.analyze),
+            ("frames", media_tasks.extract_frames),
+            ("verify", self.verify),
+            ("export", media_tasks.export_segments),
+        ]
+        for job in tqdm(self.make_jobs(name)):
+            try:
+                for stage, step in steps:
+                    with self.metrics.timer(stage):
+                        job = step(job)
+            except Exception:
+                media_tasks.cleanup(job)
+                raise
+            self.mark_done(job)
+
+    def discard(self, stage, job, error):
+        """Executor on_error hook, remove the temporary files of a dropped diarize job"""
+        if isinstance(job, dict) and "settings" in job:  # Not a search or download job
+            media_tasks.cleanup(job)
+
+    def stages(self, workers=1, model_workers=1):
+        """Executor stages from a diarize job to its exported segments
+
+        Args:
+            workers (int, optional): Processes for decode, frame extraction and export. Defaults to 1.
+            model_workers (int, optional): Model-holding workers. Defaults to 1.
+
+        Returns:
+            list: Stage objects, the last one yields jobs ready for mark_done
+        """
+        return [
+            Stage("decode", media_tasks.prepare_audio, workers),
+            Stage(
+                "analyze",
+                Diarization.analyze,
+                model_workers,
+                kind="model",
+                init=self.model_worker,
+            ),
+            Stage("frames", media_tasks.extract_frames, workers),
+            Stage(
+                "verify",
+                Diarization.verify,
+                model_workers,
+                kind="model",
+                init=self.model_worker,
+            ),
+            Stage("export", media_tasks.export_segments, workers),
+        ]
+
+    def run_pipelined(self, names, workers=1, model_workers=1, queue_size=4):
+        """Diarize every wav of several POIs with overlapping decode, inference and export
+
+        Args:
+            names (list): POI names
+            workers (int, optional): Processes for decode, frame extraction and export. Defaults to 1.
+            model_workers (int, optional): Model-holding workers. Defaults to 1.
+            queue_size (int, optional): Jobs queued in front of each stage. Defaults to 4.
+        """
+        executor = PipelinedExecutor(
+            self.stages(workers=workers, model_workers=model_workers),
+            queue_size=queue_size,
+            metrics=self.metrics,
+            on_error=self.discard,
+        )
+        jobs = (job for name in names for job in self.make_jobs(name))
+        for job in tqdm(executor.run(jobs)):
+            self.mark_done(job)
+        for stage, job, error in executor.errors:
+            self.record_error(stage, job, error)
 
     def create_directory(self, name):
         """Create target folder to store audio clips for each name
@@ -197,9 +929,10 @@ class Diarization:
         os.makedirs(target_video_dir, exist_ok=True)
         return True
 
-    def process_pois(self):
+    def process_pois(self, workers=1, model_workers=1, queue_size=4, rescore=False):
         self.read_poi_file()
-        for _, row in tqdm(self.df.iterrows(), total=self.df.shape[0]):
+        names = []
+        for _, row in self.df.iterrows():
             # Parse string as list
             name = row["Name"]
             name = re.sub(
@@ -207,15 +940,79 @@ class Diarization:
             )  # Strip special characters from name
 
             new_poi_flag = self.create_directory(name)  # Create folder for each POI
-            if new_poi_flag:
-                self.diarize(name)
+            # With a state every POI is revisited and only new or changed wavs are processed
+            if new_poi_flag or self.state or rescore:
+                names.append(name)
+        if rescore:
+            self.rescore(names)
+        else:
+            self.run_pipelined(
+                names, workers=workers, model_workers=model_workers, queue_size=queue_size
+            )
+        for stage, counts in self.cascade.counts.items():
+            self.metrics.add("cascade_evaluated", counts["evaluated"], {"check": stage})
+            self.metrics.add("cascade_pruned", counts["pruned"], {"check": stage})
+        print(self.cascade.summary())
+        print(self.metrics.summary())
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--file", type=str, required=True)
+    parser.add_argument(
+        "--batch-size", type=int, default=int(os.getenv("EMBED_BATCH_SIZE", "16"))
+    )
+    parser.add_argument("--device", type=str, default=os.getenv("DEVICE"))
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("DECODE_WORKERS", "1"))
+    )
+    parser.add_argument(
+        "--model-workers", type=int, default=int(os.getenv("MODEL_WORKERS", "1"))
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+    )
+    # Re-apply thresholds to cached turns and scores, without loading any model
+    parser.add_argument("--rescore", action="store_true")
+    # Write cProfile stats of the run to <METRICS_FOLDER>/diarize.prof
+    parser.add_argument("--profile", action="store_true")
     args = parser.parse_args()
 
-    poi_filename = os.path.join(os.getenv("POI_FOLDER"), args.file)
-    clsObj = Diarization(poi_filename)
-    diarizaton_res = clsObj.process_pois()
+    poi_filename = os.path.abspath(os.path.join(os.getenv("POI_FOLDER"), args.file))
+    result = None
+    if not args.rescore:  # Re-scoring loads no model, it gains nothing from the server
+        result = model_server.request(
+            "diarize",
+            {
+                "file": poi_filename,
+                "batch_size": args.batch_size,
+                "workers": args.workers,
+                "model_workers": args.model_workers,
+                "queue_size": args.queue_size,
+            },
+        )
+    if result is not None:
+        print(result["summary"])
+        raise SystemExit(0)
+
+    metrics = Metrics("diarize", folder=os.getenv("METRICS_FOLDER"))
+    with profiled(profile_path("diarize", args.profile)):
+        try:
+            clsObj = Diarization(
+                poi_filename,
+                batch_size=args.batch_size,
+                device=args.device,
+                state=PipelineState(
+                    os.path.join(os.getenv("CACHE_FOLDER"), "pipeline_state.sqlite")
+                ),
+                load_models=not args.rescore,
+                metrics=metrics,
+            )
+            diarizaton_res = clsObj.process_pois(
+                workers=args.workers,
+                model_workers=args.model_workers,
+                queue_size=args.queue_size,
+                rescore=args.rescore,
+            )
+        finally:
+            metrics.close()
@@ -10,11 +10,15 @@ python src/download_ref_segments.py
 import os
 import re
 import ast
+import argparse
+from glob import glob
 import pandas as pd
-from tqdm import tqdm
 from yt_dlp import YoutubeDL
 from yt_dlp.utils import download_range_func
 from dotenv import load_dotenv
+from download_scheduler import DownloadScheduler
+from pipeline_state import PipelineState
+from instrumentation import Metrics, file_size, profiled, profile_path
 
 load_dotenv()
 
@@ -36,16 +40,34 @@ class YTLogger:
 
 
 class RefVideoScrapper:
-    def __init__(self, poi_filename, audio_dir):
+    def __init__(
+        self,
+        poi_filename,
+        audio_dir,
+        scheduler_opts=None,
+        ydl_factory=YoutubeDL,
+        state=None,
+        metrics=None,
+    ):
         """Initialize a class to scrape the actual videos
 
         Args:
             poi_filename (str): filepath to the csv with URLs
             audio_dir(str): Directory to store the audio files
+            scheduler_opts (dict, optional): Keyword arguments for DownloadScheduler
+            ydl_factory (callable, optional): Builds the downloader from ydl_opts. Defaults to YoutubeDL.
+            state (PipelineState, optional): Skips clips that were already downloaded.
+            metrics (Metrics, optional): Receives download timings, outcomes and bytes.
         """
         self.poi_filename = poi_filename
         self.df = None
         self.audio_dir = audio_dir
+        self.ydl_factory = ydl_factory
+        self.state = state
+        self.metrics = metrics or Metrics("download_ref_segments")
+        self.scheduler = DownloadScheduler(
+            self.download_task, metrics=self.metrics, **(scheduler_opts or {})
+        )
 
         self.read_poi_file()
 
@@ -74,12 +96,28 @@ class RefVideoScrapper:
             "logger": YTLogger,
         }
 
-        with YoutubeDL(ydl_opts) as ydl:
-            ydl.download(url)
+        with self.ydl_factory(ydl_opts) as ydl:
+            ydl.download([url])
+
+    def download_task(self, task):
+        """Download one clip for the scheduler and record it as soon as it finishes"""
+        self.download_videos(task["url"], task["name"], task["start"], task["end"])
+        clips = glob(
+            os.path.join(self.audio_dir, task["name"], f"*_{task['start']}_{task['end']}.wav")
+        )
+        self.metrics.count(
+            "bytes_written",
+            sum(file_size(path) for path in clips),
+            labels={"poi": task["name"]},
+            url=task["url"],
+        )
+        if self.state:
+            self.state.mark_download(task["key"], task["name"], "done")
 
     def iterate_poi(self):
         """Iterate through each name and download videos into each speaker folder"""
-        for _, row in tqdm(self.df.iterrows()):
+        tasks = []
+        for _, row in self.df.iterrows():
             # Parse string as list
             name = row["Name"]
             name = re.sub(
@@ -89,12 +127,49 @@ class RefVideoScrapper:
             start_time = row["start"]
             end_time = row["end"]
 
-            if url != "":
-                self.download_videos(url, name, start_time, end_time)
+            # The same video can be listed with several clip ranges
+            key = f"{url}#{start_time}-{end_time}"
+            if url != "" and not (self.state and self.state.download_done(key)):
+                tasks.append(
+                    {
+                        "url": url,
+                        "key": key,
+                        "name": name,
+                        "start": start_time,
+                        "end": end_time,
+                    }
+                )
+        return self.scheduler.run(tasks)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # Write cProfile stats of the run to <METRICS_FOLDER>/download_ref_segments.prof
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+
     poi_filename = os.getenv("REF_AUDIO_CSV")
     audio_dir = os.getenv("REF_AUDIO_DIR")
-    clsObj = RefVideoScrapper(poi_filename, audio_dir)
-    clsObj.iterate_poi()
+    metrics = Metrics("download_ref_segments", folder=os.getenv("METRICS_FOLDER"))
+    with profiled(profile_path("download_ref_segments", args.profile)):
+        try:
+            clsObj = RefVideoScrapper(
+                poi_filename,
+                audio_dir,
+                scheduler_opts={
+                    "workers": int(os.getenv("DOWNLOAD_WORKERS", "4")),
+                    "per_host": int(os.getenv("DOWNLOAD_PER_HOST", "2")),
+                    "retries": int(os.getenv("DOWNLOAD_RETRIES", "3")),
+                    "manifest_path": os.path.join(
+                        os.getenv("CACHE_FOLDER"), "ref_download_manifest.jsonl"
+                    ),
+                },
+                state=PipelineState(
+                    os.path.join(os.getenv("CACHE_FOLDER"), "pipeline_state.sqlite")
+                ),
+                metrics=metrics,
+            )
+            clsObj.iterate_poi()
+            print(metrics.summary())
+        finally:
+            metrics.close()
@@ -0,0 +1,114 @@
+##############################################################################################
+"""
+Concurrent download scheduler shared by video_scrapper.py and download_ref_segments.py
+
+Downloads run in a bounded thread pool with a concurrency limit per host, failed downloads are
+retried with exponential backoff, and the outcome of every URL is appended to a JSONL manifest.
+The actual download is an injected callable, so a local stub can stand in for YoutubeDL.
+"""
+##############################################################################################
+
+import os
+import json
+import time
+import random
+import threading
+from tqdm import tqdm
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import Metrics
+
+
+class DownloadScheduler:
+    def __init__(
+        self,
+        download_fn,
+        workers=4,
+        per_host=2,
+        retries=3,
+        backoff=2.0,
+        manifest_path=None,
+        metrics=None,
+    ):
+        """Initialize the scheduler
+
+        Args:
+            download_fn (callable): download_fn(task) downloads one task dict with a "url" key and
+                raises on failure. It may return a status to record instead of "done", e.g.
+                "rejected" when the task was deliberately not downloaded.
+            workers (int, optional): Concurrent downloads overall. Defaults to 4.
+            per_host (int, optional): Concurrent downloads per host. Defaults to 2.
+            retries (int, optional): Retries after the first failed attempt. Defaults to 3.
+            backoff (float, optional): Base delay in seconds, doubled after every failure. Defaults to 2.0.
+            manifest_path (str, optional): JSONL file receiving one status line per URL.
+            metrics (Metrics, optional): Receives download timings and outcomes per POI.
+        """
+        self.download_fn = download_fn
+        self.workers = workers
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.manifest_path = manifest_path
+        self.metrics = metrics or Metrics("downloads")
+        if manifest_path:
+            os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+        self.host_limits = {}
+        self.lock = threading.Lock()
+
+    def host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self.host_limits[host]
+
+    def record(self, task, status, attempts, error=None):
+        """Append the outcome of a task to the manifest
+
+        Returns:
+            dict: the manifest entry
+        """
+        entry = {
+            "url": task["url"],
+            "name": task.get("name"),
+            "status": status,
+            "attempts": attempts,
+            "error": str(error) if error else None,
+            "time": time.time(),
+        }
+        self.metrics.add("downloads", 1, {"poi": task.get("name"), "status": status})
+        if self.manifest_path:
+            with self.lock:
+                with open(self.manifest_path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+        return entry
+
+    def attempt(self, task):
+        """Download one task, retrying with exponential backoff and jitter"""
+        error = None
+        for attempt in range(1, self.retries + 2):
+            try:
+                with self.host_semaphore(task["url"]):
+                    # Failed attempts are counted as errors of the download stage
+                    with self.metrics.timer("download", url=task["url"], attempt=attempt):
+                        status = self.download_fn(task)
+                return self.record(task, status or "done", attempt)
+            except Exception as e:
+                error = e
+                if attempt <= self.retries:
+                    # Sleep outside the host slot so other downloads can use it meanwhile
+                    time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+        print(f"{task['url']}: {error}")
+        return self.record(task, "failed", self.retries + 1, error)
+
+    def run(self, tasks):
+        """Download every task
+
+        Args:
+            tasks (list): task dicts, each with a "url" key
+
+        Returns:
+            list: manifest entries, in task order
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(tqdm(pool.map(self.attempt, tasks), total=len(tasks)))
@@ -0,0 +1,88 @@
+##############################################################################################
+"""
+Persistent on-disk store for embeddings computed from files (reference audios, reference images).
+
+Each entry is a .npy file under <CACHE_FOLDER>/<namespace>/ named after the source file path and
+its (size, mtime) signature. When the source file changes, the signature changes and the stale
+entry is replaced on the next lookup. Groups of files (all reference clips of a POI) are keyed the
+same way by the combined signature of their files.
+"""
+##############################################################################################
+
+import os
+import hashlib
+import numpy as np
+from glob import glob
+
+
+class EmbeddingCache:
+    def __init__(self, cache_folder, namespace):
+        """Initialize the embedding store
+
+        Args:
+            cache_folder (str): Root cache folder (CACHE_FOLDER)
+            namespace (str): Sub folder to keep different embedding types apart (e.g. speaker, face)
+        """
+        self.cache_dir = os.path.join(cache_folder, namespace)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path_key(self, path):
+        """Stable key for a source file path"""
+        return hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+
+    def signature(self, path):
+        """Key the content of a source file by its size and modification time"""
+        stat = os.stat(path)
+        return hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8")).hexdigest()[:16]
+
+    def get_group(self, group, paths, compute_fn):
+        """Return the cached embeddings computed from a set of files, e.g. all references of a POI
+
+        The entry is keyed by the group name and the signature of every file, so adding, removing
+        or changing any file of the group invalidates it.
+
+        Args:
+            group (str): group name (POI name)
+            paths (list): source files
+            compute_fn (callable): Called as compute_fn(paths) on a cache miss, returns an array
+
+        Returns:
+            np.ndarray: Memory-mapped (read-only) embeddings
+        """
+        paths = sorted(paths)
+        signature = hashlib.sha1(
+            "|".join(f"{os.path.abspath(p)}:{self.signature(p)}" for p in paths).encode("utf-8")
+        ).hexdigest()[:16]
+        # The group name is not a path, its key must not depend on the working directory
+        key = hashlib.sha1(f"group:{group}".encode("utf-8")).hexdigest()[:16]
+        return self._load_or_compute(key, signature, lambda: compute_fn(paths))
+
+    def get(self, path, compute_fn):
+        """Return the cached embedding for a file, computing and storing it on a miss
+
+        Args:
+            path (str): Source file the embedding is computed from
+            compute_fn (callable): Called as compute_fn(path) on a cache miss, returns an array
+
+        Returns:
+            np.ndarray: Memory-mapped (read-only) embedding
+        """
+        return self._load_or_compute(
+            self.path_key(path), self.signature(path), lambda: compute_fn(path)
+        )
+
+    def _load_or_compute(self, key, signature, compute):
+        entry = os.path.join(self.cache_dir, f"{key}_{signature}.npy")
+        if os.path.exists(entry):
+            return np.load(entry, mmap_mode="r")
+
+        # Drop entries written for an older version of the same source
+        for stale in glob(os.path.join(self.cache_dir, f"{key}_*.npy")):
+            os.remove(stale)
+
+        embedding = np.asarray(compute(), dtype=np.float32)
+        tmp_entry = f"{entry}.{os.getpid()}.tmp"
+        with open(tmp_entry, "wb") as f:
+            np.save(f, embedding)
+        os.replace(tmp_entry, entry)  # Atomic, so concurrent readers never see a partial file
+        return np.load(entry, mmap_mode="r")
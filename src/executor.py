@@ -0,0 +1,172 @@
+##############################################################################################
+"""
+Pipelined executor with bounded queues between stages
+
+Each stage has its own pool of workers and reads from the bounded queue the previous stage writes
+to, so audio decode, model inference, ffmpeg work and disk writes of different files overlap
+while the number of in-flight jobs stays capped.
+
+- "process" stages run a picklable function in a process pool (ffmpeg, decoding, disk I/O)
+- "model" stages run in threads that each build their model holder once with `init` and keep it
+  for the whole run, so models are loaded once per worker
+- "thread" stages run fn(job) in threads, for network-bound work (search, downloads)
+
+A fan-out stage returns an iterable of jobs for the next stage instead of a single job.
+"""
+##############################################################################################
+
+import queue
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import Metrics
+
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name, fn, workers=1, kind="process", init=None, fan_out=False):
+        """Describe one stage of the pipeline
+
+        Args:
+            name (str): stage name, used in error messages
+            fn (callable): fn(job) for process and thread stages, fn(state, job) for model
+                stages. Returns the job for the next stage, or None to drop it.
+            workers (int, optional): Number of workers. Defaults to 1.
+            kind (str, optional): "process", "model" or "thread". Defaults to "process".
+            init (callable, optional): Model stages only, init(worker_index) builds the state
+                passed to fn.
+            fan_out (bool, optional): fn returns a list of jobs for the next stage, or in thread
+                and model stages yields them, each passed on as soon as it is produced.
+                Defaults to False.
+        """
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.kind = kind
+        self.init = init
+        self.fan_out = fan_out
+
+
+class PipelinedExecutor:
+    def __init__(self, stages, queue_size=4, metrics=None, on_error=None):
+        """Initialize the executor
+
+        Args:
+            stages (list): Stage objects in execution order
+            queue_size (int, optional): Capacity of the queue in front of each stage. Defaults to 4.
+            metrics (Metrics, optional): Receives the wall time, calls and errors of every stage.
+            on_error (callable, optional): on_error(stage name, job, error) is called from the
+                worker when a stage raises and its job is dropped, e.g. to remove the job's
+                temporary files. A process stage's job is the copy sent to it, without what the
+                failing call had added.
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.metrics = metrics or Metrics("executor")
+        self.on_error = on_error
+        self.errors = []
+
+    def _worker(self, stage, state, in_queue, out_queue, pool, remaining, lock):
+        while True:
+            job = in_queue.get()
+            if job is _DONE:
+                in_queue.put(_DONE)  # Let the other workers of this stage see it too
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:  # Last worker out closes the next queue
+                        out_queue.put(_DONE)
+                return
+            try:
+                with self.metrics.timer(stage.name):
+                    if stage.kind == "model":
+                        result = stage.fn(state, job)
+                    elif stage.kind == "thread":
+                        result = stage.fn(job)
+                    else:
+                        result = pool.submit(stage.fn, job).result()
+                    if stage.fan_out:
+                        # Blocks while the next stage is saturated, a generator pauses with it
+                        for item in result or ():
+                            if item is not None:
+                                out_queue.put(item)
+                        continue
+            except Exception as e:
+                # One broken file should not take the whole run down, the timer counted it
+                self.errors.append((stage.name, job, e))
+                print(f"[{stage.name}] {e}")
+                traceback.print_exc()
+                if self.on_error is not None:
+                    try:
+                        self.on_error(stage.name, job, e)
+                    except Exception as hook_error:
+                        print(f"[{stage.name}] on_error: {hook_error}")
+                continue
+            if result is not None:
+                out_queue.put(result)
+
+    def run(self, jobs):
+        """Push jobs through every stage
+
+        Args:
+            jobs (iterable): jobs for the first stage
+
+        Yields:
+            Results of the last stage, in completion order
+
+        Raises:
+            Exception: what iterating `jobs` raised, after the jobs fed before it are done
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        queues.append(queue.Queue())
+        pools, threads = [], []
+        # Spawned workers do not inherit the model threads' locks or CUDA state
+        context = multiprocessing.get_context("spawn")
+
+        for i, stage in enumerate(self.stages):
+            pool = None
+            if stage.kind == "process":
+                pool = ProcessPoolExecutor(max_workers=stage.workers, mp_context=context)
+                pools.append(pool)
+            # Models are loaded up front so a failing init raises here instead of stalling
+            states = [None] * stage.workers
+            if stage.kind == "model" and stage.init is not None:
+                states = [stage.init(index) for index in range(stage.workers)]
+            remaining, lock = [stage.workers], threading.Lock()
+            for state in states:
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(stage, state, queues[i], queues[i + 1], pool, remaining, lock),
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        feed_errors = []
+
+        def feed():
+            try:
+                for job in jobs:
+                    queues[0].put(job)  # Blocks while the first stage is saturated
+            except Exception as e:
+                # Raised again by run() once the jobs already fed are through
+                feed_errors.append(e)
+                self.metrics.error("feed", e)
+            finally:
+                queues[0].put(_DONE)  # Otherwise the stages, and run(), wait forever
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        try:
+            while True:
+                result = queues[-1].get()
+                if result is _DONE:
+                    break
+                yield result
+        finally:
+            for pool in pools:
+                pool.shutdown(wait=True)
+        if feed_errors:
+            raise feed_errors[0]
@@ -0,0 +1,153 @@
+##############################################################################################
+"""
+Batched face verification against cached reference face embeddings
+
+The reference image of each POI is detected and embedded once and kept in the embedding cache.
+Candidate frames are detected one by one (MTCNN has no batch API in DeepFace) but embedded in
+batches, and verification is a vectorized cosine distance against the cached reference vector.
+Batching goes through DeepFace.extract_faces(target_size=...) and the Keras model returned by
+DeepFace.build_model, which later deepface releases changed, hence the pin in requirements.txt.
+
+python src/face_verification.py <image 1> <image 2>
+
+checks that the batched distance matches DeepFace.verify on one pair of images.
+"""
+##############################################################################################
+
+import os
+import argparse
+import numpy as np
+from deepface import DeepFace
+from dotenv import load_dotenv
+from embedding_cache import EmbeddingCache
+
+load_dotenv()
+
+
+class FaceVerifier:
+    def __init__(
+        self,
+        model_name="Facenet",
+        detector_backend="mtcnn",
+        threshold=0.40,
+        batch_size=32,
+        cache_folder=None,
+    ):
+        """Load the face recognition model
+
+        Args:
+            model_name (str, optional): DeepFace model. Defaults to "Facenet".
+            detector_backend (str, optional): DeepFace detector. Defaults to "mtcnn".
+            threshold (float, optional): Max cosine distance to accept a face. Defaults to 0.40,
+                DeepFace's threshold for Facenet/cosine.
+            batch_size (int, optional): Faces per forward pass. Defaults to 32.
+            cache_folder (str, optional): Root cache folder. Defaults to CACHE_FOLDER.
+        """
+        self.model_name = model_name
+        self.detector_backend = detector_backend
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.model = DeepFace.build_model(model_name)
+        input_shape = tuple(self.model.input_shape)
+        self.target_size = input_shape[1:3] if len(input_shape) == 4 else input_shape[:2]
+        self.cache = EmbeddingCache(
+            # v2: embedded from BGR faces, entries of v1 came from channel-swapped input
+            cache_folder or os.getenv("CACHE_FOLDER"),
+            f"face_v2_{model_name}_{detector_backend}",
+        )
+
+    def detect_faces(self, img):
+        """Detect and align the faces in an image
+
+        Args:
+            img (str or np.ndarray): filepath or BGR image
+
+        Returns:
+            list: aligned BGR faces as float arrays of shape target_size + (3,)
+        """
+        try:
+            faces = DeepFace.extract_faces(
+                img_path=img,
+                target_size=self.target_size,
+                detector_backend=self.detector_backend,
+                enforce_detection=True,
+            )
+        except ValueError:  # No face in the image
+            return []
+        # extract_faces flips the faces to RGB for display, the models take BGR like represent()
+        return [np.reshape(face["face"][..., ::-1], self.target_size + (3,)) for face in faces]
+
+    def embed_faces(self, faces):
+        """Embed aligned faces in batches
+
+        Returns:
+            np.ndarray: L2-normalized embeddings of shape (len(faces), dim)
+        """
+        embeddings = []
+        for b in range(0, len(faces), self.batch_size):
+            batch = np.stack(faces[b : b + self.batch_size])
+            embeddings.append(self.model.predict(batch, verbose=0))
+        embeddings = np.concatenate(embeddings)
+        norm = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.maximum(norm, 1e-6)
+
+    def embed_reference_image(self, path):
+        faces = self.detect_faces(path)
+        if not faces:
+            raise ValueError(f"No face detected in reference image {path}")
+        return self.embed_faces(faces[:1])[0]
+
+    def embed_reference(self, path):
+        """Embedding of a POI reference image, reusing the cached one when the file is unchanged"""
+        return self.cache.get(path, self.embed_reference_image)
+
+    def distances(self, ref_embedding, frames):
+        """Cosine distance of the closest face in each frame to the reference face
+
+        Args:
+            ref_embedding (np.ndarray): normalized reference embedding
+            frames (list): BGR images
+
+        Returns:
+            np.ndarray: distance per frame, np.inf for frames without a detected face
+        """
+        faces, owners = [], []
+        for idx, frame in enumerate(frames):
+            for face in self.detect_faces(frame):
+                faces.append(face)
+                owners.append(idx)
+
+        distances = np.full(len(frames), np.inf)
+        if faces:
+            face_distances = 1 - self.embed_faces(faces) @ np.asarray(ref_embedding)
+            np.minimum.at(distances, owners, face_distances)
+        return distances
+
+    def deepface_distance(self, img1, img2):
+        """Batched distance of two single-face images and the one DeepFace.verify reports
+
+        Returns:
+            tuple: (distance from this class, DeepFace.verify distance)
+        """
+        distance = self.distances(self.embed_reference_image(img1), [img2])[0]
+        reference = DeepFace.verify(
+            img1_path=img1,
+            img2_path=img2,
+            model_name=self.model_name,
+            detector_backend=self.detector_backend,
+            distance_metric="cosine",
+        )["distance"]
+        return float(distance), float(reference)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("img1", type=str)
+    parser.add_argument("img2", type=str)
+    parser.add_argument("--tolerance", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    distance, reference = FaceVerifier().deepface_distance(args.img1, args.img2)
+    print(f"FaceVerifier: {distance:.6f}, DeepFace.verify: {reference:.6f}")
+    if abs(distance - reference) > args.tolerance:
+        raise SystemExit("Batched face distance does not match DeepFace.verify")
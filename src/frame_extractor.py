@@ -0,0 +1,100 @@
+##############################################################################################
+"""
+Decode many frames of a video in a single ffmpeg pass
+
+Instead of starting one ffmpeg process (plus a seek and a PNG round trip) per diarized turn, all
+requested timestamps of a video are turned into frame numbers and selected in one streaming decode
+that pipes raw BGR frames straight into NumPy arrays.
+"""
+##############################################################################################
+
+import os
+import ffmpeg
+import numpy as np
+
+
+class FrameExtractor:
+    def __init__(self, frames_per_turn=1, max_height=720):
+        """Initialize the frame extractor
+
+        Args:
+            frames_per_turn (int, optional): Frames sampled per turn for voting. Defaults to 1.
+            max_height (int, optional): Downscale taller videos to this height. Defaults to 720.
+        """
+        self.frames_per_turn = frames_per_turn
+        self.max_height = max_height
+
+    def turn_timestamps(self, start, end):
+        """Evenly spaced timestamps inside a turn, a single frame is the midpoint
+
+        Args:
+            start (float): turn start in seconds
+            end (float): turn end in seconds
+
+        Returns:
+            list: timestamps in seconds
+        """
+        step = (end - start) / (self.frames_per_turn + 1)
+        return [start + step * (i + 1) for i in range(self.frames_per_turn)]
+
+    def probe(self, video_file):
+        """Read frame size and frame rate of the first video stream"""
+        info = ffmpeg.probe(video_file, select_streams="v:0")
+        stream = info["streams"][0]
+        num, den = stream["avg_frame_rate"].split("/")
+        fps = float(num) / float(den) if float(den) else 25.0
+        return int(stream["width"]), int(stream["height"]), fps
+
+    def extract(self, video_file, timestamps):
+        """Decode the frames at the given timestamps in one pass
+
+        Frames are streamed in timestamp order so only one frame is held in memory at a time.
+
+        Args:
+            video_file (str): filepath of the video
+            timestamps (list): timestamps in seconds, in any order
+
+        Yields:
+            tuple: (index into timestamps, BGR frame as np.ndarray of shape (h, w, 3))
+        """
+        if not timestamps or not os.path.exists(video_file):
+            return
+
+        width, height, fps = self.probe(video_file)
+        if self.max_height and height > self.max_height:
+            width = int(round(width * self.max_height / height / 2)) * 2
+            height = self.max_height
+
+        # Several timestamps can land on the same frame, decode it once and hand it to each
+        frame_numbers = {}
+        for idx, timestamp in enumerate(timestamps):
+            frame_numbers.setdefault(int(timestamp * fps), []).append(idx)
+        selected = sorted(frame_numbers)
+
+        select_expr = "+".join(f"eq(n,{n})" for n in selected)
+        process = (
+            ffmpeg.input(video_file)
+            .output(
+                "pipe:",
+                format="rawvideo",
+                pix_fmt="bgr24",
+                vf=f"select='{select_expr}',scale={width}:{height}",
+                vsync="0",
+            )
+            .global_args("-hide_banner", "-loglevel", "error")
+            .run_async(pipe_stdout=True)  # stderr left unpiped so it cannot stall ffmpeg
+        )
+
+        frame_size = width * height * 3
+        try:
+            for n in selected:
+                buffer = process.stdout.read(frame_size)
+                if len(buffer) < frame_size:  # Timestamp past the end of the video
+                    break
+                frame = np.frombuffer(buffer, np.uint8).reshape(height, width, 3)
+                for idx in frame_numbers[n]:
+                    yield idx, frame
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
@@ -0,0 +1,222 @@
+##############################################################################################
+"""
+Lightweight run metrics and profiling shared by every script
+
+Metrics counts stage wall time, calls, bytes and accept/reject/error outcomes in memory. With a
+folder set (METRICS_FOLDER), every recorded event is appended to <folder>/<script>.jsonl as it
+happens and the totals are written to <folder>/<script>.prom in the Prometheus textfile format
+(node_exporter --collector.textfile.directory) when the run closes. Totals only carry coarse
+labels (stage, POI, outcome), per-file detail lives in the JSONL trace.
+
+profiled() wraps a run in cProfile, including the worker threads it starts, and dumps the merged
+stats to a .prof file for pstats or snakeviz.
+"""
+##############################################################################################
+
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+METRIC_PREFIX = "voice_scrapper"
+
+
+def file_size(path):
+    """Size of a file in bytes, 0 when it does not exist"""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metrics:
+    def __init__(self, script, folder=None):
+        """Collect the metrics of one run of a script
+
+        Args:
+            script (str): script name, used in the file names and as a label
+            folder (str, optional): Where the trace and textfile go. Defaults to no files.
+        """
+        self.script = script
+        self.run_id = f"{script}-{int(time.time())}-{os.getpid()}"
+        self.trace_path = None
+        self.textfile_path = None
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+            self.trace_path = os.path.join(folder, f"{script}.jsonl")
+            self.textfile_path = os.path.join(folder, f"{script}.prom")
+        self.totals = {}  # (metric, sorted label items) -> value
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, metric, value, labels=None):
+        key = (metric, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.totals[key] = self.totals.get(key, 0) + value
+
+    def event(self, kind, **fields):
+        """Append one line to the JSONL trace"""
+        if not self.trace_path:
+            return
+        line = json.dumps(
+            {"run": self.run_id, "time": round(time.time(), 3), "event": kind, **fields},
+            default=str,
+        )
+        with self.lock:
+            with open(self.trace_path, "a") as f:
+                f.write(line + "\n")
+
+    def count(self, metric, value=1, labels=None, **fields):
+        """Add to a counter and trace it
+
+        Args:
+            metric (str): counter name, e.g. "turns" or "bytes_written"
+            value (float, optional): Amount to add. Defaults to 1.
+            labels (dict, optional): Labels of the Prometheus total, keep them low-cardinality.
+            **fields: Extra detail for the trace only, e.g. file=...
+        """
+        self.add(metric, value, labels)
+        self.event(metric, value=value, **(labels or {}), **fields)
+
+    @contextmanager
+    def timer(self, stage, **fields):
+        """Time a block as one call of a stage, failed calls are counted as errors of the stage
+
+        Args:
+            stage (str): stage name, the only label of the totals
+            **fields: Extra detail for the trace only, e.g. file=...
+        """
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.add("stage_seconds", seconds, {"stage": stage})
+            self.add("stage_calls", 1, {"stage": stage})
+            if error is not None:
+                self.add("stage_errors", 1, {"stage": stage})
+            self.event(
+                "stage",
+                stage=stage,
+                seconds=round(seconds, 6),
+                error=f"{type(error).__name__}: {error}" if error else None,
+                **fields,
+            )
+
+    def error(self, stage, error, **fields):
+        """Count a failure that was handled (logged and skipped) instead of raised"""
+        self.add("stage_errors", 1, {"stage": stage})
+        self.event("error", stage=stage, error=f"{type(error).__name__}: {error}", **fields)
+
+    def value(self, metric, **labels):
+        """Current total of a counter, summed over the labels not given"""
+        with self.lock:
+            return sum(
+                value
+                for (name, items), value in self.totals.items()
+                if name == metric and set(labels.items()) <= set(items)
+            )
+
+    def summary(self):
+        """One line per stage with calls, seconds and errors"""
+        stages = sorted(
+            {dict(items)["stage"] for name, items in self.totals if name == "stage_calls"}
+        )
+        lines = []
+        for stage in stages:
+            lines.append(
+                f"{stage}: {self.value('stage_calls', stage=stage):.0f} calls, "
+                f"{self.value('stage_seconds', stage=stage):.2f}s, "
+                f"{self.value('stage_errors', stage=stage):.0f} errors"
+            )
+        return "\n".join(lines)
+
+    def write_textfile(self):
+        """Write the totals in the Prometheus text format, atomically so a scrape never sees half"""
+        if not self.textfile_path:
+            return
+        with self.lock:
+            totals = sorted(self.totals.items())
+        lines, typed = [], set()
+        for (metric, items), value in totals:
+            name = f"{METRIC_PREFIX}_{metric}_total"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            labels = ",".join(
+                f'{key}="{escape_label(label)}"'
+                for key, label in (("script", self.script),) + items
+            )
+            lines.append(f"{name}{{{labels}}} {value}")
+        name = f"{METRIC_PREFIX}_last_run_timestamp_seconds"
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f'{name}{{script="{self.script}"}} {self.started}')
+        tmp_path = f"{self.textfile_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.textfile_path)
+
+    def close(self):
+        """Trace the end of the run and write the textfile"""
+        self.event("run_end", seconds=round(time.time() - self.started, 3))
+        self.write_textfile()
+
+
+@contextmanager
+def profiled(path=None):
+    """Profile the block with cProfile, in the calling thread and every thread it starts
+
+    Process-pool workers are not profiled, their time shows up as waiting in the thread that
+    submitted the work.
+
+    Args:
+        path (str, optional): .prof file for the merged stats. Defaults to no profiling.
+    """
+    if not path:
+        yield
+        return
+    profiles, lock = [], threading.Lock()
+
+    def start_thread_profile(frame, event, arg):
+        # First profiler callback in a new thread, hand the thread over to its own cProfile
+        profile = cProfile.Profile()
+        with lock:
+            profiles.append(profile)
+        profile.enable()
+
+    main = cProfile.Profile()
+    threading.setprofile(start_thread_profile)
+    main.enable()
+    try:
+        yield
+    finally:
+        main.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(main, stream=sys.stderr)
+        with lock:
+            for profile in profiles:
+                stats.add(profile)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        stats.dump_stats(path)
+        stats.sort_stats("cumulative").print_stats(25)
+        print(f"Profile written to {path}", file=sys.stderr)
+
+
+def profile_path(script, enabled):
+    """Where --profile writes the stats of a script, None when profiling is off"""
+    if not enabled:
+        return None
+    folder = os.getenv("METRICS_FOLDER") or os.getenv("CACHE_FOLDER") or "."
+    return os.path.join(folder, f"{script}.prof")
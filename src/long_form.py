@@ -0,0 +1,212 @@
+##############################################################################################
+"""
+Bounded-memory diarization of long recordings in overlapping windows
+
+pyannote holds the whole file (and its segmentation and embedding outputs) in memory, which does
+not fit for multi-hour livestreams and hearings. Here the wav is memory-mapped and diarized one
+window at a time. Each window's local speaker labels are matched to the speakers of the earlier
+windows by the cosine similarity of their speechbrain embeddings. Each window keeps the turns in
+the middle of its overlaps with its neighbours, and a turn cut at a window boundary is joined
+with its continuation. Turns are yielded as soon as their window is done.
+"""
+##############################################################################################
+
+import os
+import numpy as np
+import audio_io
+
+# Turns of the same speaker closer than this (seconds) across a window boundary are joined
+JOIN_GAP = 0.5
+
+
+class ChunkedDiarizer:
+    def __init__(
+        self,
+        pipeline,
+        embedder=None,
+        window=0.0,
+        overlap=30.0,
+        threshold=0.4,
+        representatives=3,
+        batch_size=16,
+    ):
+        """Initialize the diarizer
+
+        Args:
+            pipeline: loaded pyannote pipeline
+            embedder (SpeakerEmbedder, optional): Links speakers across windows. Without it
+                every window gets its own labels.
+            window (float, optional): Window length in seconds, 0 diarizes the whole file in one
+                call. Defaults to 0.
+            overlap (float, optional): Seconds shared by consecutive windows. Defaults to 30.
+            threshold (float, optional): Min cosine similarity to link a window's speaker to an
+                earlier one. Defaults to 0.4.
+            representatives (int, optional): Longest turns embedded per speaker and window.
+                Defaults to 3.
+            batch_size (int, optional): Segments per embedding pass. Defaults to 16.
+        """
+        self.pipeline = pipeline
+        self.embedder = embedder
+        self.window = window
+        self.overlap = min(overlap, window / 2)
+        self.threshold = threshold
+        self.representatives = representatives
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_env(cls, pipeline, embedder=None, batch_size=16):
+        """Diarizer configured by LONG_FORM_WINDOW, LONG_FORM_OVERLAP and LONG_FORM_THRESHOLD"""
+        return cls(
+            pipeline,
+            embedder,
+            window=float(os.getenv("LONG_FORM_WINDOW", "0")),
+            overlap=float(os.getenv("LONG_FORM_OVERLAP", "30")),
+            threshold=float(os.getenv("LONG_FORM_THRESHOLD", "0.4")),
+            batch_size=batch_size,
+        )
+
+    def windows(self, duration):
+        """Split a recording into overlapping windows
+
+        Args:
+            duration (float): length of the recording in seconds
+
+        Yields:
+            tuple: (start, end) of the window and (owned_start, owned_end), the part of it whose
+                turns it keeps, boundaries sit in the middle of the overlaps
+        """
+        start = 0.0
+        while True:
+            end = min(start + self.window, duration)
+            owned_start = start + self.overlap / 2 if start > 0 else 0.0
+            owned_end = end - self.overlap / 2 if end < duration else duration
+            yield start, end, owned_start, owned_end
+            if end >= duration:
+                return
+            start += self.window - self.overlap
+
+    def diarize_window(self, samples, sample_rate, start, end):
+        """Diarize one window of the memory-mapped samples
+
+        Returns:
+            list: (start, end, local label) turns in seconds from the start of the file
+        """
+        import torch
+
+        chunk = audio_io.to_float(samples[int(start * sample_rate) : int(end * sample_rate)])
+        annotation = self.pipeline(
+            {"waveform": torch.from_numpy(chunk)[None], "sample_rate": sample_rate}
+        )
+        return [
+            (start + float(turn.start), start + float(turn.end), label)
+            for turn, _, label in annotation.itertracks(yield_label=True)
+        ]
+
+    def stitch(self, samples, sample_rate, turns, speakers, index):
+        """Map the local labels of a window to the speakers of the earlier windows
+
+        Each local speaker is embedded from its longest turns and linked one-to-one to the most
+        similar earlier speaker above the threshold, or becomes a new speaker. The sums of the
+        embeddings of every speaker are updated in place.
+
+        Args:
+            samples (np.ndarray): memory-mapped samples of the whole file
+            sample_rate (int): sample rate
+            turns (list): (start, end, local label) turns of the window
+            speakers (list): running embedding sum of every speaker so far
+            index (int): window number, for labels when there is no embedder
+
+        Returns:
+            dict: local label -> global label
+        """
+        local = {}
+        for turn in turns:
+            local.setdefault(turn[2], []).append(turn)
+        labels = list(local)
+        if self.embedder is None:
+            return {label: f"W{index}_{label}" for label in labels}
+
+        segments, owners = [], []
+        for k, label in enumerate(labels):
+            longest = sorted(local[label], key=lambda turn: turn[0] - turn[1])
+            for start, end, _ in longest[: self.representatives]:
+                segments.append(samples[int(start * sample_rate) : int(end * sample_rate)])
+                owners.append(k)
+        embeddings = self.embedder.embed_batch(
+            segments, sample_rate=sample_rate, batch_size=self.batch_size
+        )
+        sums = np.zeros((len(labels), embeddings.shape[1]))
+        np.add.at(sums, owners, embeddings)
+        embeddings = self.embedder.normalize(sums)
+
+        mapping, taken = {}, set()
+        if speakers:
+            similarity = embeddings @ self.embedder.normalize(np.stack(speakers)).T
+            # Most similar pairs first, each speaker is used once per window
+            for flat in np.argsort(-similarity, axis=None):
+                i, j = np.unravel_index(flat, similarity.shape)
+                if similarity[i, j] < self.threshold:
+                    break
+                if labels[i] not in mapping and j not in taken:
+                    mapping[labels[i]] = j
+                    taken.add(j)
+        for i, label in enumerate(labels):
+            if label not in mapping:
+                speakers.append(np.zeros(embeddings.shape[1]))
+                mapping[label] = len(speakers) - 1
+            speakers[mapping[label]] += embeddings[i]
+        return {label: f"SPEAKER_{j:02d}" for label, j in mapping.items()}
+
+    def turns(self, audio_file):
+        """Diarize a recording window by window
+
+        Args:
+            audio_file (str): filepath of the audio
+
+        Yields:
+            tuple: (start, end, speaker) turns, each as soon as no later window can change it
+        """
+        try:
+            samples, sample_rate = audio_io.read_wav(audio_file)
+        except ValueError:  # Not a PCM wav, pyannote decodes it as a whole
+            samples, sample_rate = None, None
+        if samples is None or self.window <= 0 or len(samples) <= self.window * sample_rate:
+            annotation = self.pipeline(audio_file)
+            for turn, _, speaker in annotation.itertracks(yield_label=True):
+                yield float(turn.start), float(turn.end), speaker
+            return
+
+        duration = len(samples) / sample_rate
+        speakers, held = [], []
+        for index, (start, end, owned_start, owned_end) in enumerate(self.windows(duration)):
+            turns = self.diarize_window(samples, sample_rate, start, end)
+            mapping = self.stitch(samples, sample_rate, turns, speakers, index)
+            kept = []
+            for turn_start, turn_end, label in turns:
+                turn_start, turn_end = max(turn_start, owned_start), min(turn_end, owned_end)
+                if turn_end > turn_start:
+                    kept.append((turn_start, turn_end, mapping[label]))
+
+            # Turns cut at the previous boundary continue into this window's turn of the speaker
+            for turn_start, turn_end, speaker in held:
+                continued = next(
+                    (
+                        turn
+                        for turn in kept
+                        if turn[2] == speaker and turn[0] <= owned_start + JOIN_GAP
+                    ),
+                    None,
+                )
+                if continued is None:
+                    yield turn_start, turn_end, speaker
+                else:
+                    kept.remove(continued)
+                    kept.append((turn_start, continued[1], speaker))
+            kept.sort()
+
+            held = []
+            if owned_end < duration:
+                held = [turn for turn in kept if turn[1] >= owned_end - JOIN_GAP]
+            for turn in kept:
+                if turn not in held:
+                    yield turn
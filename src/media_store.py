@@ -0,0 +1,67 @@
+##############################################################################################
+"""
+Content-addressed store of downloaded videos shared by all POIs
+
+Every video is downloaded (and its wav extracted) once into <store>/<video id>/. POI folders only
+hold links to the stored files, so a video found for several POIs costs one download, and since
+the links share the stored content, the diarization result cache (keyed by content hash) runs
+pyannote on it once as well.
+"""
+##############################################################################################
+
+import os
+from glob import glob
+
+
+class MediaStore:
+    def __init__(self, store_dir):
+        """Initialize the store
+
+        Args:
+            store_dir (str): Root folder of the stored videos
+        """
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+    def entry_dir(self, video_id):
+        return os.path.join(self.store_dir, video_id)
+
+    def outtmpl(self):
+        """yt-dlp output template writing each video into its own entry"""
+        return f"{self.store_dir}/%(id)s/%(id)s.%(ext)s"
+
+    def files(self, video_id):
+        """Finished files of a stored video (yt-dlp leaves .part files while downloading)"""
+        return [
+            path
+            for path in sorted(glob(os.path.join(self.entry_dir(video_id), "*")))
+            if not path.endswith((".part", ".ytdl", ".tmp"))
+        ]
+
+    def has(self, video_id):
+        """Whether the wav of a video is in the store"""
+        return os.path.exists(os.path.join(self.entry_dir(video_id), f"{video_id}.wav"))
+
+    def link(self, video_id, target_dir):
+        """Make the stored files of a video appear in a POI folder
+
+        Hardlinks are used where possible, symlinks when the POI folder is on another device.
+
+        Args:
+            video_id (str): id of a stored video
+            target_dir (str): POI folder
+
+        Returns:
+            list: paths of the files in target_dir
+        """
+        os.makedirs(target_dir, exist_ok=True)
+        linked = []
+        for source in self.files(video_id):
+            target = os.path.join(target_dir, os.path.basename(source))
+            if not os.path.lexists(target):
+                try:
+                    os.link(source, target)
+                except OSError:
+                    os.symlink(os.path.abspath(source), target)
+            linked.append(target)
+        return linked
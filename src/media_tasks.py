@@ -0,0 +1,274 @@
+##############################################################################################
+"""
+CPU/IO-bound steps of the diarize stage
+
+These run in the process pool of the pipelined executor, so they are plain module-level functions
+that take and return a picklable job dict and never touch a model.
+"""
+##############################################################################################
+
+import os
+import shutil
+import tempfile
+import ffmpeg
+import numpy as np
+import audio_io
+from frame_extractor import FrameExtractor
+from segment_exporter import SegmentExporter
+
+SAMPLE_RATE = 16000
+# Seconds fetched around each face-check timestamp in audio-only mode
+FRAME_CLIP_LEN = 1.0
+
+
+def ensure_wav(path, tmp_folder):
+    """Return a 16 kHz mono PCM version of an audio file, converting it with ffmpeg if needed
+
+    Args:
+        path (str): filepath of the audio
+        tmp_folder (str): where a converted copy is written
+
+    Returns:
+        str: path itself when it is already usable, otherwise the converted copy
+    """
+    try:
+        samples, sample_rate = audio_io.read_wav(path)
+        if sample_rate == SAMPLE_RATE and samples.ndim == 1:
+            return path
+    except ValueError:
+        pass
+
+    name_no_ext = os.path.basename(path).split(".")[0]
+    converted = os.path.join(tmp_folder, f"{name_no_ext}_{SAMPLE_RATE}.wav")
+    stream = ffmpeg.input(path)
+    stream = stream.output(converted, ac=1, ar=SAMPLE_RATE, acodec="pcm_s16le")
+    try:
+        stream.run(overwrite_output=True, quiet=True)
+    except Exception:
+        remove_file(converted)  # Partly written, and the job never learns its name
+        raise
+    return converted
+
+
+def remove_file(path):
+    """Delete a file if it exists"""
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def cleanup(job):
+    """Delete the temporary files of a diarize job, the converted wav and the stored frames
+
+    Safe to call more than once, and on a job that failed in any stage.
+
+    Args:
+        job (dict): diarize job
+    """
+    audio_file = job.get("audio_file")
+    if audio_file and audio_file != job["wav_file"]:
+        remove_file(audio_file)
+    remove_file(job.get("frames_file"))
+    job["frames_file"], job["frame_indices"] = None, []
+
+
+def prepare_audio(job):
+    """Make sure the wav can be memory-mapped as 16 kHz mono PCM, converting it if needed
+
+    Args:
+        job (dict): diarize job with "wav_file"
+
+    Returns:
+        dict: the job with "audio_file" pointing at a 16 kHz mono PCM wav
+    """
+    job["audio_file"] = ensure_wav(job["wav_file"], job["settings"]["tmp_folder"])
+    return job
+
+
+def fetch_ranges(job):
+    """Whether the video of a job has to be fetched range by range, because its mp4 is missing
+
+    Raises:
+        FileNotFoundError: the mp4 is missing and no range downloader is configured
+    """
+    if os.path.exists(job["video_file"]):
+        return False
+    if job["settings"].get("range_downloader") is None:
+        raise FileNotFoundError(
+            f"{job['video_file']} is missing and there is no range downloader to fetch it"
+        )
+    return True
+
+
+def store_frames(frames, path, count):
+    """Write frames to an .npy file as they are decoded, so only one is in memory at a time
+
+    Args:
+        frames (iterable): (index into timestamps, frame) pairs
+        path (str): .npy file, row i holds the frame of timestamp i
+        count (int): number of timestamps
+
+    Returns:
+        list: indices of the timestamps a frame was written for
+    """
+    array, written = None, []
+    for idx, frame in frames:
+        if array is None:  # Frame size is known from the first frame
+            array = np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.uint8, shape=(count,) + frame.shape
+            )
+        array[idx] = frame
+        written.append(idx)
+    if array is not None:
+        array.flush()
+    return written
+
+
+def load_frames(job):
+    """Frames stored by extract_frames, read lazily from the memory-mapped file
+
+    Yields:
+        tuple: (index into timestamps, BGR frame)
+    """
+    if not job["frame_indices"]:
+        return
+    frames = np.load(job["frames_file"], mmap_mode="r")
+    for idx in job["frame_indices"]:
+        yield idx, np.asarray(frames[idx])
+
+
+def extract_frames(job):
+    """Decode the frames the face check needs in a single ffmpeg pass
+
+    Frames go to an .npy file in the tmp folder instead of the job, so they are neither pickled
+    back from the process pool nor held in the executor queues.
+    When the mp4 is missing (audio-only download) only a short clip starting at each
+    timestamp is downloaded, and the first frame of each clip is used.
+
+    Args:
+        job (dict): diarize job, "timestamps" is empty when no turn is waiting on a face check
+
+    Returns:
+        dict: the job with "frames_file" and "frame_indices", the timestamps it has a frame for
+    """
+    settings = job["settings"]
+    extractor = FrameExtractor(
+        frames_per_turn=settings["frames_per_turn"], max_height=settings["frame_max_height"]
+    )
+    job["frames_file"], job["frame_indices"] = None, []
+    if not job["timestamps"]:
+        return job
+    fd, job["frames_file"] = tempfile.mkstemp(
+        suffix=".npy", prefix=f"frames_{job['wav_name_no_ext']}_", dir=settings["tmp_folder"]
+    )
+    os.close(fd)
+    try:
+        return store_job_frames(job, extractor)
+    except Exception:
+        # Raised in the process pool, the executor's copy of the job has no frames file to remove
+        remove_file(job["frames_file"])
+        raise
+
+
+def store_job_frames(job, extractor):
+    """Decode the frames of a job into its frames file, see extract_frames"""
+    settings = job["settings"]
+    if not fetch_ranges(job):
+        frames = extractor.extract(job["video_file"], job["timestamps"])
+        job["frame_indices"] = store_frames(frames, job["frames_file"], len(job["timestamps"]))
+        return job
+
+    prefix = os.path.join(settings["tmp_folder"], f"frames_{job['wav_name_no_ext']}")
+    ranges = [(t, t + FRAME_CLIP_LEN) for t in job["timestamps"]]
+    clips = settings["range_downloader"].fetch(job["video_url"], ranges, prefix)
+    frames = (
+        (idx, frame)
+        for idx, clip in enumerate(clips)
+        if clip is not None  # No face can be found for this timestamp
+        for _, frame in extractor.extract(clip, [0.0])
+    )
+    job["frame_indices"] = store_frames(frames, job["frames_file"], len(job["timestamps"]))
+    for clip in set(clips) - {None}:
+        os.remove(clip)
+    return job
+
+
+def write_videos(job, videos):
+    """Write the video of the exported segments
+
+    Args:
+        job (dict): diarize job
+        videos (list): (out_filename, start, end) of every video segment to write
+    """
+    settings = job["settings"]
+    if not videos:
+        return
+    if not fetch_ranges(job):
+        # All segments of the video in one ffmpeg run
+        exporter = SegmentExporter(stream_copy=settings["stream_copy"])
+        exporter.cut(job["video_file"], videos)
+        return
+
+    # Audio-only mode: fetch just these ranges, each distinct range once
+    prefix = os.path.join(settings["tmp_folder"], f"segments_{job['wav_name_no_ext']}")
+    ranges = [(start, end) for _, start, end in videos]
+    clips = settings["range_downloader"].fetch(job["video_url"], ranges, prefix)
+    for (out_filename, _, _), clip in zip(videos, clips):
+        if clip is not None:
+            shutil.copyfile(clip, out_filename)
+    for clip in set(clips) - {None}:
+        os.remove(clip)
+
+
+def export_segments(job):
+    """Write the accepted turns (and their video) to the diarization folder
+
+    Args:
+        job (dict): diarize job with "turns" and the "accepted" mask
+
+    Returns:
+        dict: the job with "exported", the (path, start, end) of every written file
+    """
+    settings = job["settings"]
+    exported = []
+    videos = []
+    samples, sample_rate = audio_io.read_wav(job["audio_file"])
+    prefix = os.path.join(settings["diarization_folder"], job["name"], job["wav_name_no_ext"])
+
+    # Wavs are written in the background while the next turns are sliced and the video is cut
+    with audio_io.WavWriter() as writer:
+        for (start, end, _), accept in zip(job["turns"], job["accepted"]):
+            if not accept:
+                continue
+            segment = samples[int(start * sample_rate) : int(end * sample_rate)]
+            # Slice audio into multiple segments if exceed max length
+            if end - start >= settings["max_seg_len"]:
+                segment_chunks = audio_io.chunks(
+                    segment,
+                    int(settings["min_seg_len"] * sample_rate),
+                    min_tail=int(settings["chunk_min_tail"] * sample_rate),
+                    tail_policy=settings["chunk_tail_policy"],
+                )
+                for i, (offset, chunk) in enumerate(segment_chunks):
+                    chunk_start = start + offset / sample_rate
+                    chunk_end = chunk_start + len(chunk) / sample_rate
+                    chunk_name = f"{prefix}_{start}_{end}_{i}.wav"
+                    writer.write(chunk_name, chunk, sample_rate)
+                    exported.append((chunk_name, chunk_start, chunk_end))
+                    # Export the video of the same chunk as well
+                    if settings["export_video"] == "true":
+                        out_filename = f"{prefix}_{start}_{end}_{i}.mp4"
+                        videos.append((out_filename, chunk_start, chunk_end))
+            else:
+                # Export video segment as well
+                if settings["export_video"] == "true":
+                    out_filename = f"{prefix}_{start}_{end}.mp4"
+                    videos.append((out_filename, start, end))
+                writer.write(f"{prefix}_{start}_{end}.wav", segment, sample_rate)
+                exported.append((f"{prefix}_{start}_{end}.wav", start, end))
+
+        write_videos(job, videos)
+    exported.extend(video for video in videos if os.path.exists(video[0]))
+
+    cleanup(job)
+    job["exported"] = exported
+    return job
@@ -0,0 +1,64 @@
+##############################################################################################
+"""
+Load the models once, for diarize.py, compare_speaker.py and the model server
+
+The heavy libraries (torch, speechbrain, pyannote and, through DeepFace, TensorFlow) are only
+imported here, when a model is actually loaded, so the scripts start fast for --help, re-scoring
+or when the work is sent to a running model server. DeepFace is skipped entirely when the face
+check is off.
+"""
+##############################################################################################
+
+from speaker_embedding import SpeakerEmbedder, get_device
+
+SPEECHBRAIN_MODEL = "/models/speechbrain"
+PYANNOTE_CONFIG = "/models/pyannote/config.yaml"
+
+
+class ModelSet:
+    def __init__(
+        self,
+        device=None,
+        batch_size=16,
+        face_threshold=0.40,
+        speaker=True,
+        face=True,
+        diarization=True,
+    ):
+        """Load the requested models on one device
+
+        Args:
+            device (str, optional): torch device. Defaults to DEVICE or autodetect.
+            batch_size (int, optional): Faces per embedding pass. Defaults to 16.
+            face_threshold (float, optional): Max cosine distance of a matching face. Defaults to 0.40.
+            speaker (bool, optional): Load speechbrain. Defaults to True.
+            face (bool, optional): Load DeepFace. Defaults to True.
+            diarization (bool, optional): Load the pyannote pipeline. Defaults to True.
+        """
+        self.device = get_device(device)
+        self.spkr_embed_model = None
+        self.spkr_embedder = None
+        self.face_verifier = None
+        self.pipeline = None
+
+        if speaker:
+            from speechbrain.pretrained import SpeakerRecognition
+
+            self.spkr_embed_model = SpeakerRecognition.from_hparams(
+                SPEECHBRAIN_MODEL, run_opts={"device": str(self.device)}
+            )
+            self.spkr_embedder = SpeakerEmbedder(self.spkr_embed_model)
+        if face:
+            from face_verification import FaceVerifier
+
+            self.face_verifier = FaceVerifier(
+                model_name="Facenet",
+                detector_backend="mtcnn",
+                threshold=face_threshold,
+                batch_size=batch_size,
+            )
+        if diarization:
+            from pyannote.audio import Pipeline
+
+            self.pipeline = Pipeline.from_pretrained(PYANNOTE_CONFIG)
+            self.pipeline.to(self.device)
@@ -0,0 +1,209 @@
+##############################################################################################
+"""
+Long-lived local model server holding speechbrain, pyannote and DeepFace warm
+
+python src/model_server.py [--port 8765]
+
+Jobs are posted as JSON to http://127.0.0.1:<port>/<job> (diarize, verify or compare) and run
+one at a time on the loaded models. diarize.py and compare_speaker.py send their work here when
+MODEL_SERVER_URL is set and the server answers, and fall back to loading the models themselves
+otherwise. The server only listens on localhost, paths in the jobs are paths on this machine.
+"""
+##############################################################################################
+
+import os
+import json
+import argparse
+import threading
+import traceback
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def request(job, payload, url=None, timeout=None):
+    """Run a job on the model server
+
+    Args:
+        job (str): diarize, verify or compare
+        payload (dict): job arguments
+        url (str, optional): server address. Defaults to MODEL_SERVER_URL.
+        timeout (float, optional): seconds to wait for the result. Defaults to no limit.
+
+    Returns:
+        dict: the job result, None when no server is configured or reachable, so the caller
+            runs the job in-process instead
+    """
+    url = url or os.getenv("MODEL_SERVER_URL")
+    if not url:
+        return None
+    req = urllib.request.Request(
+        f"{url.rstrip('/')}/{job}",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:  # The server ran the job and it failed
+        raise RuntimeError(f"Model server failed on {job}: {e.read().decode('utf-8')}")
+    except (urllib.error.URLError, ConnectionError) as e:
+        print(f"Model server at {url} not reachable ({e}), running in-process")
+        return None
+
+
+class ModelServer:
+    def __init__(self, device=None, batch_size=16):
+        """Load the models once
+
+        Args:
+            device (str, optional): torch device. Defaults to DEVICE or autodetect.
+            batch_size (int, optional): Segments per embedding pass. Defaults to 16.
+        """
+        from cascade import cascade_stages
+        from model_loader import ModelSet
+
+        self.batch_size = batch_size
+        self.models = ModelSet(
+            device,
+            batch_size=batch_size,
+            face_threshold=float(os.getenv("FACE_THRESHOLD", "0.40")),
+            face="face" in cascade_stages(),
+        )
+        # Jobs share the models (and the GPU), so they run one at a time
+        self.lock = threading.Lock()
+        self.jobs = {"diarize": self.diarize, "verify": self.verify, "compare": self.compare}
+
+    def run_job(self, job, payload):
+        with self.lock:
+            return self.jobs[job](payload)
+
+    def diarize(self, payload):
+        """diarize.py on a POI file, payload holds its command line options"""
+        from diarize import Diarization
+        from instrumentation import Metrics
+        from pipeline_state import PipelineState
+
+        metrics = Metrics("diarize", folder=os.getenv("METRICS_FOLDER"))
+        diarization = Diarization(
+            payload["file"],
+            batch_size=payload.get("batch_size", self.batch_size),
+            state=PipelineState(
+                os.path.join(os.getenv("CACHE_FOLDER"), "pipeline_state.sqlite")
+            ),
+            models=self.models,
+            metrics=metrics,
+        )
+        try:
+            diarization.process_pois(
+                workers=payload.get("workers", 1),
+                model_workers=payload.get("model_workers", 1),
+                queue_size=payload.get("queue_size", 4),
+            )
+        finally:
+            metrics.close()
+        return {"summary": f"{diarization.cascade.summary()}\n{metrics.summary()}"}
+
+    def verify(self, payload):
+        """Score time ranges of an audio file against a folder of reference wavs
+
+        Payload: {"audio": path, "ref": folder, "segments": [[start, end], ...],
+        "method": "centroid" | "topk"}
+        """
+        import numpy as np
+        import audio_io
+        import media_tasks
+        from compare_speaker import reference_files
+
+        refs = reference_files(payload["ref"])
+        wav_file = media_tasks.ensure_wav(payload["audio"], os.getenv("TMP_FOLDER"))
+        samples, sample_rate = audio_io.read_wav(wav_file)
+        segments = [
+            samples[int(start * sample_rate) : int(end * sample_rate)]
+            for start, end in payload["segments"]
+        ]
+        embedder = self.models.spkr_embedder
+        profile = np.asarray(
+            embedder.enroll(os.path.basename(os.path.normpath(payload["ref"])), refs)
+        )
+        embeddings = embedder.embed_batch(
+            segments, sample_rate=sample_rate, batch_size=self.batch_size
+        )
+        scores, predictions = embedder.score_profile(
+            profile, embeddings, method=payload.get("method", "centroid")
+        )
+        if wav_file != payload["audio"]:
+            os.remove(wav_file)
+        return {"scores": scores.tolist(), "predictions": predictions.tolist()}
+
+    def compare(self, payload):
+        """compare_speaker.py, payload holds its command line options"""
+        from compare_speaker import CompareSpeaker, diarize, reference_files
+
+        refs = reference_files(payload["ref"])
+        diarization_res = diarize(
+            payload["audio"], pipeline=self.models.pipeline, embedder=self.models.spkr_embedder
+        )
+        timeline = CompareSpeaker(models=self.models).iterate_timestamps(
+            refs,
+            payload["audio"],
+            diarization_res,
+            resolution=payload.get("resolution", 5),
+            method=payload.get("method", "mean"),
+            hop=payload.get("hop"),
+            top_k=payload.get("top_k", 3),
+            batch_size=payload.get("batch_size", self.batch_size),
+        )
+        return {"timeline": timeline.to_dict(orient="records")}
+
+
+def make_handler(model_server):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.reply(200, {"status": "ok", "jobs": sorted(model_server.jobs)})
+            else:
+                self.reply(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            job = self.path.strip("/")
+            if job not in model_server.jobs:
+                self.reply(404, {"error": f"Unknown job {job}"})
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                self.reply(200, model_server.run_job(job, payload))
+            except Exception as e:
+                traceback.print_exc()
+                self.reply(500, {"error": f"{type(e).__name__}: {e}"})
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--port", type=int, default=int(os.getenv("MODEL_SERVER_PORT", "8765"))
+    )
+    parser.add_argument("--device", type=str, default=os.getenv("DEVICE"))
+    parser.add_argument(
+        "--batch-size", type=int, default=int(os.getenv("EMBED_BATCH_SIZE", "16"))
+    )
+    args = parser.parse_args()
+
+    model_server = ModelServer(device=args.device, batch_size=args.batch_size)
+    httpd = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(model_server))
+    print(f"Model server listening on http://127.0.0.1:{args.port}")
+    httpd.serve_forever()
@@ -0,0 +1,238 @@
+##############################################################################################
+"""
+This script will run link search, download, diarization and export of every POI as one stream
+
+python src/pipeline.py --file poi_list.csv
+
+Instead of each script finishing every POI before the next one starts, jobs flow through bounded
+queues: a POI's first video is diarized while its later videos are still downloading and the
+next POIs are still being searched. Every stage has its own concurrency. Search progress, the
+download state and the media store are the same ones the separate scripts use, so the two ways
+of running can be mixed. Search and download are injected (search_fn, ydl_factory), so stubs
+can stand in for YouTube to run the whole pipeline offline.
+"""
+##############################################################################################
+
+import os
+import re
+import argparse
+import threading
+from tqdm import tqdm
+from dotenv import load_dotenv
+from candidate_filter import CandidateFilter
+from diarize import Diarization
+from executor import PipelinedExecutor, Stage
+from instrumentation import Metrics, profiled, profile_path
+from pipeline_state import PipelineState
+from video_link_scrapper import VideoLinkScrapper
+from video_scrapper import VideoScrapper, video_id
+
+load_dotenv()
+
+
+class Pipeline:
+    def __init__(
+        self,
+        link_scrapper,
+        video_scrapper,
+        diarization,
+        search_workers=4,
+        download_workers=4,
+        workers=1,
+        model_workers=1,
+        queue_size=4,
+    ):
+        """Connect the stages of the separate scripts
+
+        Args:
+            link_scrapper (VideoLinkScrapper): searches the videos of a POI
+            video_scrapper (VideoScrapper): downloads a video into the media store
+            diarization (Diarization): diarizes and exports the wavs, its metrics are shared
+            search_workers (int, optional): Names searched concurrently. Defaults to 4.
+            download_workers (int, optional): Concurrent downloads. Defaults to 4.
+            workers (int, optional): Processes for decode, frame extraction and export. Defaults to 1.
+            model_workers (int, optional): Model-holding workers. Defaults to 1.
+            queue_size (int, optional): Jobs queued in front of each stage. Defaults to 4.
+        """
+        self.link_scrapper = link_scrapper
+        self.video_scrapper = video_scrapper
+        self.diarization = diarization
+        self.search_workers = search_workers
+        self.download_workers = download_workers
+        self.workers = workers
+        self.model_workers = model_workers
+        self.queue_size = queue_size
+        self.metrics = diarization.metrics
+        self.searched = link_scrapper.load_progress()
+        # One lock per video, a video found for several POIs is downloaded once and then linked
+        self.video_locks = {}
+        self.video_locks_guard = threading.Lock()
+
+    def search(self, name):
+        """Search stage: one download task per video found for a POI
+
+        Args:
+            name (str): POI name as written in the CSV, used as the query term
+
+        Yields:
+            dict: download task with "url", "name" and "names"
+        """
+        poi = re.sub(r"[^A-Za-z0-9 ]+", "", name)  # Strip special characters from name
+        self.video_scrapper.create_directory(poi)
+        self.diarization.create_directory(poi)
+        urls = self.searched.get(name)
+        if urls is None:  # Not searched by an earlier run
+            urls = self.link_scrapper.search_name(name)
+            self.link_scrapper.save_progress(name, urls)
+        for url in urls:
+            yield {"url": url, "name": poi, "names": [poi]}
+
+    def download(self, task):
+        """Download stage: put the video in the store and link it into the POI folder
+
+        Returns:
+            dict: POI name and wav filepath, None when the video was rejected or failed
+        """
+        vid = video_id(task["url"])
+        scrapper = self.video_scrapper
+        with self.video_locks_guard:
+            lock = self.video_locks.setdefault(vid, threading.Lock())
+        with lock:
+            if scrapper.store.has(vid):
+                scrapper.store.link(vid, os.path.join(scrapper.video_dir, task["name"]))
+            elif scrapper.state and scrapper.state.download_status(task["url"]) == "rejected":
+                return None  # Probed before and the POI was not heard
+            elif scrapper.scheduler.attempt(task)["status"] != "done":
+                return None  # Retried, recorded in the manifest and printed by the scheduler
+        wav_file = os.path.join(scrapper.video_dir, task["name"], f"{vid}.wav")
+        if not os.path.exists(wav_file):  # The probe did not hear this POI
+            return None
+        return {"name": task["name"], "wav_file": wav_file}
+
+    def prepare(self, download):
+        """Turn a downloaded wav into a diarize job, None when the state has it as done"""
+        return self.diarization.make_job(download["name"], download["wav_file"])
+
+    def run(self, names):
+        """Stream every POI through search, download and diarization
+
+        Args:
+            names (list): POI names as written in the CSV
+        """
+        executor = PipelinedExecutor(
+            [
+                # Named apart from the "search" and "download" timers of the calls inside them
+                Stage("links", self.search, self.search_workers, kind="thread", fan_out=True),
+                Stage("videos", self.download, self.download_workers, kind="thread"),
+                Stage("prepare", self.prepare, kind="thread"),
+            ]
+            + self.diarization.stages(workers=self.workers, model_workers=self.model_workers),
+            queue_size=self.queue_size,
+            metrics=self.metrics,
+            on_error=self.diarization.discard,
+        )
+        for job in tqdm(executor.run(names)):
+            self.diarization.mark_done(job)
+        for stage, job, error in executor.errors:
+            if "wav_file" in job and "settings" in job:  # A diarize job
+                self.diarization.record_error(stage, job, error)
+
+        if self.link_scrapper.rejected:
+            print(f"Rejected before download: {dict(self.link_scrapper.rejected)}")
+        print(self.diarization.cascade.summary())
+        print(self.metrics.summary())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", type=str, required=True)
+    parser.add_argument(
+        "--search-workers", type=int, default=int(os.getenv("SEARCH_WORKERS", "4"))
+    )
+    parser.add_argument(
+        "--rate", type=float, default=float(os.getenv("SEARCH_RATE", "2"))
+    )
+    parser.add_argument(
+        "--min-name-score",
+        type=float,
+        default=float(os.getenv("SEARCH_MIN_NAME_SCORE", "0.5")),
+    )
+    parser.add_argument(
+        "--language", type=str, default=os.getenv("SEARCH_LANGUAGE") or None
+    )
+    parser.add_argument(
+        "--download-workers", type=int, default=int(os.getenv("DOWNLOAD_WORKERS", "4"))
+    )
+    parser.add_argument(
+        "--per-host", type=int, default=int(os.getenv("DOWNLOAD_PER_HOST", "2"))
+    )
+    parser.add_argument(
+        "--retries", type=int, default=int(os.getenv("DOWNLOAD_RETRIES", "3"))
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=int(os.getenv("EMBED_BATCH_SIZE", "16"))
+    )
+    parser.add_argument("--device", type=str, default=os.getenv("DEVICE"))
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("DECODE_WORKERS", "1"))
+    )
+    parser.add_argument(
+        "--model-workers", type=int, default=int(os.getenv("MODEL_WORKERS", "1"))
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+    )
+    # Write cProfile stats of the run to <METRICS_FOLDER>/pipeline.prof
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+
+    poi_filename = os.path.join(os.getenv("POI_FOLDER"), args.file)
+    state = PipelineState(os.path.join(os.getenv("CACHE_FOLDER"), "pipeline_state.sqlite"))
+    metrics = Metrics("pipeline", folder=os.getenv("METRICS_FOLDER"))
+    with profiled(profile_path("pipeline", args.profile)):
+        try:
+            link_scrapper = VideoLinkScrapper(
+                args.file,
+                min_duration=60 * 1,
+                max_duration=60 * 10,
+                nrecords=15,
+                rate=args.rate,
+                candidate_filter=CandidateFilter(
+                    min_score=args.min_name_score, language=args.language
+                ),
+                metrics=metrics,
+            )
+            video_scrapper = VideoScrapper(
+                poi_filename,
+                video_dir=os.path.join(os.getenv("DATA_FOLDER"), os.getenv("VIDEO_FOLDER")),
+                scheduler_opts={
+                    "per_host": args.per_host,
+                    "retries": args.retries,
+                    "manifest_path": os.path.join(
+                        os.getenv("CACHE_FOLDER"), "download_manifest.jsonl"
+                    ),
+                },
+                state=state,
+                audio_only=os.getenv("AUDIO_ONLY") == "true",
+                metrics=metrics,
+            )
+            diarization = Diarization(
+                os.path.abspath(poi_filename),
+                batch_size=args.batch_size,
+                device=args.device,
+                state=state,
+                metrics=metrics,
+            )
+            pipeline = Pipeline(
+                link_scrapper,
+                video_scrapper,
+                diarization,
+                search_workers=args.search_workers,
+                download_workers=args.download_workers,
+                workers=args.workers,
+                model_workers=args.model_workers,
+                queue_size=args.queue_size,
+            )
+            pipeline.run(list(dict.fromkeys(diarization.df["Name"])))
+        finally:
+            metrics.close()
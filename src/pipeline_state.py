@@ -0,0 +1,139 @@
+##############################################################################################
+"""
+Resumable pipeline state kept in SQLite under CACHE_FOLDER
+
+Records which URLs were downloaded, which wavs were diarized (with their content hash and the
+settings used) and which segments each wav produced, so every stage only works on new or changed
+inputs instead of skipping a whole POI as soon as its folder exists.
+"""
+##############################################################################################
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+_hash_memo = {}
+_hash_lock = threading.Lock()
+
+
+def file_hash(path, block_size=1 << 20):
+    """sha1 of a file's content
+
+    Memoized per inode, so the links of one stored video in several POI folders are read once.
+    """
+    stat = os.stat(path)
+    inode = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        if inode in _hash_memo:
+            return _hash_memo[inode]
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    with _hash_lock:
+        _hash_memo[inode] = digest.hexdigest()
+    return _hash_memo[inode]
+
+
+class PipelineState:
+    def __init__(self, db_path):
+        """Open (or create) the state database
+
+        Args:
+            db_path (str): filepath of the SQLite database
+        """
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # Download workers record from their own threads, so serialize access with a lock
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS downloads (
+                    key TEXT PRIMARY KEY, name TEXT, status TEXT, path TEXT, hash TEXT,
+                    updated REAL
+                );
+                CREATE TABLE IF NOT EXISTS diarized (
+                    wav TEXT PRIMARY KEY, name TEXT, hash TEXT, params TEXT, updated REAL
+                );
+                CREATE TABLE IF NOT EXISTS segments (
+                    path TEXT PRIMARY KEY, wav TEXT, name TEXT, start REAL, end REAL
+                );
+                """
+            )
+
+    def download_done(self, key):
+        """Whether a download finished and its file (when known) is still on disk
+
+        Args:
+            key (str): URL, or URL plus clip range for reference clips
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, path FROM downloads WHERE key = ?", (key,)
+            ).fetchone()
+        return bool(row) and row[0] == "done" and (not row[1] or os.path.exists(row[1]))
+
+    def download_status(self, key):
+        """Last recorded status of a download, None when it was never attempted"""
+        with self.lock:
+            row = self.conn.execute("SELECT status FROM downloads WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def mark_download(self, key, name, status, path=None):
+        """Record the outcome of a download, hashing the produced file when there is one"""
+        content_hash = file_hash(path) if path and os.path.exists(path) else None
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?)",
+                (key, name, status, path, content_hash, time.time()),
+            )
+
+    def diarize_needed(self, wav, params):
+        """Whether a wav is new, changed, or was diarized with different settings
+
+        Args:
+            wav (str): filepath of the wav
+            params (dict): settings that affect which segments get accepted
+
+        Returns:
+            tuple: (needed, content hash of the wav)
+        """
+        content_hash = file_hash(wav)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT hash, params FROM diarized WHERE wav = ?", (wav,)
+            ).fetchone()
+        needed = row is None or row[0] != content_hash or row[1] != json.dumps(params, sort_keys=True)
+        return needed, content_hash
+
+    def previous_segments(self, wav):
+        """Segment files accepted the last time a wav was diarized"""
+        with self.lock:
+            rows = self.conn.execute("SELECT path FROM segments WHERE wav = ?", (wav,)).fetchall()
+        return [row[0] for row in rows]
+
+    def mark_diarized(self, wav, name, content_hash, params, segments):
+        """Record a finished wav and the segments it produced
+
+        Args:
+            wav (str): filepath of the wav
+            name (str): Name of the POI
+            content_hash (str): hash returned by diarize_needed
+            params (dict): settings the wav was diarized with
+            segments (list): (path, start, end) of every exported file
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM segments WHERE wav = ?", (wav,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?)",
+                [(path, wav, name, start, end) for path, start, end in segments],
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO diarized VALUES (?, ?, ?, ?, ?)",
+                (wav, name, content_hash, json.dumps(params, sort_keys=True), time.time()),
+            )
@@ -0,0 +1,91 @@
+##############################################################################################
+"""
+On-disk cache of diarization output and per-turn verification scores
+
+Turns are stored as RTTM keyed by the content hash of the audio, so the pyannote pipeline runs
+once per unique recording. Per-turn voice scores and per-frame face distances are stored per
+(audio, POI reference), so thresholds can be re-tuned and segments re-selected without any model.
+"""
+##############################################################################################
+
+import os
+import hashlib
+import numpy as np
+
+
+class DiarizationCache:
+    def __init__(self, cache_folder):
+        """Initialize the cache
+
+        Args:
+            cache_folder (str): Root cache folder (CACHE_FOLDER)
+        """
+        self.cache_dir = os.path.join(cache_folder, "diarization_results")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def turns_path(self, content_hash):
+        return os.path.join(self.cache_dir, f"{content_hash}.rttm")
+
+    def scores_path(self, content_hash, reference_key):
+        key = hashlib.sha1(reference_key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{content_hash}_{key}.npz")
+
+    def load_turns(self, content_hash):
+        """Cached turns of a recording
+
+        Returns:
+            list: (start, end, label) tuples, None when the recording was never diarized
+        """
+        path = self.turns_path(content_hash)
+        if not os.path.exists(path):
+            return None
+        turns = []
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                start, duration = float(fields[3]), float(fields[4])
+                # The exact end is kept in the orthography field, start + duration can differ
+                # in the last digits and the end ends up in segment filenames
+                end = float(fields[5]) if fields[5] != "<NA>" else start + duration
+                turns.append((start, end, fields[7]))
+        return turns
+
+    def save_turns(self, content_hash, turns):
+        """Write turns as RTTM, with the end time in the unused orthography field
+
+        Args:
+            content_hash (str): hash of the audio content
+            turns (list): (start, end, label) tuples
+        """
+        path = self.turns_path(content_hash)
+        with open(f"{path}.tmp", "w") as f:
+            for start, end, label in turns:
+                f.write(
+                    f"SPEAKER {content_hash} 1 {start} {end - start} {end} <NA> {label} <NA> <NA>\n"
+                )
+        os.replace(f"{path}.tmp", path)
+
+    def load_scores(self, content_hash, reference_key):
+        """Cached scores of a recording against a POI reference
+
+        Returns:
+            dict: arrays saved by save_scores, None when missing
+        """
+        path = self.scores_path(content_hash, reference_key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+
+    def save_scores(self, content_hash, reference_key, **arrays):
+        """Store per-turn score arrays, NaN marks a check that never ran on that turn
+
+        Args:
+            content_hash (str): hash of the audio content
+            reference_key (str): identifies the POI reference (name and reference file hashes)
+            **arrays: arrays to store, e.g. voice_scores and face_distances
+        """
+        path = self.scores_path(content_hash, reference_key)
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,85 @@
+##############################################################################################
+"""
+Cut many segments out of one video with a single ffmpeg run
+
+Every segment becomes its own input-seeked input and output of the same ffmpeg command, so a
+video with N accepted segments costs one process start and one seek per segment instead of N
+separate ffmpeg runs. With stream copy nothing is re-encoded; cuts then snap to the keyframe
+at or before each start, which is fine when exact boundaries are not needed. The length is
+capped on the output side so the keyframe pre-roll does not make a clip longer than its request,
+and clips that still overrun by more than about one GOP are reported.
+"""
+##############################################################################################
+
+import os
+import ffmpeg
+
+# Seconds a stream-copied clip may exceed its request, about one GOP of a YouTube encode
+MAX_COPY_OVERRUN = 2.0
+
+
+class SegmentExporter:
+    def __init__(self, stream_copy=False, max_outputs=32):
+        """Initialize the exporter
+
+        Args:
+            stream_copy (bool, optional): Copy the streams instead of re-encoding them, cuts
+                become keyframe-aligned. Defaults to False.
+            max_outputs (int, optional): Segments per ffmpeg run, bounds the open decoders and
+                the length of the command line. Defaults to 32.
+        """
+        self.stream_copy = stream_copy
+        self.max_outputs = max_outputs
+
+    def output(self, video_file, out_filename, start, end):
+        if self.stream_copy:
+            # Copied packets from the keyframe before start would otherwise get negative times.
+            # An input -t counts from the seek point and keeps all of that pre-roll on top, the
+            # output -t caps what is written.
+            stream = ffmpeg.input(video_file, ss=start)
+            return stream.output(
+                out_filename, t=end - start, c="copy", avoid_negative_ts="make_zero"
+            )
+        return ffmpeg.input(video_file, ss=start, t=end - start).output(out_filename)
+
+    def check_copies(self, segments):
+        """Warn about stream-copied clips much longer than requested
+
+        Returns:
+            list: (out_filename, requested seconds, written seconds) of every overrunning clip
+        """
+        overruns = []
+        for out_filename, start, end in segments:
+            if not os.path.exists(out_filename):
+                continue
+            try:
+                duration = float(ffmpeg.probe(out_filename)["format"]["duration"])
+            except (ffmpeg.Error, KeyError, ValueError):
+                continue
+            if duration > end - start + MAX_COPY_OVERRUN:
+                print(
+                    f"Stream-copied {out_filename} is {duration:.2f}s for a "
+                    f"{end - start:.2f}s segment, set EXPORT_STREAM_COPY=false for exact cuts"
+                )
+                overruns.append((out_filename, end - start, duration))
+        return overruns
+
+    def cut(self, video_file, segments):
+        """Write every segment of a video
+
+        Args:
+            video_file (str): filepath of the source video
+            segments (list): (out_filename, start, end) tuples, start and end in seconds
+
+        Returns:
+            list: the out_filenames that were written
+        """
+        if not segments or not os.path.exists(video_file):
+            return []
+        for i in range(0, len(segments), self.max_outputs):
+            batch = segments[i : i + self.max_outputs]
+            outputs = [self.output(video_file, *segment) for segment in batch]
+            ffmpeg.merge_outputs(*outputs).run(overwrite_output=True, quiet=True)
+        if self.stream_copy:
+            self.check_copies(segments)
+        return [out_filename for out_filename, _, _ in segments if os.path.exists(out_filename)]
@@ -0,0 +1,313 @@
+##############################################################################################
+"""
+Per-POI index of the speaker embedding and audio fingerprint of every exported segment
+
+python src/segment_index.py --name "<poi>" --ref <wav or folder of wavs> [--top 20]
+
+diarize.py adds every accepted turn to the index of its POI and drops turns that are near
+duplicates of indexed ones (re-uploads and clips of the same speech under another video id):
+the durations must be close, the speaker embedding must be nearly identical and the fingerprints
+must match. The fingerprint follows the content over time, 32 bits per 16 ms hop from the signs
+of band energy differences (Haitsma & Kalker), compared by bit error rate at the best alignment,
+so two different turns of the same speaker and channel do not match. The index is one file,
+<CACHE_FOLDER>/segment_index/<poi>/index.npz, searched exactly with one matrix product, so
+ranking the whole collected corpus against new reference audio takes milliseconds once the
+reference is embedded.
+"""
+##############################################################################################
+
+import os
+import json
+import argparse
+import threading
+import numpy as np
+from glob import glob
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FINGERPRINT_FRAME = 0.064
+FINGERPRINT_HOP = 0.016
+# 33 log-spaced bands between these frequencies give 32 bits per hop
+FINGERPRINT_BANDS = (300.0, 2000.0, 33)
+# Max shift (seconds) between two copies of the same speech, turn boundaries differ per upload
+MAX_SHIFT = 1.0
+# Max relative difference in length between duplicates
+DURATION_TOLERANCE = 0.1
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def fingerprint(samples, sample_rate):
+    """Time-ordered fingerprint of a segment, one 32-bit word per hop
+
+    Bit m of hop n is set when the energy difference of bands m and m+1 grew since hop n-1.
+
+    Args:
+        samples (np.ndarray): int16 samples
+        sample_rate (int): sample rate
+
+    Returns:
+        np.ndarray: uint32 array, empty for segments shorter than two frames
+    """
+    frame_len = int(FINGERPRINT_FRAME * sample_rate)
+    hop = int(FINGERPRINT_HOP * sample_rate)
+    num_frames = (len(samples) - frame_len) // hop + 1
+    if num_frames < 2:
+        return np.zeros(0, dtype=np.uint32)
+    samples = np.ascontiguousarray(samples, dtype=np.float32)
+    frames = np.lib.stride_tricks.as_strided(
+        samples,
+        shape=(num_frames, frame_len),
+        strides=(samples.strides[0] * hop, samples.strides[0]),
+        writeable=False,
+    )
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(frame_len), axis=1)) ** 2
+    low, high, bands = FINGERPRINT_BANDS
+    edges = np.geomspace(low, high, bands + 1) * frame_len / sample_rate
+    edges = np.round(edges).astype(int)
+    energy = np.add.reduceat(spectrum[:, : edges[-1]], edges[:-1], axis=1)
+    difference = energy[:, :-1] - energy[:, 1:]
+    bits = (difference[1:] - difference[:-1]) > 0
+    words = bits.astype(np.uint64) << np.arange(bits.shape[1], dtype=np.uint64)
+    return words.sum(axis=1).astype(np.uint32)
+
+
+def fingerprint_similarity(a, b, max_shift=MAX_SHIFT):
+    """1 - bit error rate of two fingerprints at their best alignment
+
+    Args:
+        a (np.ndarray): fingerprint
+        b (np.ndarray): fingerprint
+        max_shift (float, optional): Max shift in seconds tried. Defaults to MAX_SHIFT.
+
+    Returns:
+        float: 1 for identical content, about 0.5 for unrelated audio
+    """
+    # The shorter one must overlap the other by at least half of its length
+    min_overlap = max(1, min(len(a), len(b)) // 2)
+    best = 0.0
+    shifts = int(max_shift / FINGERPRINT_HOP)
+    for shift in range(-shifts, shifts + 1):
+        x = a[shift:] if shift >= 0 else a
+        y = b if shift >= 0 else b[-shift:]
+        overlap = min(len(x), len(y))
+        if overlap < min_overlap:
+            continue
+        errors = POPCOUNT[np.bitwise_xor(x[:overlap], y[:overlap]).view(np.uint8)].sum()
+        best = max(best, 1.0 - errors / (32.0 * overlap))
+    return best
+
+
+class SegmentIndex:
+    def __init__(self, index_dir):
+        """Load the index of one POI, or start an empty one
+
+        Args:
+            index_dir (str): folder of the index, <CACHE_FOLDER>/segment_index/<poi>
+        """
+        self.index_dir = index_dir
+        self.path = os.path.join(index_dir, "index.npz")
+        self.embeddings = np.zeros((0, 0), dtype=np.float32)
+        self.fingerprints = []
+        self.entries = []
+        # Ids stay valid when other segments are removed, they are never reused
+        self.next_id = 0
+        self.rows = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with np.load(self.path) as data:
+                self.embeddings = data["embeddings"]
+                lengths = data["fingerprint_lengths"]
+                self.fingerprints = np.split(data["fingerprints"], np.cumsum(lengths)[:-1])
+                self.entries = json.loads(str(data["entries"]))
+                self.next_id = int(data["next_id"])
+            self.fingerprints = self.fingerprints[: len(self.entries)]
+        self.update_rows()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update_rows(self):
+        self.rows = {entry["id"]: row for row, entry in enumerate(self.entries)}
+
+    def durations(self):
+        return np.array([entry["end"] - entry["start"] for entry in self.entries])
+
+    def find_duplicate(self, row, queries, indexed, candidates, threshold, fingerprint_threshold):
+        """First indexed segment a query segment duplicates
+
+        Args:
+            row (int): query segment
+            queries (tuple): (embeddings, fingerprints, durations) of the query segments
+            indexed (tuple): (embeddings, fingerprints, durations) to look in
+            candidates (list): positions in indexed to consider
+            threshold (float): Min embedding similarity
+            fingerprint_threshold (float): Min fingerprint similarity
+
+        Returns:
+            int: position in indexed, -1 when there is none
+        """
+        embeddings, fingerprints, durations = queries
+        index_embeddings, index_fingerprints, index_durations = indexed
+        candidates = np.asarray(candidates, dtype=int)
+        if not len(candidates):
+            return -1
+        close = (
+            np.abs(durations[row] - index_durations[candidates])
+            <= DURATION_TOLERANCE * index_durations[candidates]
+        )
+        # A zero embedding is one that was never computed (re-scoring without models)
+        similarity = index_embeddings[candidates] @ embeddings[row]
+        unknown = ~embeddings[row].any() | ~index_embeddings[candidates].any(axis=1)
+        for k in np.flatnonzero(close & ((similarity >= threshold) | unknown)):
+            other = index_fingerprints[candidates[k]]
+            if fingerprint_similarity(fingerprints[row], other) >= fingerprint_threshold:
+                return int(candidates[k])
+        return -1
+
+    def add(self, embeddings, fingerprints, entries, threshold=0.0, fingerprint_threshold=0.65):
+        """Add segments, leaving out near duplicates of indexed ones and of each other
+
+        The check and the insert happen under one lock, so two jobs with the same speech
+        running at once cannot both get in.
+
+        Args:
+            embeddings (np.ndarray): (n, dim) normalized speaker embeddings, zero rows for
+                segments that were not embedded, which then match on the fingerprint alone
+            fingerprints (list): fingerprint() of each segment
+            entries (list): one dict per segment with at least "start" and "end"
+            threshold (float, optional): Min embedding similarity of a duplicate, 0 keeps every
+                segment. Defaults to 0.
+            fingerprint_threshold (float, optional): Min fingerprint similarity of a duplicate.
+                Defaults to 0.65.
+
+        Returns:
+            tuple: (ids of the added segments, -1 for duplicates; ids of the indexed segment each
+                one duplicates, -1 for added ones)
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(entries), -1)
+        durations = np.array([entry["end"] - entry["start"] for entry in entries])
+        with self.lock:
+            # Segments indexed or added without any embedding have no width yet
+            if not embeddings.shape[1] and len(self.embeddings):
+                embeddings = np.zeros((len(entries), self.embeddings.shape[1]), np.float32)
+            if not self.embeddings.shape[1] and embeddings.shape[1]:
+                self.embeddings = np.zeros((len(self.entries), embeddings.shape[1]), np.float32)
+
+            queries = (embeddings, fingerprints, durations)
+            indexed = (self.embeddings, self.fingerprints, self.durations())
+            ids, duplicate_of, added = [-1] * len(entries), [-1] * len(entries), []
+            for row in range(len(entries)):
+                if threshold > 0:
+                    found = self.find_duplicate(
+                        row,
+                        queries,
+                        indexed,
+                        range(len(self.entries)),
+                        threshold,
+                        fingerprint_threshold,
+                    )
+                    if found >= 0:
+                        duplicate_of[row] = self.entries[found]["id"]
+                        continue
+                    # Earlier rows of the same call win over later ones
+                    found = self.find_duplicate(
+                        row, queries, queries, added, threshold, fingerprint_threshold
+                    )
+                    if found >= 0:
+                        duplicate_of[row] = ids[found]
+                        continue
+                ids[row] = self.next_id
+                self.next_id += 1
+                added.append(row)
+
+            if added:
+                self.embeddings = np.concatenate([self.embeddings, embeddings[added]])
+                self.fingerprints.extend(fingerprints[row] for row in added)
+                self.entries.extend(dict(entries[row], id=ids[row], files=[]) for row in added)
+                self.update_rows()
+        return ids, duplicate_of
+
+    def remove_source(self, source):
+        """Drop the segments of a recording, before it is diarized again"""
+        with self.lock:
+            keep = [i for i, entry in enumerate(self.entries) if entry["source"] != source]
+            if len(keep) == len(self.entries):
+                return
+            self.embeddings = self.embeddings[keep]
+            self.fingerprints = [self.fingerprints[i] for i in keep]
+            self.entries = [self.entries[i] for i in keep]
+            self.update_rows()
+
+    def attach(self, segment_id, path):
+        """Record an exported file of an indexed segment
+
+        Returns:
+            bool: False when the segment was removed since it was added
+        """
+        with self.lock:
+            if segment_id not in self.rows:
+                return False
+            self.entries[self.rows[segment_id]]["files"].append(path)
+            return True
+
+    def save(self):
+        """Write the index as one file, atomically, readers never see a partial index"""
+        os.makedirs(self.index_dir, exist_ok=True)
+        with self.lock:
+            arrays = {
+                "embeddings": self.embeddings,
+                "fingerprints": np.concatenate(self.fingerprints or [np.zeros(0, np.uint32)]),
+                "fingerprint_lengths": np.array([len(f) for f in self.fingerprints], dtype=int),
+                "entries": np.array(json.dumps(self.entries)),
+                "next_id": np.array(self.next_id),
+            }
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.path)
+
+    def search(self, query, top=20):
+        """Indexed segments most similar to a query embedding, exact cosine search
+
+        Args:
+            query (np.ndarray): (dim,) normalized embedding
+            top (int, optional): Number of results. Defaults to 20.
+
+        Returns:
+            list: (score, entry) pairs, best first
+        """
+        if not len(self.entries) or not self.embeddings.shape[1]:
+            return []
+        scores = self.embeddings @ query
+        top = min(top, len(scores))
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), self.entries[i]) for i in best]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--name", type=str, required=True)
+    # A reference wav, or a folder of them that is enrolled like the POI references
+    parser.add_argument("--ref", type=str, required=True)
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--device", type=str, default=os.getenv("DEVICE"))
+    args = parser.parse_args()
+
+    index = SegmentIndex(os.path.join(os.getenv("CACHE_FOLDER"), "segment_index", args.name))
+    if not len(index):
+        raise SystemExit(f"No indexed segments for {args.name}")
+
+    from model_loader import ModelSet
+
+    embedder = ModelSet(args.device, face=False, diarization=False).spkr_embedder
+    refs = sorted(glob(os.path.join(args.ref, "*.wav"))) if os.path.isdir(args.ref) else [args.ref]
+    query = np.asarray(
+        embedder.enroll(os.path.basename(os.path.normpath(args.ref)), refs)
+    )[0]
+    for score, entry in index.search(query, top=args.top):
+        # Segments indexed by a run that did not finish exporting have no files
+        location = f"{entry['source']} {entry['start']:.2f}-{entry['end']:.2f}"
+        for path in entry["files"] or [location]:
+            print(f"{score:.4f}  {path}")
@@ -0,0 +1,184 @@
+##############################################################################################
+"""
+Speaker embedding helpers shared by diarize.py and compare_speaker.py
+
+Reference embeddings are computed once per reference file and kept in the embedding cache, so
+verifying a segment only needs one embedding pass for the segment plus a cosine similarity.
+torch is imported where it is used, so importing this module (e.g. for a CLI --help) stays cheap.
+"""
+##############################################################################################
+
+import os
+import numpy as np
+import audio_io
+from embedding_cache import EmbeddingCache
+
+# Same decision threshold SpeakerRecognition.verify_files uses by default
+SPEECHBRAIN_THRESHOLD = 0.25
+
+
+def get_device(device=None):
+    """Resolve the torch device, falling back to CPU when CUDA is not available
+
+    Args:
+        device (str, optional): "cuda", "cpu", "cuda:1"... Defaults to DEVICE or autodetect.
+
+    Returns:
+        torch.device: device to run the models on
+    """
+    import torch
+
+    device = device or os.getenv("DEVICE")
+    if not device:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    elif device.startswith("cuda") and not torch.cuda.is_available():
+        print(f"CUDA not available, running on CPU instead of {device}")
+        device = "cpu"
+    return torch.device(device)
+
+
+class SpeakerEmbedder:
+    def __init__(self, spkr_embed_model, cache_folder=None):
+        """Wrap a speechbrain SpeakerRecognition model with a reference embedding cache
+
+        Args:
+            spkr_embed_model (SpeakerRecognition): Loaded speechbrain model
+            cache_folder (str, optional): Root cache folder. Defaults to CACHE_FOLDER.
+        """
+        self.model = spkr_embed_model
+        self.cache = EmbeddingCache(
+            cache_folder or os.getenv("CACHE_FOLDER"), "speaker"
+        )
+
+    def normalize(self, embeddings):
+        norm = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.maximum(norm, 1e-6)
+
+    def embed_file(self, path):
+        """Embed a wav file
+
+        Args:
+            path (str): filepath of the wav
+
+        Returns:
+            np.ndarray: L2-normalized embedding
+        """
+        import torch
+
+        waveform = self.model.load_audio(path)
+        with torch.no_grad():
+            embedding = self.model.encode_batch(waveform.unsqueeze(0))
+        return self.normalize(embedding.squeeze().cpu().numpy())
+
+    def load_waveform(self, item, sample_rate=None):
+        """Turn a segment into a float tensor, items are either a wav filepath or int16 samples"""
+        import torch
+
+        if isinstance(item, str):
+            return self.model.load_audio(item)
+        if sample_rate != self.model.audio_normalizer.sample_rate:
+            raise ValueError(
+                f"Expected {self.model.audio_normalizer.sample_rate} Hz audio, got {sample_rate} Hz"
+            )
+        return torch.from_numpy(audio_io.to_float(item))
+
+    def embed_batch(self, items, sample_rate=None, batch_size=16):
+        """Embed many segments in padded batches
+
+        Segments are bucketed by length before batching, so each batch holds segments of
+        similar duration and little compute is spent on padding.
+
+        Args:
+            items (list): wav filepaths or int16 sample arrays
+            sample_rate (int, optional): sample rate of the sample arrays
+            batch_size (int, optional): Number of segments per forward pass. Defaults to 16.
+
+        Returns:
+            np.ndarray: L2-normalized embeddings of shape (len(items), dim), in input order
+        """
+        import torch
+
+        def length(i):
+            return os.path.getsize(items[i]) if isinstance(items[i], str) else len(items[i])
+
+        embeddings = [None] * len(items)
+        order = sorted(range(len(items)), key=length)
+        for b in range(0, len(order), batch_size):
+            batch_idx = order[b : b + batch_size]
+            waveforms = [self.load_waveform(items[i], sample_rate) for i in batch_idx]
+            lengths = torch.tensor([len(w) for w in waveforms], dtype=torch.float32)
+            padded = torch.zeros(len(waveforms), int(lengths.max()))
+            for j, waveform in enumerate(waveforms):
+                padded[j, : len(waveform)] = waveform
+            with torch.no_grad():
+                batch = self.model.encode_batch(
+                    padded.to(self.model.device), lengths / lengths.max()
+                )
+            for j, embedding in zip(batch_idx, batch.squeeze(1).cpu().numpy()):
+                embeddings[j] = embedding
+        if not embeddings:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self.normalize(np.stack(embeddings))
+
+    def score_profile(self, profile, embeddings, method="centroid", top_k=3, cohort=None):
+        """Score embeddings against an enrolled POI profile
+
+        Args:
+            profile (np.ndarray): enroll() output, row 0 is the centroid, the rest the clips
+            embeddings (np.ndarray): normalized embeddings of shape (n, dim)
+            method (str, optional): "centroid" (one dot product per segment), "topk" (mean of the
+                top_k clip scores) or "snorm" (centroid score normalized against a cohort).
+                Defaults to "centroid".
+            top_k (int, optional): clips averaged by "topk". Defaults to 3.
+            cohort (np.ndarray, optional): centroids of other POIs, needed by "snorm"
+
+        Returns:
+            tuple: (scores, predictions), predictions use the raw centroid cosine like
+                SpeakerRecognition.verify_files
+
+        Raises:
+            ValueError: "snorm" with fewer than 2 cohort centroids, the raw cosine it would fall
+                back to is on another scale than a threshold tuned for s-norm
+        """
+        if method == "snorm" and (cohort is None or len(cohort) < 2):
+            raise ValueError("snorm scoring needs a cohort of at least 2 other POIs")
+        if len(embeddings) == 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=bool)
+        profile = np.asarray(profile)
+        raw = embeddings @ profile[0]
+        scores = raw
+        if method == "topk":
+            k = min(top_k, len(profile) - 1)
+            scores = np.sort(embeddings @ profile[1:].T, axis=1)[:, -k:].mean(axis=1)
+        elif method == "snorm":
+            # Symmetric normalization, both sides compared against the same impostor cohort
+            enroll_cohort = cohort @ profile[0]
+            test_cohort = embeddings @ cohort.T
+            scores = 0.5 * (
+                (raw - enroll_cohort.mean()) / max(enroll_cohort.std(), 1e-6)
+                + (raw - test_cohort.mean(axis=1)) / np.maximum(test_cohort.std(axis=1), 1e-6)
+            )
+        return scores, raw > SPEECHBRAIN_THRESHOLD
+
+    def enroll(self, name, paths):
+        """Enroll a POI from all of its reference clips
+
+        Args:
+            name (str): Name of the POI
+            paths (list): reference wav filepaths
+
+        Returns:
+            np.ndarray: (1 + len(paths), dim) array, the normalized centroid followed by the
+                per-clip embeddings, cached as one file that is rebuilt when any clip changes
+        """
+
+        def compute(paths):
+            clips = np.stack([self.embed_reference(path) for path in paths])
+            centroid = self.normalize(clips.mean(axis=0))
+            return np.concatenate([centroid[None], clips])
+
+        return self.cache.get_group(name, paths, compute)
+
+    def embed_reference(self, path):
+        """Embed a reference wav, reusing the cached embedding when the file has not changed"""
+        return self.cache.get(path, self.embed_file)
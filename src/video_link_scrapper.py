@@ -3,24 +3,67 @@
 This script will read the poi CSV and query the YT URLs with each POI name as the query term
 
 python src/video_link_scrapper.py --file poi_list.csv
+
+Names are searched concurrently under a shared rate limit. Every finished name is appended to
+<poi>_withurls.jsonl right away, so an interrupted run keeps its results and resumes from there.
 """
 ##############################################################################################
 
 import os
+import json
+import time
 import datetime
+import threading
 import scrapetube
 import argparse
 import pandas as pd
 from tqdm import tqdm
 from dotenv import load_dotenv
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from candidate_filter import CandidateFilter
+from instrumentation import Metrics, profiled, profile_path
 
 load_dotenv()
 
 BASE_YOUTUBE_URL = "https://www.youtube.com/watch?v="
 
 
+class RateLimiter:
+    def __init__(self, rate):
+        """Spaces out calls shared by several threads
+
+        Args:
+            rate (float): Max calls per second, 0 disables the limit
+        """
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the caller may issue its next call"""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
 class VideoLinkScrapper:
-    def __init__(self, poi_filename, min_duration, max_duration, nrecords=50):
+    def __init__(
+        self,
+        poi_filename,
+        min_duration,
+        max_duration,
+        nrecords=50,
+        workers=4,
+        rate=2.0,
+        search_limit=None,
+        search_fn=scrapetube.get_search,
+        candidate_filter=None,
+        metrics=None,
+    ):
         """Initializes the class to scrape youtube links
 
         Args:
@@ -28,6 +71,14 @@ class VideoLinkScrapper:
             min_duration (int): minimum allowable length of the audio (mins)
             max_duration (int): maximum allowable length of the audio (mins)
             nrecords (int, optional): Number of YT links to pull. Defaults to 50.
+            workers (int, optional): Names searched concurrently. Defaults to 4.
+            rate (float, optional): Max searches started per second. Defaults to 2.0.
+            search_limit (int, optional): Max search results looked at per name. Defaults to 5 * nrecords.
+            search_fn (callable, optional): search_fn(query, limit, sort_by) yielding video dicts.
+                Defaults to scrapetube.get_search, a fake generator can stand in for it.
+            candidate_filter (CandidateFilter, optional): Metadata checks a video must pass
+                before it counts towards nrecords.
+            metrics (Metrics, optional): Receives search timings and candidate outcomes.
         """
         self.poi_filename = os.path.join(os.getenv("POI_FOLDER"), poi_filename)
         self.df = None
@@ -35,7 +86,16 @@ class VideoLinkScrapper:
             os.getenv("POI_FOLDER"),
             os.path.basename(poi_filename).split(".")[0] + "_withurls.csv",
         )
+        self.progress_file = os.path.splitext(self.outfile)[0] + ".jsonl"
         self.nrecords = nrecords
+        self.search_limit = search_limit or 5 * nrecords
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.search_fn = search_fn
+        self.candidate_filter = candidate_filter
+        self.rejected = Counter()
+        self.metrics = metrics or Metrics("video_link_scrapper")
+        self.lock = threading.Lock()
         self.max_duration = max_duration
         self.min_duration = min_duration
 
@@ -75,43 +135,97 @@ class VideoLinkScrapper:
                 ).split(".")[0]
             )
 
-    def process_urls(self):
-        """Iterte through each name and query YT for the links via scrapetube"""
-        poi_names = self.df["Name"]
-        url_col = []
-        for name in tqdm(poi_names):
-            videos = scrapetube.get_search(
-                name, limit=self.nrecords, sort_by="relevance"
-            )
+    def video_seconds(self, video):
+        """Duration of a search result in seconds, None when it has no duration overlay (live, shorts)"""
+        overlays = video.get("thumbnailOverlays") or [{}]
+        if "thumbnailOverlayTimeStatusRenderer" not in overlays[0]:
+            return None
+        duration = overlays[0]["thumbnailOverlayTimeStatusRenderer"]["text"]["simpleText"]
+        return self.get_seconds(duration)
+
+    def load_progress(self):
+        """Names already searched in a previous (possibly interrupted) run
+
+        Returns:
+            dict: Name -> list of urls
+        """
+        done = {}
+        if os.path.exists(self.progress_file):
+            with open(self.progress_file) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Partial last line of a crashed run
+                    done[entry["Name"]] = entry["Urls"]
+        return done
+
+    def save_progress(self, name, video_urls):
+        """Append a searched name to the progress file, so it is not searched again"""
+        with self.lock:
+            with open(self.progress_file, "a") as f:
+                f.write(json.dumps({"Name": name, "Urls": video_urls}) + "\n")
+
+    def search_name(self, name):
+        """Query YT for one name, stopping once nrecords videos pass the duration and metadata checks
 
-            video_urls = []
+        Args:
+            name (str): POI name used as the query term
+
+        Returns:
+            list: video urls
+        """
+        self.rate_limiter.wait()
+        videos = self.search_fn(name, limit=self.search_limit, sort_by="relevance")
+
+        video_urls = []
+        # Results are fetched page by page while iterating, so the loop is the search time
+        with self.metrics.timer("search", poi=name):
             for video in videos:
-                if (
-                    "thumbnailOverlays" in video
-                    and "thumbnailOverlayTimeStatusRenderer"
-                    in video["thumbnailOverlays"][0]
-                ):
-                    duration = video["thumbnailOverlays"][0][
-                        "thumbnailOverlayTimeStatusRenderer"
-                    ]["text"]["simpleText"]
-                else:
+                seconds = self.video_seconds(video)
+                if not seconds or not self.min_duration <= seconds <= self.max_duration:
+                    self.metrics.add("candidates", 1, {"outcome": "duration"})
                     continue
+                if self.candidate_filter:
+                    _, reason = self.candidate_filter.check(name, video)
+                    if reason:
+                        with self.lock:
+                            self.rejected[reason] += 1
+                        self.metrics.add("candidates", 1, {"outcome": reason})
+                        continue
+                video_urls.append(BASE_YOUTUBE_URL + video["videoId"])
+                if len(video_urls) >= self.nrecords:
+                    break
+        self.metrics.add("candidates", len(video_urls), {"outcome": "accepted"})
+        self.metrics.event("poi", poi=name, urls=len(video_urls))
+        return video_urls
+
+    def process_urls(self):
+        """Search every name concurrently, appending each finished name to the progress JSONL file
 
-                seconds = self.get_seconds(duration)
+        Names found in the progress file are not searched again, so an interrupted run resumes
+        where it stopped. A name whose search fails is left out and retried on the next run.
+        """
+        done = self.load_progress()
+        pending = [name for name in dict.fromkeys(self.df["Name"]) if name not in done]
 
-                if (
-                    seconds
-                    and int(seconds) >= self.min_duration
-                    and int(seconds) <= self.max_duration
-                ):
-                    video_urls.append(BASE_YOUTUBE_URL + video["videoId"])
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self.search_name, name): name for name in pending}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                name = futures[future]
+                try:
+                    video_urls = future.result()
+                except Exception as e:
+                    print(f"{name}: {e}")
+                    self.metrics.error("search", e, poi=name)
+                    continue
+                done[name] = video_urls
+                self.save_progress(name, video_urls)
 
-            if url_col:
-                url_col.extend([video_urls])
-            else:
-                url_col = [video_urls]
+        if self.rejected:
+            print(f"Rejected before download: {dict(self.rejected)}")
         # Append new column to dataframe
-        self.df["Urls"] = url_col
+        self.df["Urls"] = [done.get(name, []) for name in self.df["Name"]]
 
     def export_df(self):
         self.df.to_csv(self.outfile, index=False)
@@ -120,15 +234,42 @@ class VideoLinkScrapper:
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--file", type=str, required=True)
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("SEARCH_WORKERS", "4"))
+    )
+    parser.add_argument(
+        "--rate", type=float, default=float(os.getenv("SEARCH_RATE", "2"))
+    )
+    parser.add_argument(
+        "--min-name-score",
+        type=float,
+        default=float(os.getenv("SEARCH_MIN_NAME_SCORE", "0.5")),
+    )
+    parser.add_argument(
+        "--language", type=str, default=os.getenv("SEARCH_LANGUAGE") or None
+    )
+    # Write cProfile stats of the run to <METRICS_FOLDER>/video_link_scrapper.prof
+    parser.add_argument("--profile", action="store_true")
     args = parser.parse_args()
 
     poi_filename = args.file
-    clsObj = VideoLinkScrapper(
-        poi_filename,
-        min_duration=60 * 1,
-        max_duration=60 * 10,
-        nrecords=15,
-    )
-    clsObj.read_poi_file()
-    clsObj.process_urls()
-    clsObj.export_df()
+    metrics = Metrics("video_link_scrapper", folder=os.getenv("METRICS_FOLDER"))
+    with profiled(profile_path("video_link_scrapper", args.profile)):
+        try:
+            clsObj = VideoLinkScrapper(
+                poi_filename,
+                min_duration=60 * 1,
+                max_duration=60 * 10,
+                nrecords=15,
+                workers=args.workers,
+                rate=args.rate,
+                candidate_filter=CandidateFilter(
+                    min_score=args.min_name_score, language=args.language
+                ),
+                metrics=metrics,
+            )
+            clsObj.read_poi_file()
+            clsObj.process_urls()
+            clsObj.export_df()
+        finally:
+            metrics.close()
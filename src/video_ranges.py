@@ -0,0 +1,69 @@
+##############################################################################################
+"""
+Fetch only some time ranges of a video, for the audio-only download mode
+
+When videos are downloaded as audio only, the frames for the face check and the video of the
+exported segments are fetched afterwards, range by range, with the same download_range_func
+mechanism download_ref_segments.py uses for reference clips. Only the seconds that are actually
+needed cross the network or land on disk.
+"""
+##############################################################################################
+
+import os
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import download_range_func
+
+# Max 720p, the face check downscales to FRAME_MAX_HEIGHT anyway
+VIDEO_FORMAT = "bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720]/best"
+
+
+class VideoRangeDownloader:
+    def __init__(self, video_format=VIDEO_FORMAT, ydl_factory=YoutubeDL):
+        """Initialize the downloader
+
+        It is handed to the process-pool tasks, so ydl_factory must be picklable (a module-level
+        class or function).
+
+        Args:
+            video_format (str, optional): yt-dlp format selector. Defaults to VIDEO_FORMAT.
+            ydl_factory (callable, optional): Builds the downloader from ydl_opts. Defaults to YoutubeDL.
+        """
+        self.video_format = video_format
+        self.ydl_factory = ydl_factory
+
+    def range_path(self, prefix, start, end):
+        return f"{prefix}_{start}_{end}.mp4"
+
+    def fetch(self, url, ranges, prefix):
+        """Download the given time ranges of a video in one yt-dlp run
+
+        Cuts are keyframe-forced, so every clip starts exactly at its range start and lines up
+        with the audio cut from the same range.
+
+        Args:
+            url (str): video URL
+            ranges (list): (start, end) tuples in seconds
+            prefix (str): path prefix of the clips, each is written to <prefix>_<start>_<end>.mp4
+
+        Returns:
+            list: filepath of the clip of each range, None for ranges that could not be fetched
+        """
+        ranges = [(round(float(start), 3), round(float(end), 3)) for start, end in ranges]
+        if not ranges:
+            return []
+        os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+        ydl_opts = {
+            "format": self.video_format,
+            "download_ranges": download_range_func(None, sorted(set(ranges))),
+            "force_keyframes_at_cuts": True,
+            "merge_output_format": "mp4",
+            "outtmpl": f"{prefix}_%(section_start)s_%(section_end)s.%(ext)s",
+            "quiet": True,
+            "noprogress": True,
+        }
+        with self.ydl_factory(ydl_opts) as ydl:
+            ydl.download([url])
+        return [
+            path if os.path.exists(path) else None
+            for path in (self.range_path(prefix, start, end) for start, end in ranges)
+        ]
@@ -1,7 +1,8 @@
 ##############################################################################################
 """
 This script will read the CSV containing the YT links and download only the audio related to 
-each video. The vdieos and audios are saved in data/videos/<poi>
+each video. The vdieos and audios are saved once per video in the media store and linked into
+data/videos/<poi>, so a video found for several POIs is only downloaded once
 
 python src/video_scrapper.py --file poi_list_withurls.csv
 """
@@ -13,9 +14,13 @@ import argparse
 import shutil
 import ast
 import pandas as pd
-from tqdm import tqdm
 from dotenv import load_dotenv
 from yt_dlp import YoutubeDL
+from urllib.parse import urlparse, parse_qs
+from download_scheduler import DownloadScheduler
+from pipeline_state import PipelineState
+from media_store import MediaStore
+from instrumentation import Metrics, file_size, profiled, profile_path
 
 load_dotenv()
 
@@ -36,17 +41,53 @@ class YTLogger:
         pass
 
 
+def video_id(url):
+    """YouTube video id of a watch URL, falls back to the last path component"""
+    parsed = urlparse(url)
+    return parse_qs(parsed.query).get("v", [os.path.basename(parsed.path)])[0]
+
+
 class VideoScrapper:
-    def __init__(self, poi_filename, video_dir):
+    def __init__(
+        self,
+        poi_filename,
+        video_dir,
+        scheduler_opts=None,
+        ydl_factory=YoutubeDL,
+        state=None,
+        store=None,
+        probe=None,
+        audio_only=False,
+        metrics=None,
+    ):
         """Initialize a class to scrape the actual videos
 
         Args:
             poi_filename (str): filepath to the csv with URLs
             video_dir(str): Directory to store the video and audio files
+            scheduler_opts (dict, optional): Keyword arguments for DownloadScheduler
+            ydl_factory (callable, optional): Builds the downloader from ydl_opts. Defaults to YoutubeDL.
+            state (PipelineState, optional): Skips URLs that were already downloaded.
+            store (MediaStore, optional): Shared store of downloaded videos. Defaults to
+                <video_dir>/.media_store.
+            probe (AudioProbe, optional): Checks the first seconds of audio for the POI's voice
+                before the full download.
+            audio_only (bool, optional): Download only the audio, diarize.py then fetches just
+                the video ranges it needs. Defaults to False.
+            metrics (Metrics, optional): Receives download and probe timings, outcomes and bytes.
         """
         self.poi_filename = poi_filename
         self.df = None
         self.video_dir = video_dir
+        self.ydl_factory = ydl_factory
+        self.state = state
+        self.store = store or MediaStore(os.path.join(video_dir, ".media_store"))
+        self.probe = probe
+        self.audio_only = audio_only
+        self.metrics = metrics or Metrics("video_scrapper")
+        self.scheduler = DownloadScheduler(
+            self.download_task, metrics=self.metrics, **(scheduler_opts or {})
+        )
 
     def read_poi_file(self):
         """Read in the CSV file"""
@@ -56,8 +97,8 @@ class VideoScrapper:
         """Specify the yt-dlp parameters
 
         Args:
-            url (str): URL to retrieve videl
-            name (str): speaker name
+            url (str): URL to retrieve video
+            name (str): speaker name the video was first found for
         """
         ydl_opts = {
             "format": "bestvideo[ext=mp4]+bestaudio[ext=mp4]/mp4+best[height<=480], m4a/bestaudio/best",
@@ -68,16 +109,44 @@ class VideoScrapper:
                 }
             ],
             "postprocessor_args": ["-ar", "16000", "-ac", "1"],
-            "outtmpl": f"{self.video_dir}/{name}/%(id)s.%(ext)s",
+            "outtmpl": self.store.outtmpl(),
             "keepvideo": True,
             "logger": YTLogger,
         }
-        try:
-            with YoutubeDL(ydl_opts) as ydl:
-                ydl.download(url)
-        except Exception as e:
-            print(e)
-            return
+        if self.audio_only:
+            ydl_opts["format"] = "bestaudio/best"
+            ydl_opts["keepvideo"] = False
+        # Errors propagate so the scheduler can retry and record them
+        with self.ydl_factory(ydl_opts) as ydl:
+            ydl.download([url])
+
+    def download_task(self, task):
+        """Download one video for the scheduler, link it to every POI that found it and record it
+
+        Returns:
+            str: "rejected" when the probe heard none of the POIs, None once downloaded
+        """
+        vid = video_id(task["url"])
+        names = task["names"]
+        if self.probe:
+            with self.metrics.timer("probe", url=task["url"]):
+                names = self.probe.matching_names(task["url"], vid, names)
+            if not names:
+                if self.state:
+                    self.state.mark_download(task["url"], task["name"], "rejected")
+                return "rejected"
+        self.download_videos(task["url"], task["name"])
+        self.metrics.count(
+            "bytes_written",
+            sum(file_size(path) for path in self.store.files(vid)),
+            labels={"poi": task["name"]},
+            url=task["url"],
+        )
+        for name in names:
+            self.store.link(vid, os.path.join(self.video_dir, name))
+        if self.state:
+            wav_file = os.path.join(self.store.entry_dir(vid), f"{vid}.wav")
+            self.state.mark_download(task["url"], task["name"], "done", wav_file)
 
     def create_directory(self, name):
         """Create target folder to store audio clips for each name
@@ -86,14 +155,21 @@ class VideoScrapper:
             name (str): Name of each POI
         """
         target_video_dir = os.path.join(self.video_dir, name)
-        if os.path.exists(target_video_dir):  # If directory exists, dont do anything
+        if os.path.exists(target_video_dir):
             return False
         os.makedirs(target_video_dir, exist_ok=True)
         return True
 
     def process_urls(self):
-        """Iterate through each name and download videos into each speaker folder"""
-        for _, row in tqdm(self.df.iterrows(), total=self.df.shape[0]):
+        """Iterate through each name and download videos into each speaker folder
+
+        Downloads of all POIs go through one scheduler, so a slow video only holds up its own
+        worker instead of the whole run. Each unique video is downloaded once into the store,
+        no matter how many POIs found it, and videos already in the store are only linked into
+        the folders of the POIs that found them.
+        """
+        tasks = {}
+        for _, row in self.df.iterrows():
             # Parse string as list
             name = row["Name"]
             name = re.sub(
@@ -102,19 +178,85 @@ class VideoScrapper:
             urls = ast.literal_eval(row["Urls"])
 
             new_poi_flag = self.create_directory(name)  # Create folder for each POI
-            if new_poi_flag:
-                self.download_videos(urls, name)
+            if self.state is None and not new_poi_flag:
+                continue  # Without a state, fall back to skipping existing POIs
+            for url in urls:
+                vid = video_id(url)
+                if self.probe and self.state and self.state.download_status(url) == "rejected":
+                    continue  # Probed before and none of its POIs was heard
+                if self.store.has(vid):
+                    self.store.link(vid, os.path.join(self.video_dir, name))
+                    self.metrics.add("downloads", 1, {"poi": name, "status": "stored"})
+                elif vid in tasks:
+                    tasks[vid]["names"].append(name)
+                else:
+                    tasks[vid] = {"url": url, "name": name, "names": [name]}
+        return self.scheduler.run(list(tasks.values()))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--file", type=str, required=True)
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("DOWNLOAD_WORKERS", "4"))
+    )
+    parser.add_argument(
+        "--per-host", type=int, default=int(os.getenv("DOWNLOAD_PER_HOST", "2"))
+    )
+    parser.add_argument(
+        "--retries", type=int, default=int(os.getenv("DOWNLOAD_RETRIES", "3"))
+    )
+    # Seconds of audio probed for the POI's voice before a full download, 0 disables the probe
+    parser.add_argument(
+        "--probe-seconds", type=int, default=int(os.getenv("PROBE_SECONDS", "0"))
+    )
+    # Write cProfile stats of the run to <METRICS_FOLDER>/video_scrapper.prof
+    parser.add_argument("--profile", action="store_true")
     args = parser.parse_args()
 
+    probe = None
+    if args.probe_seconds > 0:
+        # The speaker model is only needed (and imported) when probing
+        from speechbrain.pretrained import SpeakerRecognition
+        from speaker_embedding import SpeakerEmbedder, get_device
+        from audio_probe import AudioProbe
+
+        spkr_embed_model = SpeakerRecognition.from_hparams(
+            "/models/speechbrain", run_opts={"device": str(get_device())}
+        )
+        probe = AudioProbe(
+            SpeakerEmbedder(spkr_embed_model),
+            ref_audio_dir=os.getenv("REF_AUDIO_DIR"),
+            tmp_folder=os.getenv("TMP_FOLDER"),
+            seconds=args.probe_seconds,
+            threshold=float(os.getenv("VOICE_THRESHOLD")),
+            logger=YTLogger,
+        )
+
     poi_filename = os.path.join(os.getenv("POI_FOLDER"), args.file)
-    clsObj = VideoScrapper(
-        poi_filename,
-        video_dir=os.path.join(os.getenv("DATA_FOLDER"), os.getenv("VIDEO_FOLDER")),
-    )
-    clsObj.read_poi_file()
-    clsObj.process_urls()
+    metrics = Metrics("video_scrapper", folder=os.getenv("METRICS_FOLDER"))
+    with profiled(profile_path("video_scrapper", args.profile)):
+        try:
+            clsObj = VideoScrapper(
+                poi_filename,
+                video_dir=os.path.join(os.getenv("DATA_FOLDER"), os.getenv("VIDEO_FOLDER")),
+                scheduler_opts={
+                    "workers": args.workers,
+                    "per_host": args.per_host,
+                    "retries": args.retries,
+                    "manifest_path": os.path.join(
+                        os.getenv("CACHE_FOLDER"), "download_manifest.jsonl"
+                    ),
+                },
+                state=PipelineState(
+                    os.path.join(os.getenv("CACHE_FOLDER"), "pipeline_state.sqlite")
+                ),
+                probe=probe,
+                audio_only=os.getenv("AUDIO_ONLY") == "true",
+                metrics=metrics,
+            )
+            clsObj.read_poi_file()
+            clsObj.process_urls()
+            print(metrics.summary())
+        finally:
+            metrics.close()